@@ -1,12 +1,34 @@
 # -*- coding: utf-8 -*-
 
-import xml.etree.cElementTree as ET
 import re
-import pymongo as mongoDB
+import json
+import sys
+
+import osm_reader
+import index_builder
+import ingest_checkpoint
+import osm_changes
+import parallel_parse
+import pipeline_metrics
+import pipeline_profiler
+import quality_events
+import storage_backend
+from element_record import ElementRecord
+from street_normalizer import StreetNameNormalizer
+from normalization_cache import NormalizationCache
+import normalization_cache
 
 
 problemchars = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
 
+# The regular expressions used by the cleaning functions. They are compiled once here, and not on every call.
+phone_regex = re.compile(r"\(?\+?(1)?\)?[- .]?\(?(\d\s?\d\s?\d)?\)?[- .]?(\d{3})[- .]?(\d\s?\d\s?\d\s?\d)")
+postal_code_regex = re.compile(r"(\w\d\w)[\s\-\.]{0,2}(\d\w\d)")
+english_street_num_regex = re.compile(r"[\d]+(th|rd|nd|st)")
+french_street_num_regex = re.compile(r"\d+[Ee]")
+num_pattern = re.compile(r"(?<=\d)([Ee])")
+esthetic_pattern = re.compile(r"(\d)[Ee]")
+
 CREATED = [ "version", "changeset", "timestamp", "user", "uid"]
 
 
@@ -22,7 +44,7 @@ french_naming = ["Rue", "rue", \
                  "Route", "route", \
                  "Ruelle", "ruelle", \
                  "Quai", "quai", "Quai-", "quai-", \
-                 "Voie", "Court", "Rang", "rang", "Descente", u"Monte", "Croissant", u"Carr", "Impasse", "Promenade", "Cercle", "Terrasse"]
+                 "Voie", "Court", "Rang", "rang", "Descente", u"Montée", "Croissant", u"Carré", "Impasse", "Promenade", "Cercle", "Terrasse"]
 
 english_naming = "Street street St St. st st. West W. w. W w East E. e. E e".split()
 
@@ -47,6 +69,16 @@ french_to_english = { "Rue" : "Street", "Avenue" : "Avenue", "Boulevard" : "Boul
 # Also will include tags that start with contact
 tags_we_care_about = "amenity cuisine name phone denomination religion wheelchair operator".split()
 
+# All the word lists and dictionaries above compiled into one street name normalizer (see street_normalizer.py). It does
+# the same as the cleaning functions below, but much faster. It has to be rebuilt if the lists are changed.
+street_normalizer = StreetNameNormalizer(french_naming, english_naming, saint_abbreviations_list,
+                                         english_street_abbreviations_dict, english_directions_abbreviation_dict,
+                                         french_abbreviations_dict, french_to_english)
+
+# The memoization caches in front of the normalization functions, by name ("street", "phone" and "postcode"). They are
+# empty until enable_normalization_cache() is called, and the functions are then called directly.
+normalization_caches = normalization_cache.caches
+
 
 
 ########################################################################################################################
@@ -60,15 +92,16 @@ def is_unclean(name):
         return False
 
 
-# A function to connect to a MongoDB server running over the local host.
+# A function to connect to a MongoDB server running over the local host, or to the storage backend selected with
+# storage_backend.select_backend() (see storage_backend.py). The returned handle is used the same way for all of them.
 def connect_to_local_db():
     print "Connecting..."
     # Try to connect
     try:
-        handle = mongoDB.MongoClient()
+        handle = storage_backend.connect()
 
     # If connection fails, alert the user and quit
-    except mongoDB.errors.ConnectionFailure, e:
+    except storage_backend.ConnectionFailure, e:
         print "Could not connect to MongoDB: %s" % e
         return None
 
@@ -89,101 +122,109 @@ def add_document(document, collection_name):
 
 
 # Shape element has the same role as the function within the exercises of the course. Of course there were added
-# functionalities.
+# functionalities. The attributes and the sub-elements are read by shape_into(), which hands them to a builder: a
+# DocumentBuilder here, for the usual nested dictionaries.
 def shape_element(element):
-    node = {}
+    return shape_into(element, DocumentBuilder)
+
+
+# The same as shape_element(), but returning a compact ElementRecord (see element_record.py) instead of nested
+# dictionaries, with the repeated strings interned. record.to_document() gives the same dictionary as shape_element().
+def shape_element_record(element):
+    return shape_into(element, ElementRecord)
+
+
+# The shaping rules shared by shape_element() and shape_element_record(). new_builder(element_type) creates the output,
+# which receives the fields of the element through its add_...() methods, and is returned by its result() method.
+def shape_into(element, new_builder):
+    # We are not interested in processing other nodes, so just return None
+    if element.tag != "node" and element.tag != "way":
+        return None
+
+    builder = new_builder(element.tag)
+
+    # To not add the position unless both are present (In case of a corrupt node that has only one of them)
+    latitude = longitude = None
+
+    for attrib_key, value in element.attrib.iteritems():
+        # check if any if the attributes are not clean
+        if is_unclean(attrib_key):
+            quality_events.record(quality_events.PROBLEMATIC_ATTRIBUTE, attribute = attrib_key,
+                                  element_id = element.attrib.get("id"))
+            continue
+
+        if attrib_key == "lat":
+            latitude = float(value)
+        elif attrib_key == "lon":
+            longitude = float(value)
+        elif attrib_key in CREATED:
+            builder.add_created(attrib_key, value)
+        else:
+            builder.add_attribute(attrib_key, value)
 
-    if element.tag == "node" or element.tag == "way" :
-        # YOUR CODE HERE
+    if latitude is not None and longitude is not None:
+        builder.set_position([latitude, longitude])
 
-        node["created"] = {}
-        node["type"] = element.tag
+    # process the sub-elements for the node or way
+    for sub_elem in element:
+        # Add the refs to node_refs
+        if sub_elem.tag == "nd":
+            if "ref" in sub_elem.attrib:
+                builder.add_node_ref(sub_elem.attrib["ref"])
 
-        # A variable to hold longitude\latitude. It was done that way to always preserve order
-        # and to not add them to the node unless both are present (In case of a corrupt node that has only
-        # one of them.
-        temp_coordinates = []
+        elif sub_elem.tag == "tag":
+            key = sub_elem.attrib["k"]
+            value = sub_elem.attrib["v"]
 
-        for attrib_key in element.attrib:
-            # check if any if the attributes are not clean
-            if is_unclean(attrib_key):
-                print attrib_key + "in element ID: " + element.attrib["id"] + ' contains a problematic character, skipping'
-                continue
+            # If it's an address tag, extract it and add it to the address dictionary
+            if key.startswith("addr:"):
+                address_elements = key.split(":")
+                # Process only if the value of the key has only one column, ignore the rest (As per requirement)
+                if len(address_elements) < 3:
+                    builder.add_address(address_elements[1], value)
 
-            # handle special keys
-            ## longitude\latitude
-            if attrib_key in ["lon", "lat"]:
-                if attrib_key == "lon":
-                    temp_coordinates.append( float(element.attrib[attrib_key]) )
+            elif key.startswith("contact:"):
+                builder.add_info(key.split(":")[1], value)
 
-                if attrib_key == "lat":
-                    temp_coordinates.insert(0, float(element.attrib[attrib_key]) )
+            elif key in tags_we_care_about:
+                if key == "amenity":
+                    builder.set_amenity()
+                builder.add_info(key, value)
 
-                if len(temp_coordinates) == 2:
-                    node["pos"] = temp_coordinates
+    return builder.result()
 
-            ## Created
-            elif attrib_key in CREATED:
-                node["created"][attrib_key] = element.attrib[attrib_key]
 
-            ## Anything else
-            else:
-                node[attrib_key] = element.attrib[attrib_key]
+# The builder of shape_into() for the nested dictionaries of shape_element()
+class DocumentBuilder(object):
+    __slots__ = ("document",)
 
+    def __init__(self, element_type):
         # Assume that it is not an amenity. If this is not correct, we will update it when we find out
-        node["is_amenity"] = False
-
-        # process the sub-elements for the node or way
-        for sub_elem in element.iter():
-            # nd
-            if sub_elem.tag == "nd":
-                # Add the refs to node_refs
-                if "ref" in sub_elem.attrib: # Can a node have refs too ? Or only ways have refs?
-                    if "node_refs" in node:
-                        node["node_refs"].append(sub_elem.attrib["ref"])
-                    else:
-                        node["node_refs"] = [sub_elem.attrib["ref"]]
-
-            # tag
-            elif sub_elem.tag == "tag":
-
-                # If it's an address tag, extract it and add it to the address dictionary
-                if sub_elem.attrib["k"].startswith("addr:"):
-                    address_elements = sub_elem.attrib["k"].split(":")
-                    # Process only if the value of the key has only one column, ignore the rest (As per requirement)
-                    if len(address_elements) < 3:
-                        if "address" in node:
-                            node["address"][ address_elements[1] ] = sub_elem.attrib["v"]
-                        else:
-                            node["address"] = {}
-                            node["address"][ address_elements[1] ] = sub_elem.attrib["v"]
-
-                elif sub_elem.attrib["k"].startswith("contact:"):
-                    contact_elements = sub_elem.attrib["k"].split(":")
-
-                    if "info" in node:
-                        node["info"][ contact_elements[1] ] = sub_elem.attrib["v"]
-                    else:
-                        node["info"] = {}
-                        node["info"][ contact_elements[1] ] = sub_elem.attrib["v"]
-
-                else:
-                    if sub_elem.attrib["k"] in tags_we_care_about:
-                        # Update the is_amenity to be true
-                        if sub_elem.attrib["k"] == "amenity":
-                            node["is_amenity"] = True
-
-                        if "info" in node:
-                            node["info"][sub_elem.attrib["k"] ] =  sub_elem.attrib["v"]
-                        else:
-                            node["info"] = {}
-                            node["info"][sub_elem.attrib["k"] ] = sub_elem.attrib["v"]
-
-        return node
+        self.document = {"created" : {}, "type" : element_type, "is_amenity" : False}
 
-    # We are not interested in processing other nodes, so just return None
-    else:
-        return None
+    def add_created(self, key, value):
+        self.document["created"][key] = value
+
+    def add_attribute(self, key, value):
+        self.document[key] = value
+
+    def set_position(self, position):
+        self.document["pos"] = position
+
+    def set_amenity(self):
+        self.document["is_amenity"] = True
+
+    def add_node_ref(self, ref):
+        self.document.setdefault("node_refs", []).append(ref)
+
+    def add_address(self, key, value):
+        self.document.setdefault("address", {})[key] = value
+
+    def add_info(self, key, value):
+        self.document.setdefault("info", {})[key] = value
+
+    def result(self):
+        return self.document
 
 
 # A function to clear all the contents of a collection. Used when we want to rerun the program after making some changes,
@@ -193,40 +234,232 @@ def clear_collection(db_name, collection_name):
         db_name[collection_name].drop()
 
 
-# A function that is used to handle detected corrupt fields. It raises a flag called "has_corrupt_data" to be True, and
-# appends the corrupt field to a newly created field "corrupt_field". This way, we can later query where changes has been
-# made, and maybe manually correct the data.
-def process_corrupt_data(db_name, collection_name, object_id, corrupt_field):
-    # Mark the document to have corrupt data
-    db_name[collection_name].update_one( {
-                                        "_id" : object_id
-                                    },
-                                    {
-                                        "$set" :
-                                            {
-                                                "has_corrupt_data" : True
-                                            }
-                                    }
-                                   )
-
-    # Append the corrupt data to the corrupt_fields field for manual inspection later
-    db_name[collection_name].update_one( {
-                                        "_id" : object_id
-                                    },
-                                    {
-                                        "$set" :
-                                            {
-                                                "corrupt_fields" : corrupt_field
-                                            }
-                                    }
-                                   )
+# The default number of document updates sent to the server in one bulk_write() call by the cleaning stages
+CLEANING_BATCH_SIZE = 1000
+
+
+# A class that collects the updates of a cleaning stage and sends them to the server in unordered bulk_write() batches,
+# instead of one update_one() round trip per change. Each document gets exactly one update, so all the changes of a
+# document have to be merged before calling add(). If the metrics of the stage are passed (see pipeline_metrics.py), the
+# time and the latency of the writes are added to them. If a profiler is passed (see pipeline_profiler.py), it is told
+# about the end of every batch.
+class CleaningBatch(object):
+    def __init__(self, collection, stage_name, batch_size = CLEANING_BATCH_SIZE, metrics = None, profiler = None):
+        self.collection = collection
+        self.stage_name = stage_name
+        self.batch_size = batch_size
+        self.profiler = profiler
+
+        self.bulk_write = collection.bulk_write
+        if metrics is not None:
+            self.bulk_write = metrics.timed_write(collection.bulk_write)
+
+        self.requests = []
+        self.flagged = 0
+        self.batch_count = 0
+
+        # Totals over the whole stage
+        self.total_matched = 0
+        self.total_modified = 0
+        self.total_flagged = 0
+
+    def add(self, object_id, update, is_corrupt = False):
+        self.requests.append(storage_backend.UpdateOne({"_id" : object_id}, update))
+        if is_corrupt:
+            self.flagged += 1
+
+        if len(self.requests) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.requests:
+            return
+
+        # Unordered, so the server can apply the updates in parallel and does not stop at the first error
+        result = self.bulk_write(self.requests, ordered = False)
+        self.batch_count += 1
+
+        print "%s batch %d: %d matched, %d modified, %d flagged as corrupt" % \
+              (self.stage_name, self.batch_count, result.matched_count, result.modified_count, self.flagged)
+
+        self.total_matched += result.matched_count
+        self.total_modified += result.modified_count
+        self.total_flagged += self.flagged
+
+        self.requests = []
+        self.flagged = 0
+        if self.profiler is not None:
+            self.profiler.batch_done()
+
+    def close(self):
+        self.flush()
+        print "%s finished: %d matched, %d modified, %d flagged as corrupt in %d batches" % \
+              (self.stage_name, self.total_matched, self.total_modified, self.total_flagged, self.batch_count)
+
+
+# A function that is used to handle detected corrupt fields. It raises a flag called "has_corrupt_data" to be True,
+# appends the corrupt field to a newly created field "corrupt_field" and removes the corrupt field from the document.
+# This way, we can later query where changes has been made, and maybe manually correct the data.
+# The three changes are merged into one update that is added to the cleaning stage's batch.
+def process_corrupt_data(batch, object_id, corrupt_field, field_name):
+    batch.add(object_id,
+              {
+                  "$set" :
+                      {
+                          "has_corrupt_data" : True,
+                          "corrupt_fields" : corrupt_field
+                      },
+                  "$unset" :
+                      {
+                          field_name : ""
+                      }
+              },
+              is_corrupt = True)
+
+
+# The in-memory equivalent of process_corrupt_data(), used when the document is cleaned before it reaches the database.
+# The same two fields are set, so documents cleaned at ingest and documents cleaned from the database look the same.
+def flag_corrupt_element(document, corrupt_field):
+    document["has_corrupt_data"] = True
+    document["corrupt_fields"] = corrupt_field
+
+
+# A function that cleans a freshly shaped element before it is buffered for insertion. It applies the same rules as
+# clean_phone_numbers() and clean_address_info(), but on the dictionary itself, so every document is written only once
+# and already clean, instead of being re-read and updated from the database afterwards.
+def clean_shaped_element(node):
+    if "info" in node and "phone" in node["info"]:
+        phones = cached_normalization("phone", standardize_phone_number, node["info"]["phone"])
 
+        if phones:
+            node["info"]["phone"] = phones
+        # No valid phones were found, flag the document and delete the phone field
+        else:
+            quality_events.record(quality_events.NO_VALID_PHONE, element_id = node.get("id"),
+                                  phone = node["info"]["phone"])
+            flag_corrupt_element(node, node["info"]["phone"])
+            del node["info"]["phone"]
+
+    if "address" in node:
+        current_address = standardize_address_info(node["address"])
+
+        if current_address:
+            node["address"] = current_address
+        else:
+            quality_events.record(quality_events.NO_VALID_ADDRESS, element_id = node.get("id"),
+                                  address = node["address"])
+            flag_corrupt_element(node, node["address"])
+            del node["address"]
+
+    return node
+
+
+# Shapes an element and cleans it right away. Defined as a module level function so that it can be sent to the worker
+# processes of a parallel parse, which then do the cleaning as well.
+def shape_and_clean_element(element):
+    shaped_element = shape_element(element)
+    if shaped_element:
+        shaped_element = clean_shaped_element(shaped_element)
+    return shaped_element
+
+
+# The version of the shaping rules, used to invalidate the parse cache (see parse_cache.py) when they change. Increase
+# SHAPE_VERSION when shape_element() itself changes.
+SHAPE_VERSION = 1
+
+def shape_rules_version():
+    return json.dumps([SHAPE_VERSION, CREATED, tags_we_care_about, problemchars.pattern])
+
+
+# A generator that parses the map file serially, and yields the shaped elements (passed through shape_function) one by
+# one. The count of every tag found is added to the tag_count dictionary.
+def iterate_shaped_elements(filename, tag_count, shape_function = shape_element):
+    # The parsing is done by truly iteravily check an item and then discarding it, thus saving a lot of RAM (see
+    # osm_reader.py). The elements are shaped only once they are complete, ie once all their tags and nds were parsed.
+    for element in osm_reader.iterate_elements(filename, tag_count = tag_count):
+        shaped_element = shape_function(element)
+        if shaped_element:
+            yield shaped_element
+
+
+# Returns a shape function that adds the time of the shaping and, if a clean function is passed, of the cleaning of
+# the elements to the metrics of the stage, separately (see pipeline_metrics.py). Only used by the serial parse, as it
+# can not be sent to the processes of a parallel parse.
+def timed_shape_function(metrics, shape_function, clean_function = None):
+    shape_function = metrics.timed("shape", shape_function)
+    if clean_function is None:
+        return shape_function
+
+    def shape_and_clean(element):
+        shaped_element = shape_function(element)
+        if shaped_element:
+            shaped_element = clean_function(shaped_element)
+        return shaped_element
+    return shape_and_clean
+
+
+# A function that prepares a full buffer for insertion: converts the records to dictionaries if compact records are used
+# (and cleans them with clean_function, as the cleaning works on dictionaries), then adds the way geometries if a node
+# index is passed, and converts the documents to the typed schema if typed is set to true.
+def prepare_batch(buffer, compact_records = False, clean_on_ingest = False, coordinates = None,
+                  clean_function = clean_shaped_element, typed = False):
+    if compact_records:
+        buffer = [record.to_document() for record in buffer]
+        if clean_on_ingest:
+            buffer = [clean_function(document) for document in buffer]
+
+    if coordinates is not None:
+        # Imported here, as it needs numpy
+        import node_index
+
+        for document in buffer:
+            if document["type"] == "node":
+                coordinates.add_document(document)
+        node_index.add_way_geometry(buffer, coordinates)
+
+    if typed:
+        # Imported here, as it needs numpy
+        import typed_schema
+        typed_schema.convert_batch(buffer)
+
+    return buffer
 
 
 # A function that opens the map XML file and loads it into a running MongoDB server on the local host..
-# The last parameter for that function is by default false. If set to true, the function will delete all the contents
+# The clean_up parameter is by default false. If set to true, the function will delete all the contents
 # of the collection before loading the XML data.
-def insert_xml_map_to_db(filename, db_name, collection_name, clean_up = False):
+# If clean_on_ingest is set to true, the phone numbers and addresses are cleaned while the data is loaded (see
+# clean_shaped_element()), and there is no need to call clean_osm_data() afterwards.
+# If parallel is set to true, the file is parsed, shaped (and cleaned) by a pool of processes (see parallel_parse.py).
+# The documents are inserted in the file's order, unless ordered is set to false.
+# If use_parse_cache is set to true, the shaped elements are read from a binary cache of the map file (see
+# parse_cache.py), built on the first run, so the XML is not parsed again as long as the map file does not change. With
+# parallel, the cache is built by the parallel parse.
+# If way_geometry is set to true, the coordinates of the nodes are kept in an index (see node_index.py), and every way
+# gets a position (its centroid), a bounding box and a length before it is inserted. The nodes must come before the
+# ways, as they do in the OSM files, so it can not be used with an unordered parallel parse.
+# If compact_records is set to true, the elements of a serial parse are shaped into compact records (see
+# element_record.py), converted to dictionaries only when their batch is inserted.
+# If checkpoints is set to true, a checkpoint is recorded after every batch inserted (see ingest_checkpoint.py), and the
+# documents get their ordinal in the file as _id. The collection must be empty (or cleared with clean_up) when the load
+# starts. If resume is set to true, a load that was interrupted is resumed from its last checkpoint (clean_up is then
+# ignored), or started over if there is none. The checkpoints need a serial parse and inserts done by this process, so
+# they can not be used with parallel, use_parse_cache or pipelined.
+# The time of the parse, shape, clean, serialize and write phases, the rate of the elements, the insert latencies and
+# the peak memory are added to the metrics of the run (see pipeline_metrics.py), and the progress is printed after every
+# batch, with an ETA computed from the position in the map file. The shaping and cleaning done by the processes of a
+# parallel parse are counted in the parse phase. With pipelined, the write phase is the time the parser waited for the
+# background writers.
+# The load is profiled as the "load" stage if it is selected with pipeline_profiler.configure().
+# If typed is set to true, the documents are inserted with the typed schema (see typed_schema.py): integer ids, refs and
+# versions, datetime timestamps and GeoJSON positions.
+def insert_xml_map_to_db(filename, db_name, collection_name, clean_up = False, clean_on_ingest = False,
+                         parallel = False, processes = None, ordered = True, use_parse_cache = False,
+                         way_geometry = False, compact_records = False, pipelined = False, writers = 1,
+                         checkpoints = False, resume = False, batch_size = 10000, typed = False):
+    if (checkpoints or resume) and (parallel or use_parse_cache or pipelined):
+        raise ValueError("The checkpoints can not be used with parallel, use_parse_cache or pipelined")
+
     db_server_handle = connect_to_local_db()
     if db_server_handle == None:
         print "Could not connect, XML map file loading failed"
@@ -234,59 +467,124 @@ def insert_xml_map_to_db(filename, db_name, collection_name, clean_up = False):
 
     # Open the databse
     db = open_db(db_server_handle, db_name)
+
+    checkpoint = None
+    resuming = False
+    if checkpoints or resume:
+        checkpoint = ingest_checkpoint.IngestCheckpoint(ingest_checkpoint.checkpoint_path(db_name, collection_name),
+                                                        filename, db[collection_name])
+        resuming = resume and checkpoint.load()
+
     #Clear the collection if requested
-    if clean_up:
+    if clean_up and not resuming:
         clear_collection(db, collection_name)
+    if checkpoint is not None and not resuming and db[collection_name].count() > 0:
+        raise ValueError("A load with checkpoints needs an empty collection, use clean_up")
 
     # A dictionary to hold the unique encountered tags and their count, just for exploration purposes.
     tag_count = {}
 
     # a buffer to hold a certain amount of documents to be inserted. It is used to take advantage of the performance
-    # benefits of batch inserting.  The size will be 10,000 (ten thousands) document batch per insert
+    # benefits of batch inserting.  The size will be 10,000 (ten thousands) document batch per insert by default
     buffer = []
 
-    # counter of how many documents were inserted
-    counter = 1
-
-    # Set for efficient parsing. Parsing will not be by building a tree as usual, but by truly iteravily check an item
-    # and then discarding it, thus saving a lot of RAM The method is to get the root node before looping, start looping
-    # and then clear the root node, and by that the tree is destroyed (Or so is how I understand it)
-    # The older method's problem was that it never deleted the node, it just cleared its contents, and therefore
-    # cramming the RAM with a huge number of empty nodes, which still take a lot of space when the file is huge. The old
-    # method is:
-    # for event, child in ET.iterparse(filename, events=("start", )):
-
-    # Get an iterable over the tree
-    tree_iterable = ET.iterparse(filename, events=("start", ))
-
-    # Turn the iterable into an iterator
-    tree_iterator = iter(tree_iterable)
+    # The parse cache is not read by position in the map file, so there is no ETA
+    metrics = pipeline_metrics.stage("Load", "elements",
+                                     None if use_parse_cache else pipeline_metrics.input_size(filename))
+    if resuming:
+        checkpoint.remove_unrecorded_documents()
+        metrics.start_position = metrics.position = checkpoint.chunk_start or 0
 
-    # get the root element, so we can delete it
-    event, root = tree_iterator.next()
-
-
-    # ITERATE OVER XML FILE
-    for event, child in tree_iterator:
-        if child.tag in tag_count:
-            tag_count[child.tag] += 1
-        else:
-            tag_count[child.tag] = 1
-
-        shaped_element = shape_element(child)
-        if shaped_element:
-            buffer.append(shaped_element)
-            if len(buffer) == 10000:
-                db[collection_name].insert_many(buffer)
-                buffer = []
-                print str(counter*10000) + " documents inserted so far"
-                counter += 1
+    if clean_on_ingest:
+        shape_function = shape_and_clean_element
+    else:
+        shape_function = shape_element
 
-        # Clear the root, and save RAM!
-        root.clear()
+    # The serial parse times the shaping and the cleaning separately
+    clean_function = metrics.timed("clean", clean_shaped_element)
+    if compact_records:
+        # The records are cleaned once converted, in prepare_batch()
+        serial_shape_function = timed_shape_function(metrics, shape_element_record)
+    else:
+        serial_shape_function = timed_shape_function(metrics, shape_element,
+                                                     clean_function if clean_on_ingest else None)
+
+    if use_parse_cache:
+        # Imported here, as it needs numpy
+        import parse_cache
+
+        # The cache holds the shaped elements before cleaning, so that changing the cleaning rules does not require
+        # rebuilding it
+        shaped_elements = parse_cache.cached_shaped_elements(filename, shape_element, shape_rules_version(), tag_count,
+                                                             parallel = parallel, processes = processes)
+        if clean_on_ingest:
+            shaped_elements = (clean_function(element) for element in shaped_elements)
+    elif parallel:
+        shaped_elements = parallel_parse.parallel_shape(filename, shape_function, processes, ordered, tag_count,
+                                                        progress = metrics.set_position)
+    elif checkpoint is not None:
+        shaped_elements = checkpoint.shaped_elements(serial_shape_function, tag_count, metrics.set_position)
+    else:
+        shaped_elements = iterate_shaped_elements(pipeline_metrics.progress_source(filename, metrics), tag_count,
+                                                  serial_shape_function)
+    compact_records = compact_records and not (use_parse_cache or parallel)
+
+    coordinates = None
+    if way_geometry:
+        # Imported here, as it needs numpy
+        import node_index
+        coordinates = node_index.NodeCoordinateIndex()
+        if resuming:
+            # The nodes loaded before the checkpoint
+            for document in db[collection_name].find({"type": "node", "pos": {"$exists": True}}):
+                coordinates.add_document(document)
+
+    if pipelined:
+        # Imported here, as it needs the bson package
+        import pipelined_ingest
+
+        # The batches are inserted by background threads while the parsing goes on
+        # The documents are encoded to BSON by writer.write(), and inserted by the background writers
+        writer = pipelined_ingest.BackgroundWriter(db[collection_name], writers)
+        insert_batch = metrics.timed("serialize", writer.write)
+    elif checkpoint is not None:
+        insert_batch = metrics.timed_write(checkpoint.insert_batch)
+    else:
+        insert_batch = metrics.timed_write(db[collection_name].insert_many)
+
+    profiler = pipeline_profiler.stage_profiler("load")
+    profiler.start()
+    for shaped_element in metrics.iterate("parse", shaped_elements):
+        buffer.append(shaped_element)
+        if len(buffer) == batch_size:
+            buffer = metrics.call("serialize", prepare_batch, buffer, compact_records, clean_on_ingest, coordinates,
+                                  clean_function, typed)
+            insert_batch(buffer)
+            metrics.items += len(buffer)
+            buffer = []
+            metrics.report_progress()
+            profiler.batch_done()
 
     # Insert the last batch of nodes that were not inserted because the data finished before that buffer reached 1000
-    db[collection_name].insert_many(buffer)
+    buffer = metrics.call("serialize", prepare_batch, buffer, compact_records, clean_on_ingest, coordinates,
+                          clean_function, typed)
+    if way_geometry:
+        coordinates.report()
+    if buffer:
+        insert_batch(buffer)
+        metrics.items += len(buffer)
+    profiler.finish()
+    if pipelined:
+        metrics.call("write", writer.close)
+        # The time the parser waited for a free place in the queue of the writers
+        metrics.add_time("serialize", -writer.backpressure_wait)
+        metrics.add_time("write", writer.backpressure_wait)
+        metrics.latencies.extend(writer.latencies)
+        writer.report()
+    if checkpoint is not None:
+        checkpoint.remove()
+    metrics.finish()
+    metrics.report()
 
     print "Data Loading Finished."
     print "A total of " + str(db[collection_name].count() ) + " elements loaded."
@@ -296,27 +594,109 @@ def insert_xml_map_to_db(filename, db_name, collection_name, clean_up = False):
     # Clean up
     db_server_handle.close()
 
+# A function that applies an OSM change file (.osc) to a collection loaded with insert_xml_map_to_db(), instead of
+# reloading the whole map (see osm_changes.py). The created and modified elements are shaped and, if clean is set to
+# true, cleaned before they are written, so only the documents touched by the changes are cleaned again. The way
+# geometries (see node_index.py) and the locations of the 2dsphere index (see index_builder.py) are not computed for the
+# changed elements: run build_query_indexes() again to add the locations. Set typed to true if the collection was loaded
+# with the typed schema.
+def apply_change_file(filename, db_name, collection_name, clean = True, batch_size = osm_changes.CHANGE_BATCH_SIZE,
+                      typed = False):
+    db_server_handle = connect_to_local_db()
+    db = open_db(db_server_handle, db_name)
+
+    if clean:
+        shape_function = shape_and_clean_element
+    else:
+        shape_function = shape_element
+    osm_changes.apply_changes(db[collection_name], osm_reader.iterate_changes(filename), shape_function, batch_size,
+                              typed)
+
+    db_server_handle.close()
+
+# A function that builds the indexes of the cleaning queries and of the amenity lookup of build_spatial_index() once the
+# data is loaded (building them after the load is faster than updating them on every insert), and checks that all these
+# queries use them. The statistics of map_stats() scan the whole collection by design. It raises an
+# index_builder.CollectionScanError if one of them still scans the whole collection (see index_builder.py). Set typed to
+# true if the collection was loaded with the typed schema.
+def build_query_indexes(db_name, collection_name, typed = False):
+    db_server_handle = connect_to_local_db()
+    db = open_db(db_server_handle, db_name)
+
+    index_builder.build_indexes(db[collection_name], typed)
+
+    db_server_handle.close()
+
+# A function that builds the spatial index of the amenities having a position (see spatial_index.py) from the loaded
+# data, and saves it to filename, so the radius and nearest amenity queries can be answered without the database.
+def build_spatial_index(db_name, collection_name, filename):
+    # Imported here, as it needs numpy
+    import spatial_index
+
+    db_server_handle = connect_to_local_db()
+    db = open_db(db_server_handle, db_name)
+
+    index = spatial_index.AmenitySpatialIndex.build(db[collection_name].find({"is_amenity": True}))
+    index.save(filename)
+    print "Spatial index of %d amenities saved to %s" % (len(index), filename)
+
+    db_server_handle.close()
+    return index
+
 def get_data(data):
     # A function to extract the data in question that can come in different formatting. For example, if the data is
     # still freshly loaded, it might be represented by a string. If the data was already loaded within the database and
     # was processed before, the field might become a list. This function will extract the data no matter how is the
     # could have been represented by the program before
     # If the data was already formatted as an array\list, convert it to a string so that we can perform regex on it
+    # Note: data coming directly from the XML parser can be a plain str, while data coming from the database is unicode
     data_str = ""
     if type(data) == list:
         data_str = " ".join(data)
-    elif type(data) == basestring or type(data) == unicode:
+    elif isinstance(data, basestring):
         data_str = data
     else:
-        print "Unexpected type for phone number: " + type(data)
+        quality_events.record(quality_events.UNEXPECTED_DATA_TYPE, data_type = type(data).__name__)
         return
     return data_str
 
+# A function that puts a memoization cache (see normalization_cache.py) in front of the normalization of the street names,
+# phone numbers and postal codes. Every cache is identified by the rules it depends on, so changing any of the word
+# lists, dictionaries or regular expressions below automatically invalidates the results kept on the disk.
+def enable_normalization_cache(cache_dir = normalization_cache.DEFAULT_CACHE_DIR,
+                               max_memory_entries = normalization_cache.DEFAULT_MEMORY_ENTRIES, persistent = True):
+    street_rules = [french_naming, english_naming, saint_abbreviations_list, english_street_abbreviations_dict,
+                    english_directions_abbreviation_dict, french_abbreviations_dict, french_to_english,
+                    english_street_num_regex.pattern, french_street_num_regex.pattern, num_pattern.pattern,
+                    esthetic_pattern.pattern]
+
+    normalization_caches["street"] = NormalizationCache("street", street_normalizer.normalize, street_rules,
+                                                        cache_dir, max_memory_entries, persistent)
+    normalization_caches["phone"] = NormalizationCache("phone", standardize_phone_number, [phone_regex.pattern],
+                                                       cache_dir, max_memory_entries, persistent)
+    normalization_caches["postcode"] = NormalizationCache("postcode", standardize_postal_code,
+                                                          [postal_code_regex.pattern], cache_dir, max_memory_entries,
+                                                          persistent)
+
+
+# Prints the hit and miss rates of every cache, and writes the new results to the disk
+def report_normalization_cache():
+    for name in sorted(normalization_caches):
+        normalization_caches[name].flush()
+        normalization_caches[name].report()
+
+
+# Calls the normalization function through its cache, if the caches are enabled
+def cached_normalization(cache_name, function, value):
+    cache = normalization_caches.get(cache_name)
+    if cache is None:
+        return function(value)
+    return cache(value)
+
+
 # A function that uses regex to extract phone number and then standardizing them into the following format:
 # +1 (XXX) XXX-XXXX
 def standardize_phone_number(number):
-    phone_regex = re.compile(r"\(?\+?(1)?\)?[- .]?\(?(\d\s?\d\s?\d)?\)?[- .]?(\d{3})[- .]?(\d\s?\d\s?\d\s?\d)")
-
     # If the data was already formatted as an array\list, convert it to a string so that we can perform regex on it
 
     str_number = get_data(number)
@@ -325,7 +705,7 @@ def standardize_phone_number(number):
     result = []
 
     if all_phones == []:
-        print "Corrupt phone number: ", number
+        quality_events.record(quality_events.CORRUPT_PHONE, phone = number)
         return
 
     for nums in all_phones:
@@ -338,8 +718,7 @@ def standardize_phone_number(number):
         area_code = nums[1]
         if (area_code == "") or (len(area_code) != 3):
             is_number_corrupt = True
-            print ''.join(nums) + " phone number is corrupt: No area code found, area code is not equal to 3 digits or there is a missing digit"
-            print "    deleting..."
+            quality_events.record(quality_events.PHONE_WITHOUT_AREA_CODE, phone = ''.join(nums))
 
         if not number_is_corrupt:
             formatted_number = "+1 (" + area_code + ") " + str(nums[2]) + "-" + str(nums[3])
@@ -350,49 +729,46 @@ def standardize_phone_number(number):
 
 
 # THis function gets all fields with phone numbers, attempts to standardize them. If the operation fails, it declares
-# the document to be containing a corrupt data (phone number in this case), calls process_corrupt_data() then deletes
-# the corrupt phone field
-def clean_phone_numbers(db_name, collection_name):
+# the document to be containing a corrupt data (phone number in this case) and calls process_corrupt_data(), which also
+# deletes the corrupt phone field. The updates are sent in bulk batches of batch_size documents.
+# The time of the read, clean and write phases is added to the metrics of the run (see pipeline_metrics.py), and the
+# stage is profiled as "phone_cleanup" if it is selected with pipeline_profiler.configure().
+def clean_phone_numbers(db_name, collection_name, batch_size = CLEANING_BATCH_SIZE):
     print "Starting phone numbers cleanup."
     db_server_handle = connect_to_local_db()
     db = open_db(db_server_handle, db_name)
 
+    metrics = pipeline_metrics.stage("Phone numbers cleanup", "documents")
     cursor = db[collection_name].find( {"info.phone": {"$exists": True}} )
+    profiler = pipeline_profiler.stage_profiler("phone_cleanup")
+    batch = CleaningBatch(db[collection_name], "Phone numbers cleanup", batch_size, metrics, profiler)
+    profiler.start()
 
-    for docs in cursor:
+    for docs in metrics.iterate("read", cursor):
         doc_id = docs["_id"]
+        metrics.items += 1
 
-        phones = standardize_phone_number(docs["info"]["phone"])
+        phones = metrics.call("clean", cached_normalization, "phone", standardize_phone_number, docs["info"]["phone"])
 
         # If phone is valid, ie there was a result passed back from the standardized_phone_number() function
         if phones:
-            db[collection_name].update_one( {
-                                                "_id" : doc_id
-                                            },
-                                            {
-                                                "$set" :
-                                                    {
-                                                        "info.phone" : phones
-                                                    }
-                                            }
-                                           )
+            batch.add(doc_id,
+                      {
+                          "$set" :
+                              {
+                                  "info.phone" : phones
+                              }
+                      })
         # No valid phones were found, delete the phone field
         else:
-            print "No valid phone number found, removing the phone field.."
-            print docs["info"]["phone"]
-            process_corrupt_data(db, collection_name, doc_id, docs["info"]["phone"] )
-
-            db[collection_name].update_one( {
-                                                "_id" : doc_id
-                                            },
-                                            {
-                                                "$unset" :
-                                                    {
-                                                        "info.phone" : ""
-                                                    }
-                                            }
-                                           )
-
+            quality_events.record(quality_events.NO_VALID_PHONE, document_id = str(doc_id),
+                                  phone = docs["info"]["phone"])
+            process_corrupt_data(batch, doc_id, docs["info"]["phone"], "info.phone")
+
+    batch.close()
+    profiler.finish()
+    metrics.finish()
+    metrics.report()
     db_server_handle.close()
     #delete fields with null values
 
@@ -404,8 +780,6 @@ def standardize_postal_code(code):
     # If the data was already formatted as an array\list, convert it to a string so that we can perform regex on it
     str_code = get_data(code)
 
-    postal_code_regex = re.compile(r"(\w\d\w)[\s\-\.]{0,2}(\d\w\d)")
-
     all_postal_codes = re.findall(postal_code_regex, str_code)
 
     result = []
@@ -444,9 +818,7 @@ def is_street_in_english(street_name):
 
     # Sometimes the street is named in a numberical form, like 5th street. If it detects a number followed by th, nd..etc
     # it will assume that this is an English street name
-    street_num_regex = re.compile(r"[\d]+(th|rd|nd|st)")
-
-    if re.findall(street_num_regex, street_name):
+    if re.findall(english_street_num_regex, street_name):
         is_english = True
 
     for english_end in english_naming:
@@ -463,9 +835,7 @@ def is_street_in_french(street_name):
     is_french = False
 
     # A regular expression to catch streets named in numbers in French (eg 24e . THis is equivalent to 24th in English)
-    street_num_regex = re.compile(r"\d+[Ee]")
-
-    if re.findall(street_num_regex, street_name):
+    if re.findall(french_street_num_regex, street_name):
         is_french = True
 
     for french_start in french_naming:
@@ -501,9 +871,7 @@ def expand_abbreviations(street_name):
     if is_street_in_french(street_name):
         for abbrv in french_abbreviations_dict:
             if abbrv in street_name_list:
-                print "Abbrv found: " + abbrv + " in : " + street_name
                 street_name_list[ street_name_list.index(abbrv)] = french_abbreviations_dict[abbrv]
-                print " ".join(street_name_list)
 
     street_name = " ".join(street_name_list)
 
@@ -535,8 +903,6 @@ def translate_french_to_english(street_name):
     street_name = " ".join(street_name_list)
 
     # The final step: convert street numbers to English --> 23e --> 23rd
-    num_pattern = re.compile(r"(?<=\d)([Ee])")
-    esthetic_pattern = re.compile(r"(\d)[Ee]")
     french_number_street = re.findall(esthetic_pattern, street_name)
 
     # What we are going to substitute the e at the end of the number with. This is just an esthetical part. In french,
@@ -574,11 +940,11 @@ def standardize_address_info(address):
 
     if "postcode" in address:
         #clean the post code
-        formatted_postcode = standardize_postal_code(address["postcode"])
+        formatted_postcode = cached_normalization("postcode", standardize_postal_code, address["postcode"])
         if formatted_postcode:
             address["postcode"] = formatted_postcode
         else:
-            print "Corrupt postal code: " + address["postcode"]
+            quality_events.record(quality_events.CORRUPT_POSTCODE, postcode = address["postcode"])
 
     # If we have a street name within the address, and it is NOT an empty field
     if ("street" in address) and address["street"] != "":
@@ -594,18 +960,19 @@ def standardize_address_info(address):
         # But we will do nothing about it, as there is, for example, a street called Canada in the city of Montreal
         for suspect in [',', 'QC', 'Quebec', 'Montreal', 'Canada']:
             if  suspect in address["street"]:
-                print "Warning, a potentially long address: " + street_name
-
-        # Remove all the dashes -  in the street name. The - is heavily used in French naming, like St-Cathering Street
-        # It will be replaced by a space
-        street_name = street_name.replace("-", " ")
+                quality_events.record(quality_events.LONG_ADDRESS, street = street_name, suspect = suspect)
 
-        # Expand all the abbreviations in the street_name, if there are ones
-        street_name = expand_abbreviations(street_name)
+        # Remove all the dashes -  in the street name (the - is heavily used in French naming, like St-Cathering Street),
+        # expand all the abbreviations in the street_name, if there are ones, and translate the street_name to English
+        # if it's in French. This is the same as calling expand_abbreviations(), is_street_in_french() and
+        # translate_french_to_english(), but done by the compiled normalizer
+        original_street_name = street_name
+        street_name = cached_normalization("street", street_normalizer.normalize, street_name)
 
-        # Translate the street_name to English if it's in French
-        if is_street_in_french(street_name):
-            street_name = translate_french_to_english(street_name)
+        # Recorded here, and not by the normalizer, so the street names normalized by the cache are counted too
+        for abbreviation in street_normalizer.french_abbreviations_in(original_street_name):
+            quality_events.record(quality_events.ABBREVIATION_EXPANDED, abbreviation = abbreviation,
+                                  street = original_street_name, expanded = street_name)
 
     else:
         #THis is tricky an address without a street. Npthing to be done for that for now
@@ -621,168 +988,132 @@ def standardize_address_info(address):
 
 # A function that calls all the cleaning processes for a street name. If the street name was detected to be corrupt and
 # cannot be worked with, the corrupt data flag is created, the corrupt street name is apended to the corrupt data field
-# and is removed from the info field.
-def clean_address_info(db_name, collection_name):
+# and is removed from the info field. The updates are sent in bulk batches of batch_size documents.
+# The time of the read, clean and write phases is added to the metrics of the run (see pipeline_metrics.py), and the
+# stage is profiled as "address_cleanup" if it is selected with pipeline_profiler.configure().
+def clean_address_info(db_name, collection_name, batch_size = CLEANING_BATCH_SIZE):
     db_server_handle = connect_to_local_db()
     db = open_db(db_server_handle, db_name)
 
-    cursor = db[collection_name].find( {"address": {"$exists": True}} )
+    metrics = pipeline_metrics.stage("Address cleanup", "documents")
+    # Sorted by _id, so MongoDB reads the documents from the partial index of the addresses (see index_builder.py)
+    cursor = db[collection_name].find( {"address": {"$exists": True}}, sort = [("_id", 1)] )
+    profiler = pipeline_profiler.stage_profiler("address_cleanup")
+    batch = CleaningBatch(db[collection_name], "Address cleanup", batch_size, metrics, profiler)
+    profiler.start()
 
-    for docs in cursor:
+    for docs in metrics.iterate("read", cursor):
         doc_id = docs["_id"]
+        metrics.items += 1
 
-        current_address = standardize_address_info(docs["address"])
+        current_address = metrics.call("clean", standardize_address_info, docs["address"])
 
         # If address is valid, ie there was a result passed back from the standardize_address_info() function
         if current_address:
-            db[collection_name].update_one( {
-                                                "_id" : doc_id
-                                            },
-                                            {
-                                                "$set" :
-                                                    {
-                                                        "address" : current_address
-                                                    }
-                                            }
-                                           )
-        # No valid phones were found, delete the phone field
+            batch.add(doc_id,
+                      {
+                          "$set" :
+                              {
+                                  "address" : current_address
+                              }
+                      })
+        # No valid address was found, move the address to the document's corrupt_fields field
         else:
-            print "No valid address found in, removing the phone field to the document's corrupt_fields field"
-            #db[collection_name]["contains_corrupted_data"] = True
-            print docs["address"]
-            process_corrupt_data(db, collection_name, doc_id,docs["address"] )
-
-            db[collection_name].update_one( {
-                                                "_id" : doc_id
-                                            },
-                                            {
-                                                "$unset" :
-                                                    {
-                                                        "address" : ""
-                                                    }
-                                            }
-                                           )
-        #print db[collection_name].find( {"_id" : doc_id} )[0]
+            quality_events.record(quality_events.NO_VALID_ADDRESS, document_id = str(doc_id), address = docs["address"])
+            process_corrupt_data(batch, doc_id, docs["address"], "address")
 
+    batch.close()
+    profiler.finish()
+    metrics.finish()
+    metrics.report()
     db_server_handle.close()
 
 
 # Just for organizational purpose, calls the other cleaning functions
-def clean_osm_data(db_name, collection_name):
-    clean_phone_numbers(db_name, collection_name)
-    clean_address_info(db_name, collection_name)
+def clean_osm_data(db_name, collection_name, batch_size = CLEANING_BATCH_SIZE):
+    clean_phone_numbers(db_name, collection_name, batch_size)
+    clean_address_info(db_name, collection_name, batch_size)
+
 
+# A function that turns the result of a $group stage into a list of (value, count) pairs
+def group_counts(groups):
+    return [(group["_id"], group["count"]) for group in groups]
 
-# Map statistics used in the project's report
+
+# The sections of the statistics, as the sub-pipelines of one $facet stage: every section is computed from the same
+# single scan of the collection, instead of one scan per section.
+def map_stats_facets():
+    # That's the example in the sample project, but it was really what I needed.
+    return {
+        "users" : [ {"$group" : {"_id" : "$created.user", "count" : {"$sum" : 1} } },
+                    {"$sort" : {"count" : -1 } } ],
+
+        "amenities" : [ { "$match" : {"is_amenity": True} },
+                        { "$group" : {"_id" : "$info.amenity" , "count" : {"$sum" : 1} } },
+                        { "$sort" : {"count" : -1}} ],
+
+        "cuisines" : [ {"$match" : {"info.amenity" : { "$in" : ["restaurant" , "fast_food"] } } },
+                       {"$group" : {"_id" : "$info.cuisine", "count" : {"$sum" : 1} }},
+                       {"$sort" : { "count" : -1 }} ],
+
+        "top_cafes" : [ {"$match" : {"info.amenity" : "cafe" } },
+                        {"$group" : {"_id" : "$info.name", "count" : {"$sum" : 1} }},
+                        {"$sort" : { "count" : -1 }},
+                        {"$limit" : 3} ],
+
+        "top_fast_food_chains" : [ {"$match" : {"info.amenity" : "fast_food" } },
+                                   {"$group" : {"_id" : "$info.name", "count" : {"$sum" : 1} }},
+                                   {"$sort" : { "count" : -1 }},
+                                   {"$limit" : 3} ],
+
+        "denominations" : [ {"$match" : {"info.amenity" : "place_of_worship" } },
+                            {"$group" : {"_id" : "$info.denomination", "count" : {"$sum" : 1} }},
+                            {"$sort" : { "count" : -1 }} ]
+    }
+
+
+# Map statistics used in the project's report. They are computed by one aggregation with a $facet stage, so the
+# collection is scanned once, and returned as a dictionary:
+#   - "contributors": the number of unique users, and "users_contributing_once": the number of them with one element
+#   - "users", "amenities", "cuisines", "top_cafes", "top_fast_food_chains", "denominations": lists of (value, count)
+#     pairs, by decreasing count
+# The users contributing once are taken from the user frequencies, instead of grouping the users a second time.
 def map_stats(db_name, collection_name):
     db_server_handle = connect_to_local_db()
     db = open_db(db_server_handle, db_name)
 
-    # That's the example in the sample project, but it was really what I needed.
-    # These queries are very similar to the point that I was tempted to make a function for them. But I preferred to
-    # write the quesries manually as a way of exercising, to memorize them.
-    users_frequency = db[collection_name].aggregate( [
-                                                      {"$group" : {"_id" : "$created.user", "count" : {"$sum" : 1} } },
-                                                      {"$sort" : {"count" : -1 } }
-                                                      ] )
-
-    users_contributing_once = db[collection_name].aggregate( [
-                                                      {"$group" : {"_id" : "$created.user", "count" : {"$sum" : 1} } },
-                                                      {"$match" : {"count" : 1} }
-                                                      ] )
-
-    print len(list(users_contributing_once))
-    # For some reason when I use the command list(users_frequency), the second time I use it it returns an empty list. Not
-    # sure what is going on. To overcome this, I will hold the result in a variable and use that variable
-    users_freq_list =  list(users_frequency)
-    number_of_unique_users = len(list(users_freq_list))
-    print "Number of contributors:", number_of_unique_users
-
-    amenity_type_frequency = db[collection_name].aggregate( [
-                                                              { "$match" : {"is_amenity": True} },
-                                                              { "$group" : {"_id" : "$info.amenity" , "count" : {"$sum" : 1} } },
-                                                              { "$sort" : {"count" : -1}}
-                                                            ])
-    cuisine_type_frequency = db[collection_name].aggregate([ {"$match" : {"info.amenity" : { "$in" : ["restaurant" , "fast_food"] } } },
-                                                             {"$group" : {"_id" : "$info.cuisine", "count" : {"$sum" : 1} }},
-                                                             {"$sort" : { "count" : -1 }}
-    ])
-
-
-    top_3_cafes_chains =  db[collection_name].aggregate([ {"$match" : {"info.amenity" : "cafe" } },
-                                                             {"$group" : {"_id" : "$info.name", "count" : {"$sum" : 1} }},
-                                                             {"$sort" : { "count" : -1 }},
-                                                             {"$limit" : 3}
-                                                          ])
-
-    print "Top Cafes: ", list(top_3_cafes_chains)
-
-    top_3_fast_food_chains =  db[collection_name].aggregate([ {"$match" : {"info.amenity" : "fast_food" } },
-                                                             {"$group" : {"_id" : "$info.name", "count" : {"$sum" : 1} }},
-                                                             {"$sort" : { "count" : -1 }},
-                                                             {"$limit" : 3}
-                                                          ])
-
-    print "Top Fast Food Chains: ", list(top_3_fast_food_chains)
-
-    denomination_frequency = db[collection_name].aggregate([ {"$match" : {"info.amenity" : "place_of_worship" } },
-                                                             {"$group" : {"_id" : "$info.denomination", "count" : {"$sum" : 1} }},
-                                                             {"$sort" : { "count" : -1 }}
-    ])
-
-
-
-    # I think the following solution "might" be more efficient sinceit loops over the data once. Is that a sound reasoning?
-    """
-    cursor = db[collection_name].find( {"is_amenity": True} )
-
-    for docs in cursor:
-        doc_id = docs["_id"]
+    metrics = pipeline_metrics.stage("Statistics", "queries")
+    timer = metrics.start_timer()
+    facets, = list(db[collection_name].aggregate([ {"$facet" : map_stats_facets()} ]))
+    metrics.stop_timer("query", timer)
+    metrics.items += 1
+    metrics.finish()
+    metrics.report()
+    db_server_handle.close()
 
-        if docs["info"]["amenity"] in amenity_type_frequency:
-            amenity_type_frequency[docs["info"]["amenity"]] += 1
-        else:
-            amenity_type_frequency[docs["info"]["amenity"]] = 1
-
-        # Survey the food industry
-        if docs["info"]["amenity"] in ["restaurant", "fast_food"]:
-            if "cuisine" in docs["info"]:
-                if docs["info"]["cuisine"] in cuisine_type_frequency:
-                    cuisine_type_frequency[docs["info"]["cuisine"]] += 1
-                else:
-                    cuisine_type_frequency[docs["info"]["cuisine"]] = 1
-
-        # Survey the places of worship
-        if docs["info"]["amenity"] == "place_of_worship":
-            if "denomination" in docs["info"]:
-                if docs["info"]["denomination"] in denomination_frequency:
-                    denomination_frequency[docs["info"]["denomination"]] += 1
-                else:
-                    denomination_frequency[docs["info"]["denomination"]] = 1
-    """
-    print "Users: ", users_freq_list
-    print "Amenities: ", list(amenity_type_frequency)
-    print "Cuisines:" , list(cuisine_type_frequency)
-    print "Denominations: ", list(denomination_frequency)
-
-
-
-# There is two files I used for development, a small file (About 15 MB that contained downtown Montreal), and another
-# file that had the whole greater Montreal. test_config controls which one to use
-test_config = True
-
-if test_config:
-    active_db = "my_test"
-    active_collection = "test_collection_1"
-	#Update path please to use the map file included in the submission zip
-    active_map = ".\\map"
-else:
-    active_db = "montreal_osm"
-    active_collection = "all_data"
-    active_map = ".\\greater_montreal.osm"
-
-
-# Insert the XML data to database, clean the database data and then diplay statistics
-insert_xml_map_to_db(active_map, active_db, active_collection, True)
-clean_osm_data(active_db, active_collection)
-map_stats(active_db, active_collection)
+    stats = dict((section, group_counts(groups)) for section, groups in facets.iteritems())
+    stats["contributors"] = len(stats["users"])
+    stats["users_contributing_once"] = len([user for user, count in stats["users"] if count == 1])
+    return stats
+
+
+# Prints the statistics returned by map_stats()
+def print_map_stats(stats):
+    print "Number of contributors:", stats["contributors"]
+    print "Contributors with a single element:", stats["users_contributing_once"]
+    print "Top Cafes: ", stats["top_cafes"]
+    print "Top Fast Food Chains: ", stats["top_fast_food_chains"]
+    print "Users: ", stats["users"]
+    print "Amenities: ", stats["amenities"]
+    print "Cuisines:" , stats["cuisines"]
+    print "Denominations: ", stats["denominations"]
+
+
+
+# The pipeline only runs when the script is executed, not when it is imported. This is needed by the parallel parse, as
+# the worker processes import this module to get shape_element()
+if __name__ == "__main__":
+    # The run is set with the options of the command line (see osm_cli.py): python Montreal_data_processing.py MAP is
+    # the same as python osm_cli.py ingest MAP
+    import osm_cli
+    osm_cli.main(["ingest"] + sys.argv[1:])
@@ -13,6 +13,7 @@ import xml.etree.cElementTree as ET
 from collections import defaultdict
 import re
 import pprint
+from compressed_input import open_map
 
 OSMFILE = "example.osm"
 street_type_re = re.compile(r'\b\S+\.?$', re.IGNORECASE)
@@ -35,8 +36,6 @@ def audit_street_type(street_types, street_name):
         street_type = m.group()
         if street_type not in expected:
             street_types[street_type].add(street_name)
-            
-    print street_type
 
 
 def is_street_name(elem):
@@ -44,7 +43,7 @@ def is_street_name(elem):
 
 
 def audit(osmfile):
-    osm_file = open(osmfile, "r")
+    osm_file = open_map(osmfile)
     street_types = defaultdict(set)
     for event, elem in ET.iterparse(osm_file, events=("start",)):
 
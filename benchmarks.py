@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+
+# The benchmark suite of the pipeline, run on a synthetic Montreal-like map (see synthetic_map.py):
+#   - shape_element(), timed alone while the map is parsed
+#   - the street name, phone number and postal code normalizers, on the values found in the map, without the
+#     normalization caches
+#   - the whole ingest with the cleaning, into the embedded SQLite store (see storage_backend.py), so no server is needed
+#   - map_stats() on the loaded data
+# The throughput of every benchmark is appended to a JSONL file (one line per run, with the commit and the machine), and
+# compared with the last run on a map of the same size, so the regressions are visible from one run to the next.
+
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import Montreal_data_processing as processing
+import osm_reader
+import pipeline_metrics
+import storage_backend
+import synthetic_map
+
+
+BENCHMARK_RESULTS_FILE = "benchmark_results.jsonl"
+DEFAULT_NODE_COUNT = 200000
+
+# A benchmark slower than the previous run by more than this is reported as a regression
+REGRESSION_THRESHOLD = 0.10
+
+
+# The best time of repeat calls of function, and its result
+def best_time(function, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        result = function()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def benchmark_result(seconds, items):
+    return {"seconds" : seconds, "items" : items, "items_per_second" : items / max(seconds, 1e-9)}
+
+
+# The time of shape_element() alone: the parsing is timed apart (see pipeline_metrics.py)
+def benchmark_shape(filename, repeat):
+    best = None
+    for _ in range(repeat):
+        metrics = pipeline_metrics.StageMetrics("shape_element")
+        shape_function = metrics.timed("shape", processing.shape_element)
+        items = 0
+        for element in osm_reader.iterate_elements(filename):
+            shape_function(element)
+            items += 1
+        if best is None or metrics.phases["shape"] < best:
+            best = metrics.phases["shape"]
+    return benchmark_result(best, items)
+
+
+# The street names, phone numbers and postal codes of the map, as shaped
+def normalizer_inputs(filename):
+    streets, phones, postcodes = [], [], []
+    for element in osm_reader.iterate_elements(filename):
+        document = processing.shape_element(element)
+        if not document:
+            continue
+        address = document.get("address", {})
+        if address.get("street"):
+            streets.append(address["street"].title())
+        if "postcode" in address:
+            postcodes.append(address["postcode"])
+        if "phone" in document.get("info", {}):
+            phones.append(document["info"]["phone"])
+    return streets, phones, postcodes
+
+
+def benchmark_normalizer(function, values, repeat):
+    seconds, _ = best_time(lambda: [function(value) for value in values], repeat)
+    return benchmark_result(seconds, len(values))
+
+
+# Loads the map into an SQLite store in directory, with the cleaning, and returns the result with the time of the
+# phases of the load
+def benchmark_ingest(filename, directory):
+    previous_run = pipeline_metrics.run
+    metrics = pipeline_metrics.configure()
+    try:
+        processing.insert_xml_map_to_db(filename, "benchmark", "elements", True, clean_on_ingest = True)
+    finally:
+        pipeline_metrics.run = previous_run
+
+    summary = metrics.stages[0].summary()
+    result = benchmark_result(summary["seconds"], summary["items"])
+    result["phases"] = summary["phases"]
+    result["peak_rss_mb"] = summary["peak_rss_mb"]
+    return result
+
+
+def benchmark_map_stats(repeat):
+    seconds, stats = best_time(lambda: processing.map_stats("benchmark", "elements"), repeat)
+    return benchmark_result(seconds, sum(count for user, count in stats["users"]))
+
+
+# The commit of the working tree, if it is a git repository
+def current_commit():
+    try:
+        with open(os.devnull, "w") as null:
+            return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr = null,
+                                           cwd = os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# The runs recorded in the results file
+def load_results(results_file):
+    if not os.path.exists(results_file):
+        return []
+    with open(results_file) as results:
+        return [json.loads(line) for line in results if line.strip()]
+
+
+# Compares the throughput of every benchmark with a previous run. Returns (name, previous rate, rate, change) tuples,
+# the change being relative (-0.2 is 20% slower).
+def compare_runs(previous, current):
+    changes = []
+    for name in sorted(current["results"]):
+        if name not in previous["results"]:
+            continue
+        previous_rate = previous["results"][name]["items_per_second"]
+        rate = current["results"][name]["items_per_second"]
+        changes.append((name, previous_rate, rate, rate / previous_rate - 1.0))
+    return changes
+
+
+def print_run(run, previous = None, threshold = REGRESSION_THRESHOLD):
+    print "Benchmarks on %d nodes, commit %s:" % (run["node_count"], run["commit"])
+    changes = dict((name, (rate, change)) for name, previous_rate, rate, change in
+                   (compare_runs(previous, run) if previous else []))
+    for name in sorted(run["results"]):
+        result = run["results"][name]
+        line = "  %-22s %8.3f s %12.0f items/s" % (name, result["seconds"], result["items_per_second"])
+        if name in changes:
+            change = changes[name][1]
+            line += "  %+6.1f%% vs %s" % (100.0 * change, previous["commit"])
+            if change < -threshold:
+                line += "  REGRESSION"
+        print line
+
+
+# Runs all the benchmarks on a synthetic map of node_count nodes, appends the results to results_file, and prints them
+# next to the ones of the last run on a map of the same size. Returns the run.
+def run_benchmarks(node_count = DEFAULT_NODE_COUNT, repeat = 3, results_file = BENCHMARK_RESULTS_FILE):
+    directory = tempfile.mkdtemp()
+    previous_backend = storage_backend.active_backend
+    try:
+        filename = os.path.join(directory, "synthetic.osm")
+        synthetic_map.write_synthetic_map(filename, node_count)
+
+        results = {}
+        results["shape_element"] = benchmark_shape(filename, repeat)
+
+        streets, phones, postcodes = normalizer_inputs(filename)
+        results["street_normalizer"] = benchmark_normalizer(processing.street_normalizer.normalize, streets, repeat)
+        results["phone_normalizer"] = benchmark_normalizer(processing.standardize_phone_number, phones, repeat)
+        results["postcode_normalizer"] = benchmark_normalizer(processing.standardize_postal_code, postcodes, repeat)
+
+        storage_backend.select_backend("sqlite", directory = os.path.join(directory, "db"))
+        results["ingest"] = benchmark_ingest(filename, directory)
+        results["map_stats"] = benchmark_map_stats(repeat)
+    finally:
+        storage_backend.select_backend(previous_backend.name, **vars(previous_backend))
+        shutil.rmtree(directory)
+
+    run = {"time" : time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), "commit" : current_commit(),
+           "python" : platform.python_version(), "machine" : platform.node(), "node_count" : node_count,
+           "repeat" : repeat, "results" : results}
+
+    previous_runs = [previous for previous in load_results(results_file) if previous["node_count"] == node_count]
+    print_run(run, previous_runs[-1] if previous_runs else None)
+
+    with open(results_file, "a") as results:
+        results.write(json.dumps(run, sort_keys = True) + "\n")
+    return run
+
+
+def test():
+    directory = tempfile.mkdtemp()
+    try:
+        results_file = os.path.join(directory, "results.jsonl")
+        first = run_benchmarks(3000, 1, results_file)
+        second = run_benchmarks(3000, 1, results_file)
+        assert len(load_results(results_file)) == 2
+
+        assert set(first["results"]) == set(["shape_element", "street_normalizer", "phone_normalizer",
+                                             "postcode_normalizer", "ingest", "map_stats"])
+        assert first["results"]["shape_element"]["items"] > 3000
+        assert first["results"]["ingest"]["items"] == second["results"]["ingest"]["items"]
+        assert [name for name, _, _, _ in compare_runs(first, second)] == sorted(first["results"])
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        run_benchmarks(int(sys.argv[1]))
+    else:
+        test()
@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+
+# Reading of compressed map files (.osm.bz2, as the extracts are distributed, or .osm.gz) as a stream, without
+# decompressing them to the disk first. map_source() gives what to pass to ET.iterparse() (or osm_reader) for a map file:
+# the file name itself for an uncompressed file, or a file object yielding the decompressed data for a compressed one.
+# The compression is found from the first bytes of the file, not from its name.
+#
+# The decompression never runs in the parsing process, so the parser does not wait for it:
+#   - a bzip2 file made of several streams (as written by pbzip2 or lbzip2, like the planet files) is split at the start
+#     of its streams into segments of about SEGMENT_SIZE bytes, which a pool of processes decompresses in parallel.
+#     A few segments are decompressed ahead of the parser, so the memory used stays bounded.
+#   - any other file (a single bzip2 stream, gzip) is decompressed by one separate process, which sends the decompressed
+#     blocks through a bounded queue, so it runs at the same time as the parsing.
+# Python 2's bz2.BZ2File stops at the end of the first stream of a file, so the streams (and the gzip members) are
+# chained here instead.
+
+import bz2
+import multiprocessing
+import re
+import zlib
+from collections import deque
+
+
+# The first bytes of the compressed files
+MAGIC_NUMBERS = [(b"BZh", "bz2"), (b"\x1f\x8b", "gzip")]
+
+# The start of a bzip2 stream: the header with the block size, then the magic number of the first block. The blocks
+# inside a stream are not aligned on bytes, so these bytes are only found at the start of the streams.
+bz2_stream_start = re.compile(b"BZh[1-9]1AY&SY")
+
+# How many compressed bytes are decompressed at a time by a process of the pool
+SEGMENT_SIZE = 1024 * 1024
+
+# How many compressed bytes are read at a time
+READ_SIZE = 1024 * 1024
+
+# How many decompressed blocks the separate process can send ahead of the parser
+QUEUE_SIZE = 8
+
+# Used by the decompression process to tell that the file is finished
+END = None
+
+
+# The compression of a file ("bz2" or "gzip"), or None if it is not compressed
+def compression(filename):
+    with open(filename, "rb") as input_file:
+        start = input_file.read(3)
+    for magic_number, name in MAGIC_NUMBERS:
+        if start.startswith(magic_number):
+            return name
+    return None
+
+
+def new_decompressor(compression_name):
+    if compression_name == "bz2":
+        return bz2.BZ2Decompressor()
+    # 16 + MAX_WBITS: the gzip header and trailer are expected
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+# A generator that decompresses the compressed blocks passed, and yields the decompressed ones. When a stream (or a
+# gzip member) ends, the data after it is decompressed as a new one.
+def decompress_blocks(compressed_blocks, compression_name):
+    decompressor = new_decompressor(compression_name)
+    for data in compressed_blocks:
+        while data:
+            try:
+                output = decompressor.decompress(data)
+            except EOFError:
+                # The previous bzip2 stream ended exactly at the end of the previous block
+                decompressor = new_decompressor(compression_name)
+                continue
+
+            if output:
+                yield output
+            data = decompressor.unused_data
+            if data:
+                decompressor = new_decompressor(compression_name)
+
+
+def read_blocks(filename, start = 0, end = None):
+    with open(filename, "rb") as input_file:
+        input_file.seek(start)
+        position = start
+        while end is None or position < end:
+            size = READ_SIZE if end is None else min(READ_SIZE, end - position)
+            block = input_file.read(size)
+            if not block:
+                break
+            position += len(block)
+            yield block
+
+
+# The offsets of the streams of a bzip2 file
+def bz2_stream_starts(filename):
+    starts = []
+    with open(filename, "rb") as input_file:
+        position = 0
+        while True:
+            # Read a bit more than a block, so that a stream start split between two blocks is still found
+            input_file.seek(position)
+            block = input_file.read(READ_SIZE + 16)
+            if not block:
+                break
+            starts.extend(position + match.start() for match in bz2_stream_start.finditer(block)
+                          if match.start() < READ_SIZE)
+            position += READ_SIZE
+    return starts
+
+
+# Splits a bzip2 file into byte ranges of about segment_size bytes, each one starting at the start of a stream
+def bz2_segments(filename, segment_size = SEGMENT_SIZE):
+    starts = bz2_stream_starts(filename)
+    with open(filename, "rb") as input_file:
+        input_file.seek(0, 2)
+        end = input_file.tell()
+
+    boundaries = [0]
+    for start in starts:
+        if start - boundaries[-1] >= segment_size:
+            boundaries.append(start)
+    boundaries.append(end)
+    return [(boundaries[i], boundaries[i + 1]) for i in range(len(boundaries) - 1)]
+
+
+# The work done by every process of the pool: decompress one segment of a multi-stream bzip2 file
+def decompress_segment(arguments):
+    filename, start, end = arguments
+    return b"".join(decompress_blocks(read_blocks(filename, start, end), "bz2"))
+
+
+# The work done by the separate decompression process: decompress the whole file, and send the blocks to the parser.
+# An error is sent to the parser too, so that it is raised there.
+def decompress_to_queue(filename, compression_name, queue):
+    try:
+        for block in decompress_blocks(read_blocks(filename), compression_name):
+            queue.put(block)
+    except Exception, e:
+        queue.put(IOError("Could not decompress %s: %s" % (filename, e)))
+    queue.put(END)
+
+
+# The decompressed blocks of a file decompressed by a separate process
+def queued_blocks(filename, compression_name):
+    queue = multiprocessing.Queue(QUEUE_SIZE)
+    process = multiprocessing.Process(target = decompress_to_queue, args = (filename, compression_name, queue))
+    process.daemon = True
+    process.start()
+    try:
+        while True:
+            block = queue.get()
+            if block is END:
+                break
+            if isinstance(block, Exception):
+                raise block
+            yield block
+        process.join()
+    finally:
+        if process.is_alive():
+            process.terminate()
+
+
+# The decompressed segments of a multi-stream bzip2 file, decompressed by a pool of processes, in order. At most
+# 2 segments per process are decompressed ahead of the parser.
+def parallel_blocks(filename, segments, processes):
+    pool = multiprocessing.Pool(processes)
+    try:
+        segments = iter(segments)
+        pending = deque()
+        for start, end in segments:
+            pending.append(pool.apply_async(decompress_segment, ((filename, start, end), )))
+            if len(pending) == 2 * processes:
+                break
+
+        while pending:
+            block = pending.popleft().get()
+            for start, end in segments:
+                pending.append(pool.apply_async(decompress_segment, ((filename, start, end), )))
+                break
+            yield block
+
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+# A read-only file object over an iterator of decompressed blocks
+class DecompressedStream(object):
+    def __init__(self, blocks):
+        self.blocks = blocks
+        self.block = b""
+        self.offset = 0
+
+    def read(self, size = -1):
+        if size < 0:
+            data = self.block[self.offset:] + b"".join(self.blocks)
+            self.block = b""
+            self.offset = 0
+            return data
+
+        while self.offset >= len(self.block):
+            self.block = next(self.blocks, None)
+            self.offset = 0
+            if self.block is None:
+                self.block = b""
+                return b""
+
+        data = self.block[self.offset:self.offset + size]
+        self.offset += len(data)
+        return data
+
+    # Stops the decompression processes
+    def close(self):
+        self.blocks.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+
+# Opens a compressed file as a stream of decompressed data. A multi-stream bzip2 file is decompressed by a pool of
+# processes (all the cores of the machine by default), any other file by one separate process.
+def open_compressed(filename, processes = None):
+    compression_name = compression(filename)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    if compression_name == "bz2" and processes > 1:
+        segments = bz2_segments(filename)
+        if len(segments) > 1:
+            return DecompressedStream(parallel_blocks(filename, segments, processes))
+
+    return DecompressedStream(queued_blocks(filename, compression_name))
+
+
+# Opens a map file, compressed or not, as a file object
+def open_map(filename, processes = None):
+    if compression(filename):
+        return open_compressed(filename, processes)
+    return open(filename, "rb")
+
+
+# What to pass to ET.iterparse() to read a map file: the file name for an uncompressed file, and a stream of the
+# decompressed data for a compressed one. Anything that is not a file name (a file object) is returned as it is.
+def map_source(source, processes = None):
+    if isinstance(source, basestring) and compression(source):
+        return open_compressed(source, processes)
+    return source
+
+
+def test():
+    import gzip
+    import os
+    import shutil
+    import tempfile
+
+    import osm_reader
+
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, "map.osm")
+        osm_reader.write_test_file(filename, 20000)
+        with open(filename, "rb") as map_file:
+            data = map_file.read()
+        expected = [(element.tag, element.attrib["id"], len(element)) for element in osm_reader.iterate_elements(filename)]
+
+        # One bzip2 stream, several bzip2 streams (like pbzip2), and gzip with two members
+        pieces = [data[start:start + 300000] for start in range(0, len(data), 300000)]
+        with open(filename + ".bz2", "wb") as compressed_file:
+            compressed_file.write(bz2.compress(data))
+        with open(filename + ".multi.bz2", "wb") as compressed_file:
+            for piece in pieces:
+                compressed_file.write(bz2.compress(piece))
+        for piece in (data[:len(data) / 2], data[len(data) / 2:]):
+            with gzip.open(filename + ".gz", "ab") as compressed_file:
+                compressed_file.write(piece)
+
+        assert compression(filename) is None
+        assert map_source(filename) == filename
+        assert compression(filename + ".gz") == "gzip"
+        with open_map(filename + ".gz") as stream:
+            assert stream.read() == data
+        assert len(bz2_segments(filename + ".bz2", 4096)) == 1
+        assert len(bz2_segments(filename + ".multi.bz2", 4096)) == len(pieces)
+
+        for name, processes in [(".bz2", 2), (".multi.bz2", 1), (".gz", 2)]:
+            with map_source(filename + name, processes) as stream:
+                assert stream.read() == data
+            source = map_source(filename + name, processes)
+            assert [(element.tag, element.attrib["id"], len(element))
+                    for element in osm_reader.iterate_elements(source)] == expected
+
+        # Decompressed by the pool, with a segment per stream
+        source = DecompressedStream(parallel_blocks(filename + ".multi.bz2",
+                                                    bz2_segments(filename + ".multi.bz2", 4096), 2))
+        assert [(element.tag, element.attrib["id"], len(element))
+                for element in osm_reader.iterate_elements(source)] == expected
+        # Stopping before the end stops the processes
+        source = map_source(filename + ".multi.bz2", 2)
+        source.read(1000)
+        source.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    test()
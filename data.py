@@ -1,10 +1,10 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-import xml.etree.cElementTree as ET
-import pprint
 import re
 import codecs
 import json
+import osm_reader
+import parallel_parse
 """
 Your task is to wrangle the data and transform the shape of the data
 into the model we mentioned earlier. The output should be a list of dictionaries
@@ -93,6 +93,13 @@ problemchars = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
 
 CREATED = [ "version", "changeset", "timestamp", "user", "uid"]
 
+# The version of the shaping rules of this file, used to invalidate its parse cache (see parse_cache.py) when they
+# change. Increase SHAPE_VERSION when shape_element() itself changes.
+SHAPE_VERSION = 1
+
+def shape_rules_version():
+    return json.dumps([SHAPE_VERSION, CREATED, lower.pattern, lower_colon.pattern, problemchars.pattern])
+
 
 def shape_element(element):
     node = {}
@@ -152,20 +159,31 @@ def shape_element(element):
                             node["address"] = {}
                             node["address"][ address_elements[1] ] = sub_elem.attrib["v"]
 
-        pprint.pprint(node)
-        
         return node
     else:
         return None
 
 
-def process_map(file_in, pretty = False):
+def process_map(file_in, pretty = False, parallel = False, processes = None, use_parse_cache = False):
     # You do not need to change this file
     file_out = "{0}.json".format(file_in)
     data = []
+
+    # With parallel, the file is split between a pool of processes (see parallel_parse.py). The order of the elements
+    # is the same.
+    # With use_parse_cache, the shaped elements are read from a binary cache of the file (see parse_cache.py), kept
+    # apart from the one of Montreal_data_processing.py. With parallel too, the cache is built by the parallel parse.
+    if use_parse_cache:
+        import parse_cache
+        shaped_elements = parse_cache.cached_shaped_elements(file_in, shape_element, shape_rules_version(),
+                                                             name = "data", parallel = parallel, processes = processes)
+    elif parallel:
+        shaped_elements = parallel_parse.parallel_shape(file_in, shape_element, processes)
+    else:
+        shaped_elements = (shape_element(element) for element in osm_reader.iterate_elements(file_in))
+
     with codecs.open(file_out, "w") as fo:
-        for _, element in ET.iterparse(file_in):
-            el = shape_element(element)
+        for el in shaped_elements:
             if el:
                 data.append(el)
                 if pretty:
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+# A compact record for a shaped element, used instead of the nested dictionaries built by shape_element() while the
+# element is on its way to the database. It is converted to the usual dictionary only when it is inserted. The record
+# is a builder of Montreal_data_processing.shape_into(), so it follows the same shaping rules as shape_element().
+#   - the record uses __slots__, so it has no per-instance dictionary
+#   - the sub-dictionaries (created, address, info) are kept as lists of (key, value) pairs
+#   - the strings repeated across millions of elements (the keys, the user names and ids, the amenity types...) are
+#     interned, so every one of them exists only once in memory
+
+import sys
+import time
+
+
+# The interned strings. The intern() builtin only accepts byte strings, and the parser returns unicode for the values
+# that are not ASCII, so a dictionary is used instead
+interned_strings = {}
+
+def intern_string(value):
+    return interned_strings.setdefault(value, value)
+
+
+# The keys of the "info" values that are categories (a handful of distinct values) and are worth interning
+CATEGORY_KEYS = frozenset(["amenity", "cuisine", "denomination", "religion", "wheelchair"])
+
+
+class ElementRecord(object):
+    __slots__ = ("type", "attributes", "created", "pos", "is_amenity", "node_refs", "address", "info")
+
+    def __init__(self, element_type):
+        self.type = intern_string(element_type)
+        self.attributes = []
+        self.created = []
+        self.pos = None
+        self.is_amenity = False
+        self.node_refs = None
+        self.address = None
+        self.info = None
+
+    # The add_...() methods are called for every attribute and tag of the map, so they call interned_strings.setdefault()
+    # directly rather than intern_string()
+    def add_created(self, key, value):
+        # The user names and ids repeat a lot, the versions, changesets and timestamps much less
+        if key == "user" or key == "uid":
+            value = interned_strings.setdefault(value, value)
+        self.created.append((interned_strings.setdefault(key, key), value))
+
+    def add_attribute(self, key, value):
+        self.attributes.append((interned_strings.setdefault(key, key), value))
+
+    def set_position(self, position):
+        self.pos = position
+
+    def set_amenity(self):
+        self.is_amenity = True
+
+    def add_node_ref(self, ref):
+        if self.node_refs is None:
+            self.node_refs = []
+        self.node_refs.append(ref)
+
+    def add_address(self, key, value):
+        if self.address is None:
+            self.address = []
+        self.address.append((interned_strings.setdefault(key, key), value))
+
+    def add_info(self, key, value):
+        if key in CATEGORY_KEYS:
+            value = interned_strings.setdefault(value, value)
+        if self.info is None:
+            self.info = []
+        self.info.append((interned_strings.setdefault(key, key), value))
+
+    def result(self):
+        return self
+
+    # Converts the record to the dictionary shape_element() would have returned for the same element
+    def to_document(self):
+        document = dict(self.attributes)
+        document["created"] = dict(self.created)
+        document["type"] = self.type
+        document["is_amenity"] = self.is_amenity
+
+        # The record is not used after the conversion, so its lists are handed over without a copy
+        if self.pos is not None:
+            document["pos"] = self.pos
+        if self.node_refs is not None:
+            document["node_refs"] = self.node_refs
+        if self.address is not None:
+            document["address"] = dict(self.address)
+        if self.info is not None:
+            document["info"] = dict(self.info)
+
+        return document
+
+
+# The memory taken by a list of objects, counting every object reachable from them only once (so an interned string
+# shared by many elements is counted once, like in the real memory)
+def deep_size(objects):
+    seen = set()
+    size = 0
+    pending = [objects]
+
+    while pending:
+        value = pending.pop()
+        if id(value) in seen:
+            continue
+        seen.add(id(value))
+        size += sys.getsizeof(value)
+
+        if isinstance(value, dict):
+            pending.extend(value.keys())
+            pending.extend(value.values())
+        elif isinstance(value, (list, tuple)):
+            pending.extend(value)
+        elif isinstance(value, ElementRecord):
+            pending.extend(getattr(value, name) for name in ElementRecord.__slots__)
+
+    return size
+
+
+# Compares the throughput and the memory of the dictionary path (shape_element) and of the record path
+# (shape_element_record) on a map file. The memory is measured on the first sample_size elements, as they would be held
+# in the insertion buffer.
+def compare(filename, sample_size = 10000):
+    import osm_reader
+    from Montreal_data_processing import shape_element, shape_element_record
+
+    results = {}
+    for label, shape_function in [("dictionaries", shape_element), ("records", shape_element_record)]:
+        sample = []
+        count = 0
+        start = time.time()
+        for element in osm_reader.iterate_elements(filename):
+            shaped_element = shape_function(element)
+            if shaped_element:
+                count += 1
+                if len(sample) < sample_size:
+                    sample.append(shaped_element)
+        elapsed = time.time() - start
+
+        results[label] = {"elements_per_second" : count / elapsed,
+                          "bytes_per_element" : deep_size(sample) / len(sample)}
+        print "%s: %.0f elements per second, %d bytes per element" % (label, results[label]["elements_per_second"],
+                                                                      results[label]["bytes_per_element"])
+    return results
+
+
+def test():
+    import os
+    import shutil
+    import tempfile
+
+    from Montreal_data_processing import shape_element, shape_element_record
+    import synthetic_map
+    import osm_reader
+
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, "test.osm")
+        synthetic_map.write_synthetic_map(filename, 2000)
+
+        for element in osm_reader.iterate_elements(filename):
+            shaped_element = shape_element(element)
+            record = shape_element_record(element)
+            if shaped_element is None:
+                assert record is None
+            else:
+                assert record.to_document() == shaped_element
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        compare(sys.argv[1])
+    else:
+        test()
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+
+# The indexes of the queries run by the cleaning stages and by the build of the spatial index of the amenities, built
+# once the data is loaded: building an index over the loaded data is much faster than updating it on every insert.
+# Once built, the query plan of every one of these queries is checked with explain(), and build_indexes() fails with a
+# CollectionScanError if one of them scans the whole collection, so an index that stops being used (a changed query, a
+# renamed field...) is noticed right away.
+#
+# MongoDB only considers an index for a query that filters or sorts on its first key. The address cleanup reads every
+# document having an address, and indexing the whole address subdocument would copy all the addresses into the index.
+# So its index is a partial index on the _id, and the cleanup reads the documents sorted by _id.
+#
+# The statistics (see map_stats()) have no index, as they are a deliberate scan: they are computed in one $facet
+# aggregation, whose sections can not use an index, and the users section counts every element, so no leading $match
+# can narrow the collection read.
+#
+# MongoDB's 2dsphere indexes need the coordinates in [longitude, latitude] order (or as GeoJSON), while "pos" is
+# [latitude, longitude]. So the points are copied to a GeoJSON "location" field, which is the one indexed. With the
+# typed schema (see typed_schema.py), "pos" is already a GeoJSON point, and is indexed directly.
+
+from collections import OrderedDict
+
+import storage_backend
+
+
+# The indexes, by name: the keys, and the partial filter (the documents indexed), if any
+QUERY_INDEXES = OrderedDict([
+    # clean_phone_numbers()
+    ("phone", ([("info.phone", 1)], {"info.phone" : {"$exists" : True}})),
+    # clean_address_info()
+    ("address", ([("_id", 1)], {"address" : {"$exists" : True}})),
+    # build_spatial_index()
+    ("amenity_flag", ([("is_amenity", 1), ("info.amenity", 1)], {"is_amenity" : True})),
+    # The spatial queries run on the database (not checked, as they are not run by the pipeline)
+    ("location", ([("location", "2dsphere")], None))
+])
+
+# The index of the spatial queries with the typed schema
+TYPED_LOCATION_INDEX = ([("pos", "2dsphere")], None)
+
+# The filter and the sort of the find() calls that must use an index, by name
+CHECKED_QUERIES = OrderedDict([
+    ("phone cleanup", ({"info.phone" : {"$exists" : True}}, None)),
+    ("address cleanup", ({"address" : {"$exists" : True}}, [("_id", 1)])),
+    ("amenity spatial index", ({"is_amenity" : True}, None))
+])
+
+
+class CollectionScanError(Exception):
+    pass
+
+
+# Copies "pos" ([lat, lon]) to "location", as a GeoJSON point ([lon, lat]), on the server. It needs MongoDB 4.2 or more
+# (updates with an aggregation pipeline).
+def add_locations(collection):
+    result = collection.update_many({"pos" : {"$exists" : True}, "location" : {"$exists" : False}},
+                                    [{"$set" : {"location" : {"type" : "Point",
+                                                              "coordinates" : [{"$arrayElemAt" : ["$pos", 1]},
+                                                                               {"$arrayElemAt" : ["$pos", 0]}]}}}])
+    print "Locations added to %d documents" % result.modified_count
+
+
+# The stages of the query plan of a filter and a sort: the stage names of MongoDB's explain(), or, for the SQLite
+# backend, COLLSCAN or IXSCAN from its query plan. The backend is told by the class of the collection: the pymongo
+# collections answer any attribute name (with a sub-collection), so hasattr() can not tell them apart.
+# MongoDB sorts by _id with the default _id_ index when there is no better one, which reads the whole collection too:
+# that index scan is reported as a COLLSCAN.
+def plan_stages(collection, query, sort = None):
+    if isinstance(collection, storage_backend.SQLiteCollection):
+        stages = []
+        for detail in collection.explain_query(query, sort):
+            if "USING INDEX" in detail or "USING COVERING INDEX" in detail:
+                stages.append("IXSCAN")
+            elif detail.startswith("SCAN"):
+                stages.append("COLLSCAN")
+        return stages
+
+    stages = []
+    pending = [collection.find(query, sort = sort).explain()["queryPlanner"]["winningPlan"]]
+    while pending:
+        value = pending.pop()
+        if isinstance(value, dict):
+            if "stage" in value:
+                if value["stage"] == "IXSCAN" and value.get("indexName") == "_id_":
+                    stages.append("COLLSCAN")
+                else:
+                    stages.append(value["stage"])
+            pending.extend(value.values())
+        elif isinstance(value, list):
+            pending.extend(value)
+    return stages
+
+
+# Checks the plan of every built-in query, and raises a CollectionScanError listing the ones scanning the collection
+def check_query_plans(collection):
+    scans = []
+    for name, (query, sort) in CHECKED_QUERIES.iteritems():
+        stages = plan_stages(collection, query, sort)
+        print "%s: %s" % (name, " > ".join(reversed(stages)))
+        if "COLLSCAN" in stages:
+            scans.append(name)
+
+    if scans:
+        raise CollectionScanError("These queries scan the whole collection: " + ", ".join(scans))
+
+
+# Builds the indexes of the built-in queries on the collection, then checks that all these queries use them. Set typed
+# to true if the collection was loaded with the typed schema.
+def build_indexes(collection, typed = False):
+    if not typed and not isinstance(collection, storage_backend.SQLiteCollection):
+        add_locations(collection)
+
+    for name, (keys, partial_filter) in QUERY_INDEXES.iteritems():
+        if typed and name == "location":
+            keys, partial_filter = TYPED_LOCATION_INDEX
+        options = {"name" : name}
+        if partial_filter is not None:
+            options["partialFilterExpression"] = partial_filter
+        collection.create_index(keys, **options)
+
+    check_query_plans(collection)
+
+
+def test():
+    import shutil
+    import tempfile
+
+    import storage_backend
+
+    directory = tempfile.mkdtemp()
+    try:
+        client = storage_backend.SQLiteBackend(directory).connect()
+        collection = client["test"]["elements"]
+        collection.insert_many([{"type" : "node", "created" : {"user" : "u%d" % (number % 7)}, "is_amenity" : False}
+                                for number in range(5000)])
+        collection.insert_many([
+            {"type" : "node", "is_amenity" : True, "info" : {"amenity" : "cafe", "phone" : ["514 555 1234"]}},
+            {"type" : "node", "is_amenity" : True, "info" : {"amenity" : "fast_food", "name" : "A&W"}},
+            {"type" : "way", "is_amenity" : False, "address" : {"street" : "Rue Sherbrooke"}}
+        ])
+
+        try:
+            check_query_plans(collection)
+            assert False, "The cleanup queries should scan the whole collection before the indexes are built"
+        except CollectionScanError:
+            pass
+
+        build_indexes(collection)
+        assert len(list(collection.find({"info.phone" : {"$exists" : True}}))) == 1
+        assert len(list(collection.find({"address" : {"$exists" : True}}, sort = [("_id", 1)]))) == 1
+        assert len(list(collection.find({"is_amenity" : True}))) == 2
+        client.close()
+    finally:
+        shutil.rmtree(directory)
+
+    test_mongodb_plans()
+
+
+# Winning plans of MongoDB, in the format of the explain() of MongoDB 4.4
+RECORDED_PLANS = {
+    # A partial index
+    "phone cleanup" : {"stage" : "FETCH",
+                       "inputStage" : {"stage" : "IXSCAN", "keyPattern" : {"info.phone" : 1}, "indexName" : "phone",
+                                       "isPartial" : True, "direction" : "forward",
+                                       "indexBounds" : {"info.phone" : ["[MinKey, MaxKey]"]}}},
+    # Sorted by _id without the partial index: the whole default index is read
+    "address cleanup" : {"stage" : "FETCH", "filter" : {"address" : {"$exists" : True}},
+                         "inputStage" : {"stage" : "IXSCAN", "keyPattern" : {"_id" : 1}, "indexName" : "_id_",
+                                         "isPartial" : False, "direction" : "forward",
+                                         "indexBounds" : {"_id" : ["[MinKey, MaxKey]"]}}},
+    "amenity spatial index" : {"stage" : "COLLSCAN", "filter" : {"is_amenity" : {"$eq" : True}},
+                               "direction" : "forward"},
+    # An $or, with an index per branch
+    "or" : {"stage" : "SUBPLAN",
+            "inputStage" : {"stage" : "FETCH",
+                            "inputStage" : {"stage" : "OR",
+                                            "inputStages" : [{"stage" : "IXSCAN", "indexName" : "phone"},
+                                                             {"stage" : "IXSCAN", "indexName" : "amenity_flag"}]}}}
+}
+
+
+def test_mongodb_plans():
+    # A collection answering find().explain() with the recorded plans
+    class RecordedCollection(object):
+        def __init__(self, plans):
+            self.plans = plans
+
+        def find(self, query, sort = None):
+            queries = dict(CHECKED_QUERIES, **{"or" : ({"$or" : []}, None)})
+            name, = [name for name, checked in queries.iteritems() if checked == (query, sort)]
+            return RecordedCursor(self.plans[name])
+
+    class RecordedCursor(object):
+        def __init__(self, plan):
+            self.plan = plan
+
+        def explain(self):
+            return {"queryPlanner" : {"winningPlan" : self.plan}}
+
+    collection = RecordedCollection(RECORDED_PLANS)
+    assert plan_stages(collection, *CHECKED_QUERIES["phone cleanup"]) == ["FETCH", "IXSCAN"]
+    assert plan_stages(collection, *CHECKED_QUERIES["address cleanup"]) == ["FETCH", "COLLSCAN"]
+    assert plan_stages(collection, *CHECKED_QUERIES["amenity spatial index"]) == ["COLLSCAN"]
+    assert sorted(plan_stages(collection, {"$or" : []})) == ["FETCH", "IXSCAN", "IXSCAN", "OR", "SUBPLAN"]
+
+    try:
+        check_query_plans(collection)
+        assert False, "The address and amenity queries should be reported"
+    except CollectionScanError, e:
+        assert str(e) == "These queries scan the whole collection: address cleanup, amenity spatial index"
+
+    # Once the indexes are used
+    index_plan = RECORDED_PLANS["phone cleanup"]
+    check_query_plans(RecordedCollection(dict((name, index_plan) for name in RECORDED_PLANS)))
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+
+# Durable checkpoints for insert_xml_map_to_db(), so a load interrupted halfway through a big map file (the process
+# killed, the database restarted...) can be resumed where it stopped, instead of dropping the collection and starting
+# over.
+# The map file is read by byte ranges aligned on the top level elements (the chunks of parallel_parse.py). After every
+# batch is inserted, the checkpoint records the start of the current chunk, the number of elements of that chunk
+# already read, the number of documents inserted, the last OSM id, the batch count, and the tag counts from before the
+# chunk. A resumed load seeks straight to that chunk and skips its first elements without shaping them, so at most one
+# chunk is parsed again. A compressed map file (see compressed_input.py) or a PBF file (see pbf_reader.py) can not be
+# read from an offset, so it is read as a single chunk: a resumed load reads the elements before the checkpoint again,
+# but still does not shape them.
+# The documents get their ordinal in the file as _id. A batch that was inserted but not recorded (the process stopped
+# between the insert and the checkpoint, or in the middle of the insert) is then easy to find: it is every document with
+# an _id at or above the number of documents recorded, and these are deleted before the load resumes. So nothing is
+# inserted twice, even without a unique index.
+# The checkpoint is written to a temporary file, synced to the disk, then renamed over the previous one, so it is never
+# left half written.
+
+import json
+import os
+from io import BytesIO
+
+import compressed_input
+import osm_reader
+import parallel_parse
+
+
+# Where the checkpoints are kept, one file per collection
+CHECKPOINT_DIRECTORY = ".ingest_checkpoints"
+
+# The size of the byte ranges the file is read by. At most one of them is parsed again when a load is resumed.
+CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def checkpoint_path(db_name, collection_name, directory = CHECKPOINT_DIRECTORY):
+    return os.path.join(directory, "%s.%s.json" % (db_name, collection_name))
+
+
+# What identifies the map file: a checkpoint is only used to resume the load of the same file, unchanged
+def file_signature(filename):
+    status = os.stat(filename)
+    return {"name" : os.path.abspath(filename), "size" : status.st_size, "mtime" : status.st_mtime}
+
+
+class IngestCheckpoint(object):
+    def __init__(self, path, filename, collection):
+        self.path = path
+        self.filename = filename
+        self.collection = collection
+        self.chunk_size = CHUNK_SIZE
+
+        # Where the load is: the start of the current chunk, the number of its elements read so far, and the tag counts
+        # of the chunks before it
+        self.chunk_start = None
+        self.chunk_elements = 0
+        self.chunk_tag_count = {}
+
+        # What was inserted
+        self.document_count = 0
+        self.last_id = None
+        self.batch_count = 0
+
+    # Loads the checkpoint of an unfinished load of the same file. Returns False if there is none.
+    def load(self):
+        if not os.path.exists(self.path):
+            return False
+
+        with open(self.path) as checkpoint_file:
+            state = json.load(checkpoint_file)
+        if state["file"] != file_signature(self.filename):
+            print "The checkpoint %s is for another map file, or the file changed since: not resumed" % self.path
+            return False
+
+        self.chunk_size = state["chunk_size"]
+        self.chunk_start = state["chunk_start"]
+        self.chunk_elements = state["chunk_elements"]
+        self.chunk_tag_count = state["chunk_tag_count"]
+        self.document_count = state["document_count"]
+        self.last_id = state["last_id"]
+        self.batch_count = state["batch_count"]
+        return True
+
+    def save(self):
+        state = {"file" : file_signature(self.filename), "chunk_size" : self.chunk_size,
+                 "chunk_start" : self.chunk_start, "chunk_elements" : self.chunk_elements,
+                 "chunk_tag_count" : self.chunk_tag_count, "document_count" : self.document_count,
+                 "last_id" : self.last_id, "batch_count" : self.batch_count}
+
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w") as checkpoint_file:
+            json.dump(state, checkpoint_file)
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        if os.name == "nt" and os.path.exists(self.path):
+            # os.rename() does not replace an existing file on Windows
+            os.remove(self.path)
+        os.rename(temporary_path, self.path)
+
+    # Called once the load is finished
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    # Deletes the documents inserted after the checkpoint was recorded
+    def remove_unrecorded_documents(self):
+        result = self.collection.delete_many({"_id" : {"$gte" : self.document_count}})
+        print "Resuming the load after %s: %d documents in %d batches already loaded, %d documents of an unfinished " \
+              "batch removed" % (self.last_id, self.document_count, self.batch_count, result.deleted_count)
+
+    # Yields the shaped elements of the map file from the checkpoint on (or from the start of the file). The position
+    # of the checkpoint follows the elements yielded, so when a batch is recorded, it is the one of the last element of
+    # that batch. The tags are counted in tag_count, including the ones of the elements loaded before the checkpoint.
+    # If a progress function is passed, it is called with the byte offset of every chunk, when it is started and done.
+    def shaped_elements(self, shape_function, tag_count, progress = None):
+        if compressed_input.compression(self.filename) or osm_reader.is_pbf(self.filename):
+            chunks = [(0, None)]
+        else:
+            chunks = parallel_parse.find_chunk_boundaries(self.filename, self.chunk_size)
+        skipped_elements = 0
+        if self.chunk_start is not None:
+            chunks = [(start, end) for start, end in chunks if start >= self.chunk_start]
+            skipped_elements = self.chunk_elements
+            tag_count.update(self.chunk_tag_count)
+
+        for start, end in chunks:
+            self.chunk_start = start
+            self.chunk_elements = 0
+            self.chunk_tag_count = dict(tag_count)
+            if progress is not None:
+                progress(start)
+
+            if end is None:
+                # The whole file
+                chunk = self.filename
+            else:
+                with open(self.filename, "rb") as osm_file:
+                    osm_file.seek(start)
+                    data = osm_file.read(end - start)
+
+                # Wrap the range inside a root element, so that it becomes a valid XML document
+                chunk = BytesIO(b"<osm>" + data + b"</osm>")
+            for element in osm_reader.iterate_elements(chunk, tag_count = tag_count):
+                self.chunk_elements += 1
+                if self.chunk_elements <= skipped_elements:
+                    continue
+
+                shaped_element = shape_function(element)
+                if shaped_element:
+                    yield shaped_element
+            skipped_elements = 0
+            if progress is not None and end is not None:
+                progress(end)
+
+    # Inserts a batch of documents, numbered from the count of the documents already inserted, then records the
+    # checkpoint
+    def insert_batch(self, documents):
+        for number, document in enumerate(documents):
+            document["_id"] = self.document_count + number
+
+        self.collection.insert_many(documents)
+
+        self.document_count += len(documents)
+        self.last_id = "%s/%s" % (documents[-1]["type"], documents[-1]["id"])
+        self.batch_count += 1
+        self.save()
+
+
+# The script run by test(): a checkpointed load into an SQLite database, resumed if a checkpoint is there
+TEST_LOADER = """
+import sys
+sys.path.insert(0, %r)
+import ingest_checkpoint
+import storage_backend
+from Montreal_data_processing import insert_xml_map_to_db
+
+ingest_checkpoint.CHUNK_SIZE = 64 * 1024
+storage_backend.select_backend("sqlite", directory = "db")
+insert_xml_map_to_db("map.osm", "test", sys.argv[1], True, clean_on_ingest = True, resume = True, batch_size = 500)
+"""
+
+
+# Loads a test file, killing the loader at random points and resuming it, and checks that the result is the same as an
+# uninterrupted load
+def test(kills = 8):
+    import random
+    import shutil
+    import subprocess
+    import sys
+    import tempfile
+    import time
+
+    import storage_backend
+
+    directory = tempfile.mkdtemp()
+    try:
+        osm_reader.write_test_file(os.path.join(directory, "map.osm"), 20000)
+        script = TEST_LOADER % os.path.dirname(os.path.abspath(__file__))
+
+        def start_loader(collection_name):
+            with open(os.devnull, "w") as output:
+                return subprocess.Popen([sys.executable, "-c", script, collection_name], cwd = directory,
+                                        stdout = output, stderr = subprocess.STDOUT)
+
+        start = time.time()
+        assert start_loader("reference").wait() == 0
+        load_time = time.time() - start
+
+        # The loaders are killed at random times, spread so that the kills are likely to fall all along the file
+        generator = random.Random(0)
+        killed = 0
+        while True:
+            loader = start_loader("resumed")
+            if killed < kills:
+                deadline = time.time() + generator.uniform(0.0, 2 * load_time / kills)
+                while loader.poll() is None and time.time() < deadline:
+                    time.sleep(0.005)
+                if loader.poll() is None:
+                    loader.kill()
+                    loader.wait()
+                    killed += 1
+                    continue
+
+            assert loader.wait() == 0
+            break
+
+        assert not os.path.exists(os.path.join(directory, checkpoint_path("test", "resumed")))
+        database = storage_backend.SQLiteBackend(os.path.join(directory, "db")).connect()["test"]
+        reference = list(database["reference"].find())
+        resumed = list(database["resumed"].find())
+        assert len(reference) == 22000
+        assert resumed == reference
+        print "Load killed %d times and resumed, same %d documents as an uninterrupted load" % (killed, len(resumed))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    test()
@@ -12,10 +12,11 @@ Note that your code will be tested with a different data file than the 'example.
 """
 import xml.etree.cElementTree as ET
 import pprint
+from compressed_input import map_source
 
 def count_tags(filename):
         # YOUR CODE HERE
-        tree = ET.parse(filename)
+        tree = ET.parse(map_source(filename))
         root = tree.getroot()
         
         result = {}
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+
+# A compact node id -> (lat, lon) index, built while the map file is parsed, and used to give every way a position (its
+# centroid), a bounding box and a length before it is inserted.
+# The index is made of three sorted NumPy arrays (int64 ids, float64 latitudes and longitudes) instead of a dictionary
+# of tuples, and the geometry of a whole batch of ways is computed in one vectorized step.
+#
+# Memory budget: 24 bytes per node once built (8 for the id, 8 for each coordinate), plus about 32 more bytes per node
+# for a short time while the arrays are sorted. The greater Montreal extract has about 6 million nodes, so the index
+# takes about 150 MB, with a peak of about 350 MB. DEFAULT_MEMORY_BUDGET_MB is checked when the index is built.
+
+import array
+
+import numpy as np
+
+from typed_schema import latitude_longitude
+
+
+DEFAULT_MEMORY_BUDGET_MB = 1024
+
+# Bytes per node: the ids, latitudes and longitudes, and the temporary sort order and sorted copies
+BYTES_PER_NODE = 24
+PEAK_BYTES_PER_NODE = 56
+
+EARTH_RADIUS_METERS = 6371008.8
+
+
+class NodeCoordinateIndex(object):
+    def __init__(self, memory_budget_mb = DEFAULT_MEMORY_BUDGET_MB):
+        self.memory_budget_mb = memory_budget_mb
+
+        # The ids are kept as Python ints by blocks (array.array has no 64 bits integer type on Python 2), the
+        # coordinates directly as packed doubles
+        self.id_blocks = []
+        self.current_ids = []
+        self.latitudes_builder = array.array("d")
+        self.longitudes_builder = array.array("d")
+
+        self.ids = None
+        self.latitudes = None
+        self.longitudes = None
+
+        # The nodes found after the index was built (ie after the first way). OSM files list all the nodes first, so
+        # this only happens with files that are not sorted, whose ways then miss these nodes.
+        self.late_nodes = 0
+
+    def __len__(self):
+        if self.ids is not None:
+            return len(self.ids)
+        return len(self.latitudes_builder)
+
+    def is_frozen(self):
+        return self.ids is not None
+
+    def add(self, node_id, latitude, longitude):
+        self.current_ids.append(node_id)
+        if len(self.current_ids) == 100000:
+            self.id_blocks.append(np.array(self.current_ids, dtype = np.int64))
+            self.current_ids = []
+
+        self.latitudes_builder.append(latitude)
+        self.longitudes_builder.append(longitude)
+
+    # Adds a shaped node document to the index, if it has a position. The documents read back from a collection loaded
+    # with the typed schema (see typed_schema.py) are accepted too.
+    def add_document(self, document):
+        if "pos" not in document:
+            return
+
+        if self.is_frozen():
+            self.late_nodes += 1
+            return
+
+        latitude, longitude = latitude_longitude(document["pos"])
+        self.add(int(document["id"]), latitude, longitude)
+
+    # Sorts the arrays by id. No node can be added after that.
+    def freeze(self):
+        if self.is_frozen():
+            return
+
+        peak_mb = len(self) * PEAK_BYTES_PER_NODE / (1024.0 * 1024.0)
+        if peak_mb > self.memory_budget_mb:
+            print "Warning, the node index of %d nodes needs about %.0f MB, more than its budget of %d MB" % \
+                  (len(self), peak_mb, self.memory_budget_mb)
+
+        ids = np.concatenate(self.id_blocks + [np.array(self.current_ids, dtype = np.int64)])
+        latitudes = np.frombuffer(self.latitudes_builder, dtype = np.float64)
+        longitudes = np.frombuffer(self.longitudes_builder, dtype = np.float64)
+
+        order = np.argsort(ids, kind = "mergesort")
+        self.ids = ids[order]
+        self.latitudes = latitudes[order]
+        self.longitudes = longitudes[order]
+
+        self.id_blocks = self.current_ids = None
+        self.latitudes_builder = self.longitudes_builder = None
+
+    def memory_usage_mb(self):
+        return len(self) * BYTES_PER_NODE / (1024.0 * 1024.0)
+
+    def report(self):
+        print "Node index: %d nodes, %.1f MB" % (len(self), self.memory_usage_mb())
+        if self.late_nodes:
+            print "Warning, %d nodes were found after the first way, and are missing from the way geometries" % \
+                  self.late_nodes
+
+    # Returns the latitudes and longitudes of an array of node ids, and a mask telling which ids were found (the nodes
+    # of a way may be outside of the extract)
+    def lookup(self, node_ids):
+        self.freeze()
+
+        if len(self.ids) == 0:
+            found = np.zeros(len(node_ids), dtype = bool)
+            return np.zeros(len(node_ids)), np.zeros(len(node_ids)), found
+
+        positions = np.searchsorted(self.ids, node_ids)
+        positions[positions == len(self.ids)] = 0
+        found = self.ids[positions] == node_ids
+        return self.latitudes[positions], self.longitudes[positions], found
+
+
+# The great circle distance in meters between arrays of points
+def haversine_meters(latitudes_1, longitudes_1, latitudes_2, longitudes_2):
+    latitudes_1, longitudes_1 = np.radians(latitudes_1), np.radians(longitudes_1)
+    latitudes_2, longitudes_2 = np.radians(latitudes_2), np.radians(longitudes_2)
+
+    a = np.sin((latitudes_2 - latitudes_1) / 2) ** 2 + \
+        np.cos(latitudes_1) * np.cos(latitudes_2) * np.sin((longitudes_2 - longitudes_1) / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * np.arcsin(np.sqrt(a))
+
+
+# A function that adds the geometry to all the ways of a batch of shaped documents, in one vectorized step:
+#   - "pos": the centroid of the nodes of the way, as [lat, lon] like the nodes. The last node of a closed way (an area,
+#     ending with its first node) is left out, so that the first node does not count twice
+#   - "geometry": {"bbox" : [min lat, min lon, max lat, max lon], "length" : length of the way in meters}
+# The nodes missing from the index are skipped. A way with none of its nodes in the index gets no geometry.
+def add_way_geometry(documents, index):
+    ways = [document for document in documents if document["type"] == "way" and "node_refs" in document]
+    if not ways:
+        return documents
+
+    ref_counts = np.array([len(way["node_refs"]) for way in ways])
+    way_numbers = np.repeat(np.arange(len(ways)), ref_counts)
+    refs = np.array([ref for way in ways for ref in way["node_refs"]]).astype(np.int64)
+
+    # The weight of every node in the centroid: 0 for the closing node of the closed ways
+    closed = np.array([len(way["node_refs"]) > 1 and way["node_refs"][0] == way["node_refs"][-1] for way in ways])
+    centroid_weights = np.ones(len(refs))
+    centroid_weights[(np.cumsum(ref_counts) - 1)[closed]] = 0.0
+
+    latitudes, longitudes, found = index.lookup(refs)
+    way_numbers, latitudes, longitudes = way_numbers[found], latitudes[found], longitudes[found]
+    centroid_weights = centroid_weights[found]
+    if len(way_numbers) == 0:
+        return documents
+
+    # Every group of consecutive values of way_numbers is one way (the ones with no node found have no group)
+    group_starts = np.flatnonzero(np.r_[True, way_numbers[1:] != way_numbers[:-1]])
+    group_ways = way_numbers[group_starts]
+    centroid_counts = np.add.reduceat(centroid_weights, group_starts)
+
+    centroid_latitudes = np.add.reduceat(latitudes * centroid_weights, group_starts) / centroid_counts
+    centroid_longitudes = np.add.reduceat(longitudes * centroid_weights, group_starts) / centroid_counts
+    min_latitudes = np.minimum.reduceat(latitudes, group_starts)
+    min_longitudes = np.minimum.reduceat(longitudes, group_starts)
+    max_latitudes = np.maximum.reduceat(latitudes, group_starts)
+    max_longitudes = np.maximum.reduceat(longitudes, group_starts)
+
+    # The length is the sum of the segments between consecutive nodes of the same way
+    segments = haversine_meters(latitudes[:-1], longitudes[:-1], latitudes[1:], longitudes[1:])
+    same_way = way_numbers[:-1] == way_numbers[1:]
+    lengths = np.bincount(way_numbers[:-1][same_way], weights = segments[same_way], minlength = len(ways))
+
+    rows = zip(group_ways.tolist(), centroid_latitudes.tolist(), centroid_longitudes.tolist(), min_latitudes.tolist(),
+               min_longitudes.tolist(), max_latitudes.tolist(), max_longitudes.tolist())
+    lengths = lengths.tolist()
+    for way_number, latitude, longitude, min_latitude, min_longitude, max_latitude, max_longitude in rows:
+        way = ways[way_number]
+        way["pos"] = [latitude, longitude]
+        way["geometry"] = {
+            "bbox" : [min_latitude, min_longitude, max_latitude, max_longitude],
+            "length" : lengths[way_number]
+        }
+
+    return documents
+
+
+def test():
+    index = NodeCoordinateIndex()
+    index.add(3, 45.0, -73.0)
+    index.add(1, 45.0, -73.001)
+    index.add(2, 45.001, -73.001)
+
+    ways = [
+        {"type" : "way", "id" : "10", "node_refs" : ["1", "2", "3"]},
+        {"type" : "way", "id" : "11", "node_refs" : ["4"]},
+        {"type" : "node", "id" : "1"},
+        {"type" : "way", "id" : "12", "node_refs" : ["4", "3", "1"]},
+        {"type" : "way", "id" : "13", "node_refs" : ["1", "2", "3", "1"]}
+    ]
+    add_way_geometry(ways, index)
+
+    assert ways[0]["geometry"]["bbox"] == [45.0, -73.001, 45.001, -73.0]
+    assert abs(ways[0]["pos"][0] - 45.000333) < 1e-6
+    # About 111 m for 0.001 degree of latitude, then the diagonal back, with 0.001 degree of longitude being about 79 m
+    assert abs(ways[0]["geometry"]["length"] - (111.2 + (111.2 ** 2 + 78.6 ** 2) ** 0.5)) < 1
+    assert "geometry" not in ways[1]
+    assert "pos" not in ways[2]
+    assert abs(ways[3]["geometry"]["length"] - 78.6) < 1
+    # The closed way has the centroid of its three distinct nodes, and the length of its closing segment
+    assert abs(ways[4]["pos"][0] - 45.000333) < 1e-6 and abs(ways[4]["pos"][1] + 73.000667) < 1e-6
+    assert abs(ways[4]["geometry"]["length"] - (ways[0]["geometry"]["length"] + 78.6)) < 1
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+
+# A memoization layer for the normalization functions (street names, phone numbers, postal codes).
+# In a city the same values repeat thousands of times, so every result is kept in two tiers:
+#   - a bounded in-memory LRU dictionary, for the values repeating within a run
+#   - an on-disk SQLite table, so the results are kept between runs
+# The on-disk file is named after a hash of the rule tables (word lists, dictionaries, regular expressions...) used by
+# the function. Changing the rules changes the hash, so the results computed with the old rules are never used again.
+# The worker processes of a parallel parse (see parallel_parse.py and pbf_reader.py) use a forked copy of the caches:
+# they write their new results to the disk at the end of every chunk, and send their hit and miss counts back with the
+# result of the chunk (see take() and merge()), like the data quality events.
+
+import hashlib
+import json
+import marshal
+import os
+import shutil
+import sqlite3
+from collections import OrderedDict
+
+
+# Increase this when the code of a cached function changes in a way that is not reflected in its rule tables
+CACHE_VERSION = 1
+
+DEFAULT_CACHE_DIR = ".normalization_cache"
+DEFAULT_MEMORY_ENTRIES = 100000
+
+# How many new results are kept before they are written to the disk in one transaction
+DISK_WRITE_BATCH = 1000
+
+# Used to tell a cached None result from a missing one
+MISSING = object()
+
+# The caches in use, by name (see enable_normalization_cache() in Montreal_data_processing.py)
+caches = {}
+
+
+# A function that returns a short hash identifying a set of rule tables. json with sorted keys is used, so that the hash
+# does not depend on the order of the dictionaries.
+def rules_hash(name, rule_tables):
+    serialized = json.dumps([name, CACHE_VERSION, rule_tables], sort_keys = True)
+    return hashlib.sha1(serialized).hexdigest()[:16]
+
+
+class NormalizationCache(object):
+    def __init__(self, name, function, rule_tables, cache_dir = DEFAULT_CACHE_DIR,
+                 max_memory_entries = DEFAULT_MEMORY_ENTRIES, persistent = True):
+        self.name = name
+        self.function = function
+        self.max_memory_entries = max_memory_entries
+
+        self.memory = OrderedDict()
+        self.pending_writes = []
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self.path = None
+        if persistent:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            self.path = os.path.join(cache_dir, "%s-%s.sqlite" % (name, rules_hash(name, rule_tables)))
+            self.remove_stale_files(cache_dir, name)
+
+        # The connection is opened lazily, by the process using it (a SQLite connection must not be shared with the
+        # worker processes of a parallel parse)
+        self.connection = None
+        self.connection_pid = None
+
+    # The files of the same cache built with other rules will never be used again, delete them
+    def remove_stale_files(self, cache_dir, name):
+        for file_name in os.listdir(cache_dir):
+            path = os.path.join(cache_dir, file_name)
+            if file_name.startswith(name + "-") and file_name.endswith(".sqlite") and path != self.path:
+                os.remove(path)
+
+    def get_connection(self):
+        if self.connection is None or self.connection_pid != os.getpid():
+            self.connection = sqlite3.connect(self.path, timeout = 30)
+            self.connection.text_factory = str
+            self.connection.execute("CREATE TABLE IF NOT EXISTS results (key BLOB PRIMARY KEY, value BLOB)")
+            self.connection_pid = os.getpid()
+            self.pending_writes = []
+        return self.connection
+
+    # Lists are not hashable, so they are turned into tuples to be used as keys
+    @staticmethod
+    def memory_key(value):
+        if isinstance(value, list):
+            return tuple(value)
+        return value
+
+    # The results are returned as copies, so that the caller can not change the cached value
+    @staticmethod
+    def copy_result(result):
+        if isinstance(result, list):
+            return list(result)
+        return result
+
+    def remember(self, key, result):
+        self.memory[key] = result
+        if len(self.memory) > self.max_memory_entries:
+            self.memory.popitem(last = False)
+
+    def __call__(self, value):
+        key = self.memory_key(value)
+
+        result = self.memory.pop(key, MISSING)
+        if result is not MISSING:
+            self.memory_hits += 1
+            # Put it back at the end, as the most recently used
+            self.memory[key] = result
+            return self.copy_result(result)
+
+        if self.path:
+            disk_key = buffer(marshal.dumps(value))
+            row = self.get_connection().execute("SELECT value FROM results WHERE key = ?", (disk_key, )).fetchone()
+            if row is not None:
+                self.disk_hits += 1
+                result = marshal.loads(row[0])
+                self.remember(key, result)
+                return self.copy_result(result)
+
+        self.misses += 1
+        result = self.function(value)
+        self.remember(key, self.copy_result(result))
+
+        if self.path:
+            self.pending_writes.append((disk_key, buffer(marshal.dumps(result))))
+            if len(self.pending_writes) >= DISK_WRITE_BATCH:
+                self.flush()
+
+        return result
+
+    def flush(self):
+        if not self.path or not self.pending_writes:
+            return
+
+        connection = self.get_connection()
+        try:
+            with connection:
+                connection.executemany("INSERT OR REPLACE INTO results (key, value) VALUES (?, ?)", self.pending_writes)
+        except sqlite3.OperationalError, e:
+            # Another process holds the lock for too long. The results are only lost for the next runs.
+            print "Could not write the %s cache: %s" % (self.name, e)
+        self.pending_writes = []
+
+    def close(self):
+        self.flush()
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    # Returns the hit and miss counts, and resets them
+    def take_counts(self):
+        counts = (self.memory_hits, self.disk_hits, self.misses)
+        self.memory_hits = self.disk_hits = self.misses = 0
+        return counts
+
+    # Adds the counts returned by take_counts() on another copy of the cache
+    def merge_counts(self, counts):
+        memory_hits, disk_hits, misses = counts
+        self.memory_hits += memory_hits
+        self.disk_hits += disk_hits
+        self.misses += misses
+
+    def stats(self):
+        calls = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "name" : self.name,
+            "calls" : calls,
+            "memory_hits" : self.memory_hits,
+            "disk_hits" : self.disk_hits,
+            "misses" : self.misses,
+            "hit_rate" : float(self.memory_hits + self.disk_hits) / calls if calls else 0.0
+        }
+
+    def report(self):
+        stats = self.stats()
+        print "%s cache: %d calls, %d memory hits, %d disk hits, %d misses (hit rate %.1f%%)" % \
+              (stats["name"], stats["calls"], stats["memory_hits"], stats["disk_hits"], stats["misses"],
+               stats["hit_rate"] * 100)
+
+
+# Called when a worker process of a parallel parse starts: the counts and the results waiting to be written, copied from
+# the parent process, are left to the parent
+def start_worker():
+    for cache in caches.itervalues():
+        cache.take_counts()
+        cache.pending_writes = []
+
+
+# Called by a worker process at the end of a chunk: writes the new results of the caches to the disk, and returns their
+# counts, to be passed to merge() by the parent process
+def take():
+    state = {}
+    for name, cache in caches.iteritems():
+        cache.flush()
+        state[name] = cache.take_counts()
+    return state
+
+
+def merge(state):
+    for name, counts in state.iteritems():
+        if name in caches:
+            caches[name].merge_counts(counts)
+
+
+def test():
+    import tempfile
+
+    calls = []
+
+    def upper(value):
+        calls.append(value)
+        return value.upper()
+
+    directory = tempfile.mkdtemp()
+    try:
+        cache_dir = os.path.join(directory, "cache")
+
+        cache = NormalizationCache("upper", upper, {"rules" : [1, 2]}, cache_dir, max_memory_entries = 2)
+        assert [cache(value) for value in ["a", "b", "a", "c", "a"]] == ["A", "B", "A", "C", "A"]
+        assert calls == ["a", "b", "c"]
+        cache.close()
+
+        # A new run with the same rules gets the results from the disk
+        cache = NormalizationCache("upper", upper, {"rules" : [1, 2]}, cache_dir)
+        assert cache("b") == "B"
+        assert cache.stats()["disk_hits"] == 1
+        cache.close()
+
+        # A new run with other rules does not
+        cache = NormalizationCache("upper", upper, {"rules" : [1, 3]}, cache_dir)
+        assert cache("b") == "B"
+        assert cache.stats()["misses"] == 1
+        cache.close()
+        assert len(os.listdir(cache_dir)) == 1
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    test()
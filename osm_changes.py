@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+# Applies OSM change files (.osc, the daily or minutely diffs of OpenStreetMap) to a collection already loaded from the
+# map, so a refresh only writes the elements that changed, instead of dropping the collection and reloading the whole
+# map.
+# The created and modified elements are shaped (and cleaned) like the ones of the map, then replaced in the collection,
+# or inserted if they are not there yet (upsert). The deleted elements are removed. The elements are found by their type
+# and id, with a unique index: node ids and way ids are separate sequences in OSM, so a node and a way can have the same
+# id. The changes are sent in unordered bulk_write() batches. An element changed more than once in a batch only gets
+# its last change, so the order of the requests within a batch does not matter.
+# With the typed schema (see typed_schema.py), the documents of a batch are converted together before they are sent,
+# and the elements are found by their integer id.
+
+from collections import OrderedDict
+
+import storage_backend
+
+
+CHANGE_BATCH_SIZE = 1000
+
+# The unique key of the elements
+ELEMENT_KEY = [("type", 1), ("id", 1)]
+
+
+class ChangeBatch(object):
+    def __init__(self, collection, batch_size = CHANGE_BATCH_SIZE, typed = False):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.typed = typed
+
+        # The last change of every element of the batch, by element key: its document, or None if it is deleted
+        self.changes = OrderedDict()
+        self.batch_count = 0
+
+        # Totals
+        self.upserted = 0
+        self.modified = 0
+        self.deleted = 0
+
+    def add(self, key, document):
+        self.changes.pop(key, None)
+        self.changes[key] = document
+        if len(self.changes) >= self.batch_size:
+            self.flush()
+
+    def upsert(self, document):
+        self.add((document["type"], document["id"]), document)
+
+    def delete(self, element_type, element_id):
+        self.add((element_type, element_id), None)
+
+    # The bulk_write() requests of the changes of the batch
+    def requests(self):
+        if self.typed:
+            # Imported here, as it needs numpy
+            import typed_schema
+            typed_schema.convert_batch([document for document in self.changes.itervalues() if document is not None])
+
+        requests = []
+        for (element_type, element_id), document in self.changes.iteritems():
+            if document is None:
+                element_id = int(element_id) if self.typed else element_id
+                requests.append(storage_backend.DeleteOne({"type" : element_type, "id" : element_id}))
+            else:
+                element_filter = {"type" : element_type, "id" : document["id"]}
+                requests.append(storage_backend.ReplaceOne(element_filter, document, upsert = True))
+        return requests
+
+    def flush(self):
+        if not self.changes:
+            return
+
+        result = self.collection.bulk_write(self.requests(), ordered = False)
+        self.batch_count += 1
+        self.upserted += result.upserted_count
+        self.modified += result.modified_count
+        self.deleted += result.deleted_count
+        self.changes = OrderedDict()
+
+    def close(self):
+        self.flush()
+        print "Changes applied in %d batches: %d elements created, %d modified, %d deleted" % \
+              (self.batch_count, self.upserted, self.modified, self.deleted)
+
+
+# A function that applies the changes (the (action, element) pairs of osm_reader.iterate_changes()) to the collection.
+# The created and modified elements are passed through shape_function, and converted to the typed schema if typed is set
+# to true. Returns the ChangeBatch, with the totals.
+def apply_changes(collection, changes, shape_function, batch_size = CHANGE_BATCH_SIZE, typed = False):
+    collection.create_index(ELEMENT_KEY, unique = True, name = "element_key")
+
+    batch = ChangeBatch(collection, batch_size, typed)
+    for action, element in changes:
+        if element.tag not in ("node", "way"):
+            continue
+
+        if action == "delete":
+            batch.delete(element.tag, element.attrib["id"])
+        else:
+            document = shape_function(element)
+            if document:
+                batch.upsert(document)
+
+    batch.close()
+    return batch
+
+
+# Writes an OSM change file modifying, deleting and creating some of the elements of a file written by
+# osm_reader.write_test_file()
+def write_test_change_file(filename, node_count, change_count):
+    with open(filename, "w") as change_file:
+        change_file.write('<?xml version="1.0" encoding="UTF-8"?>\n<osmChange version="0.6">\n <modify>\n')
+        for node_id in xrange(1, change_count + 1):
+            change_file.write('  <node id="%d" version="2" changeset="2" timestamp="2015-01-02T00:00:00Z" user="user%d" '
+                              'uid="%d" lat="45.5" lon="-73.6">\n   <tag k="amenity" v="restaurant"/>\n'
+                              '   <tag k="phone" v="514 555 %04d"/>\n  </node>\n' % (node_id, node_id % 100,
+                                                                                    node_id % 100, node_id % 10000))
+        change_file.write(' </modify>\n <delete>\n')
+        for node_id in xrange(change_count + 1, 2 * change_count + 1):
+            change_file.write('  <node id="%d" version="2" changeset="2" timestamp="2015-01-02T00:00:00Z" user="user1" '
+                              'uid="1" lat="45.5" lon="-73.6"/>\n' % node_id)
+        change_file.write(' </delete>\n <create>\n')
+        for node_id in xrange(node_count + 1, node_count + change_count + 1):
+            change_file.write('  <node id="%d" version="1" changeset="2" timestamp="2015-01-02T00:00:00Z" user="user1" '
+                              'uid="1" lat="45.6" lon="-73.7"/>\n' % node_id)
+        change_file.write(' </create>\n</osmChange>\n')
+
+
+def test():
+    import os
+    import shutil
+    import tempfile
+
+    import osm_reader
+    import storage_backend
+    from Montreal_data_processing import shape_element, shape_and_clean_element
+
+    directory = tempfile.mkdtemp()
+    try:
+        map_filename = os.path.join(directory, "map.osm")
+        change_filename = os.path.join(directory, "change.osc")
+        osm_reader.write_test_file(map_filename, 1000)
+        write_test_change_file(change_filename, 1000, 100)
+
+        client = storage_backend.SQLiteBackend(directory).connect()
+        collection = client["test"]["elements"]
+        collection.insert_many([shape_element(element) for element in osm_reader.iterate_elements(map_filename)])
+
+        batch = apply_changes(collection, osm_reader.iterate_changes(change_filename), shape_and_clean_element, 64)
+        assert (batch.upserted, batch.modified, batch.deleted) == (100, 100, 100)
+        assert collection.count() == 1100
+        assert collection.find_one({"type" : "node", "id" : "150"}) is None
+        # The modified elements were cleaned
+        assert collection.find_one({"type" : "node", "id" : "7"})["info"]["phone"] == ["+1 (514) 555-0007"]
+        # The ways with the same ids as the modified nodes were not touched
+        assert len(collection.find_one({"type" : "way", "id" : "7"})["node_refs"]) == 10
+
+        # With the typed schema, the elements are found by their integer id
+        import typed_schema
+        typed_collection = client["test"]["typed"]
+        typed_collection.insert_many(typed_schema.convert_batch([shape_element(element) for element in
+                                                                 osm_reader.iterate_elements(map_filename)]))
+        batch = apply_changes(typed_collection, osm_reader.iterate_changes(change_filename), shape_and_clean_element,
+                              64, typed = True)
+        assert (batch.upserted, batch.modified, batch.deleted) == (100, 100, 100)
+        assert typed_collection.count() == 1100
+        assert typed_collection.find_one({"type" : "node", "id" : 150}) is None
+        assert typed_collection.find_one({"type" : "node", "id" : 7})["created"]["version"] == 2
+        client.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    test()
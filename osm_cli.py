@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+
+# The command line of the pipeline:
+#   python osm_cli.py ingest MAP     loads a map file (.osm, .osm.bz2, .osm.gz or .osm.pbf) into the database, cleans
+#                                    it, applies OSM change files, builds the indexes and prints the statistics
+#   python osm_cli.py clean          cleans again the phone numbers and the addresses already in the database
+#   python osm_cli.py stats          prints the statistics of the loaded data
+#   python osm_cli.py audit MAP      explores a map file (tags, users, key types, street types), without any database
+#   python osm_cli.py compare-schemas MAP
+#                                    loads a map file with the string and the typed schemas (see typed_schema.py), and
+#                                    compares the size of the collections and of their indexes, and map_stats()
+# Only argparse is imported when the command line starts: every command imports the modules it needs when it runs. So
+# --help and audit start in a few tens of milliseconds. pymongo is only imported when the MongoDB storage is used, with
+# one exception: the background writers of ingest (see pipelined_ingest.py, turned off by --no-pipelined) encode the
+# documents with the bson package of pymongo, whatever the storage.
+# python osm_cli.py COMMAND --help lists the options of a command.
+
+import argparse
+import sys
+
+
+DEFAULT_DB = "montreal_osm"
+DEFAULT_COLLECTION = "all_data"
+
+PROFILED_STAGES = ["load", "phone_cleanup", "address_cleanup"]
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description = "Load, clean and explore the OpenStreetMap data of Montreal.")
+    commands = parser.add_subparsers(dest = "command")
+
+    # The options of the commands using the database
+    database = argparse.ArgumentParser(add_help = False)
+    database.add_argument("--db", default = DEFAULT_DB, help = "database name (default: %(default)s)")
+    database.add_argument("--collection", default = DEFAULT_COLLECTION, help = "collection name (default: %(default)s)")
+    database.add_argument("--storage", choices = ["mongodb", "sqlite"], default = "mongodb",
+                          help = "a MongoDB server, or an embedded SQLite database needing no server "
+                                 "(default: %(default)s)")
+    database.add_argument("--host", help = "MongoDB host (default: the local host)")
+    database.add_argument("--port", type = int, help = "MongoDB port")
+    database.add_argument("--sqlite-directory", default = ".sqlite_db",
+                          help = "where the SQLite databases are kept (default: %(default)s)")
+    database.add_argument("--no-normalization-cache", action = "store_true",
+                          help = "do not keep the normalized street names, phones and postal codes between runs")
+    database.add_argument("--quality-report", default = "quality_events.jsonl", metavar = "FILE",
+                          help = "where to write the data quality events, empty to skip it (default: %(default)s)")
+    database.add_argument("--quality-samples", type = int, default = 5, metavar = "N",
+                          help = "examples kept per data quality event code (default: %(default)s)")
+    database.add_argument("--echo-events", action = "store_true",
+                          help = "also print every data quality event when it happens (slower)")
+    database.add_argument("--metrics", default = "pipeline_metrics.json", metavar = "FILE",
+                          help = "where to write the metrics of the stages, empty to skip it (default: %(default)s)")
+    database.add_argument("--profile", action = "append", default = [], choices = PROFILED_STAGES, metavar = "STAGE",
+                          help = "profile a stage (%s), can be repeated" % ", ".join(PROFILED_STAGES))
+    database.add_argument("--profile-directory", default = "profiles",
+                          help = "where to save the profiles (default: %(default)s)")
+    database.add_argument("--profile-every", type = int, default = 1, metavar = "N",
+                          help = "only profile every Nth batch (default: %(default)s)")
+    database.add_argument("--profile-memory", action = "store_true",
+                          help = "also take tracemalloc snapshots at the end of the profiled batches")
+
+    ingest = commands.add_parser("ingest", parents = [database], help = "load a map file into the database")
+    ingest.add_argument("map", help = "the map file (.osm, .osm.bz2, .osm.gz or .osm.pbf)")
+    ingest.add_argument("--changes", action = "append", default = [], metavar = "FILE",
+                        help = "an OSM change file (.osc) to apply after the load, can be repeated (in order)")
+    ingest.add_argument("--changes-only", action = "store_true",
+                        help = "keep the data already loaded, and only apply the change files")
+    ingest.add_argument("--keep", action = "store_true", help = "do not clear the collection before the load")
+    ingest.add_argument("--serial", action = "store_true",
+                        help = "parse the file in this process only (the parse cache too, when it is built)")
+    ingest.add_argument("--processes", type = int, help = "processes of the parallel parse (default: all the cores)")
+    ingest.add_argument("--no-parse-cache", action = "store_true",
+                        help = "do not keep the shaped elements in a binary cache next to the map file")
+    ingest.add_argument("--no-way-geometry", action = "store_true",
+                        help = "do not compute the position, bounding box and length of the ways")
+    ingest.add_argument("--no-pipelined", action = "store_true",
+                        help = "insert the batches from this thread, instead of background writers")
+    ingest.add_argument("--resumable", action = "store_true",
+                        help = "record a checkpoint after every batch, and resume an interrupted load (the parse is "
+                               "then serial, without the parse cache and the background writers)")
+    ingest.add_argument("--batch-size", type = int, default = 10000,
+                        help = "documents per batch (default: %(default)s)")
+    ingest.add_argument("--typed-schema", action = "store_true",
+                        help = "store integer ids, refs and versions, datetime timestamps and GeoJSON positions, "
+                               "instead of strings (use it for the change files of a collection loaded with it too)")
+    ingest.add_argument("--no-indexes", action = "store_true", help = "do not build the query indexes after the load")
+    ingest.add_argument("--reclean", action = "store_true",
+                        help = "also clean again the data in the database after the load (after changing the rules)")
+    ingest.add_argument("--spatial-index", default = "amenities.spatial.npz", metavar = "FILE",
+                        help = "where to save a spatial index of the amenities after the load, empty to skip it "
+                               "(default: %(default)s)")
+    ingest.add_argument("--no-stats", action = "store_true", help = "do not print the statistics after the load")
+
+    commands.add_parser("clean", parents = [database],
+                        help = "clean the phone numbers and addresses already in the database")
+    commands.add_parser("stats", parents = [database], help = "print the statistics of the loaded data")
+
+    compare = commands.add_parser("compare-schemas", parents = [database],
+                                  help = "compare the string and the typed schemas on a map file")
+    compare.add_argument("map", help = "the map file (.osm, .osm.bz2, .osm.gz or .osm.pbf)")
+    compare.set_defaults(db = "schema_comparison")
+
+    audit = commands.add_parser("audit", help = "explore a map file, without any database")
+    audit.add_argument("map", help = "the map file (.osm, .osm.bz2 or .osm.gz)")
+    audit.add_argument("--visitors", nargs = "+", metavar = "NAME",
+                       help = "the explorations to run: tags, users, key_types, street_types (default: all)")
+
+    return parser
+
+
+# Selects the storage and sets up the metrics, the profiling and the data quality events of a run. Returns the
+# processing module.
+def start_run(arguments):
+    import Montreal_data_processing as processing
+    import pipeline_metrics
+    import pipeline_profiler
+    import quality_events
+    import storage_backend
+
+    if arguments.storage == "sqlite":
+        storage_backend.select_backend("sqlite", directory = arguments.sqlite_directory)
+    else:
+        storage_backend.select_backend("mongodb", host = arguments.host, port = arguments.port)
+
+    quality_events.configure(arguments.quality_samples, arguments.echo_events)
+    pipeline_metrics.configure()
+    pipeline_profiler.configure(arguments.profile, arguments.profile_directory, arguments.profile_every,
+                                arguments.profile_memory)
+    if not arguments.no_normalization_cache:
+        processing.enable_normalization_cache()
+    return processing
+
+
+# Writes the reports of a run
+def finish_run(arguments, processing):
+    import pipeline_metrics
+    import quality_events
+
+    if not arguments.no_normalization_cache:
+        processing.report_normalization_cache()
+    quality_events.events.report()
+    if arguments.quality_report:
+        quality_events.events.write_report(arguments.quality_report)
+    if arguments.metrics:
+        pipeline_metrics.run.write_summary(arguments.metrics)
+
+
+def ingest_command(arguments):
+    processing = start_run(arguments)
+
+    if not arguments.changes_only:
+        # The checkpoints need a serial parse, without the parse cache and the background writers
+        resumable = arguments.resumable
+        processing.insert_xml_map_to_db(arguments.map, arguments.db, arguments.collection, not arguments.keep,
+                                        clean_on_ingest = True, parallel = not (arguments.serial or resumable),
+                                        processes = arguments.processes,
+                                        use_parse_cache = not (arguments.no_parse_cache or resumable),
+                                        way_geometry = not arguments.no_way_geometry,
+                                        pipelined = not (arguments.no_pipelined or resumable), resume = resumable,
+                                        batch_size = arguments.batch_size, typed = arguments.typed_schema)
+    for change_file in arguments.changes:
+        processing.apply_change_file(change_file, arguments.db, arguments.collection, typed = arguments.typed_schema)
+    if not arguments.no_indexes:
+        processing.build_query_indexes(arguments.db, arguments.collection, arguments.typed_schema)
+    if arguments.reclean:
+        processing.clean_osm_data(arguments.db, arguments.collection)
+    if arguments.spatial_index:
+        processing.build_spatial_index(arguments.db, arguments.collection, arguments.spatial_index)
+    if not arguments.no_stats:
+        processing.print_map_stats(processing.map_stats(arguments.db, arguments.collection))
+
+    finish_run(arguments, processing)
+
+
+def clean_command(arguments):
+    processing = start_run(arguments)
+    processing.clean_osm_data(arguments.db, arguments.collection)
+    finish_run(arguments, processing)
+
+
+def stats_command(arguments):
+    processing = start_run(arguments)
+    processing.print_map_stats(processing.map_stats(arguments.db, arguments.collection))
+    finish_run(arguments, processing)
+
+
+def compare_schemas_command(arguments):
+    processing = start_run(arguments)
+    import typed_schema
+    typed_schema.compare_schemas(arguments.map, arguments.db)
+    finish_run(arguments, processing)
+
+
+def audit_command(arguments):
+    import audit
+    import osm_explorer
+
+    unknown = set(arguments.visitors or []) - set(osm_explorer.VISITORS)
+    if unknown:
+        raise SystemExit("Unknown visitors: %s (available: %s)" % (", ".join(sorted(unknown)),
+                                                                   ", ".join(sorted(osm_explorer.VISITORS))))
+
+    results = osm_explorer.scan(arguments.map, arguments.visitors)
+    if "tags" in results:
+        print "Tags found and their count:"
+        for tag, count in sorted(results["tags"].iteritems(), key = lambda item: -item[1]):
+            print "  %s: %d" % (tag, count)
+    if "users" in results:
+        print "Unique users: %d" % len(results["users"])
+    if "key_types" in results:
+        print "Tag keys by type: %s" % ", ".join("%s %d" % item for item in sorted(results["key_types"].iteritems()))
+    if "street_types" in results:
+        print "Unexpected street types:"
+        for street_type, names in sorted(results["street_types"].iteritems()):
+            for name in sorted(names):
+                print "  %s: %s => %s" % (street_type, name, audit.update_name(name, audit.mapping))
+
+
+COMMANDS = {"ingest" : ingest_command, "clean" : clean_command, "stats" : stats_command, "audit" : audit_command,
+            "compare-schemas" : compare_schemas_command}
+
+
+def main(argv = None):
+    arguments = build_parser().parse_args(argv)
+    COMMANDS[arguments.command](arguments)
+
+
+def test():
+    import os
+    import shutil
+    import subprocess
+    import tempfile
+
+    import osm_reader
+
+    parser = build_parser()
+    arguments = parser.parse_args(["ingest", "map.osm", "--storage", "sqlite", "--changes", "a.osc", "--changes",
+                                   "b.osc", "--profile", "load", "--serial"])
+    assert arguments.changes == ["a.osc", "b.osc"] and arguments.profile == ["load"] and arguments.serial
+    assert parser.parse_args(["audit", "map.osm"]).visitors is None
+
+    # Parsing the arguments and the audit do not import the pipeline, nor pymongo
+    check = "import sys, osm_cli; osm_cli.build_parser().parse_args(['stats']); import osm_explorer, audit; " \
+            "print(' '.join(name for name in ('pymongo', 'Montreal_data_processing') if name in sys.modules))"
+    assert subprocess.check_output([sys.executable, "-c", check],
+                                   cwd = os.path.dirname(os.path.abspath(__file__))).strip() == ""
+
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, "map.osm")
+        osm_reader.write_test_file(filename, 2000)
+        main(["audit", filename, "--visitors", "tags", "street_types"])
+
+        options = ["--storage", "sqlite", "--sqlite-directory", os.path.join(directory, "db"), "--db", "test",
+                   "--quality-report", os.path.join(directory, "quality.jsonl"), "--metrics",
+                   os.path.join(directory, "metrics.json"), "--no-normalization-cache"]
+        main(["ingest", filename, "--serial", "--no-parse-cache", "--no-pipelined", "--no-way-geometry",
+              "--no-indexes", "--spatial-index", "", "--no-stats"] + options)
+        main(["stats"] + options)
+        assert os.path.exists(os.path.join(directory, "metrics.json"))
+
+        # Without the background writers, the SQLite storage needs neither pymongo nor bson
+        check = "import sys, osm_cli; options = %r; " \
+                "osm_cli.main(['ingest', %r, '--no-pipelined', '--no-stats', '--spatial-index', ''] + options); " \
+                "osm_cli.main(['clean'] + options); " \
+                "print('MODULES ' + ' '.join(name for name in ('pymongo', 'bson') if name in sys.modules))" % \
+                (options, filename)
+        output = subprocess.check_output([sys.executable, "-c", check],
+                                         cwd = os.path.dirname(os.path.abspath(__file__)))
+        assert output.strip().splitlines()[-1].strip() == "MODULES"
+
+        # The default ingest builds the parse cache with the parallel parse
+        main(["ingest", filename, "--collection", "typed", "--typed-schema", "--spatial-index",
+              os.path.join(directory, "amenities.npz"), "--no-stats", "--processes", "2"] + options)
+        assert os.path.exists(filename + ".parsecache")
+
+        import storage_backend
+        client = storage_backend.SQLiteBackend(os.path.join(directory, "db")).connect()
+        assert client["test"][DEFAULT_COLLECTION].count() == 2200
+        assert type(client["test"]["typed"].find_one({"type" : "way"})["node_refs"][0]) in (int, long)
+        client.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main()
+    else:
+        test()
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+# A single pass exploration scanner, doing the work of the four exploration scripts (mapparser.py, users.py, tags.py and
+# audit.py) in one streaming pass over the file, instead of parsing it four times (and building the whole tree in RAM,
+# in the case of mapparser.py).
+# Every kind of result is computed by a visitor. The scanner calls visit() on every element of the file once it is fully
+# parsed, and the visitors keep whatever they need from it. To add a new exploration, write a class with the visit() and
+# result() methods and decorate it with @register_visitor. Setting element_tags limits the elements passed to visit() to
+# the listed tags, which saves a function call per element for the others.
+
+import xml.etree.cElementTree as ET
+import pprint
+import sys
+import time
+from collections import defaultdict
+
+import audit
+import mapparser
+import osm_reader
+import tags
+import users
+from compressed_input import map_source
+
+
+# The registered visitors, by name
+VISITORS = {}
+
+
+def register_visitor(visitor_class):
+    VISITORS[visitor_class.name] = visitor_class
+    return visitor_class
+
+
+class Visitor(object):
+    name = None
+
+    # The tags of the elements this visitor is interested in, or None for all the elements
+    element_tags = None
+
+    # Called with every element of the file, after its closing tag was parsed
+    def visit(self, element):
+        pass
+
+    def result(self):
+        return None
+
+
+# Same as mapparser.count_tags(): the number of times every tag is found in the file
+@register_visitor
+class TagCountVisitor(Visitor):
+    name = "tags"
+
+    def __init__(self):
+        self.tag_count = defaultdict(int)
+
+    def visit(self, element):
+        self.tag_count[element.tag] += 1
+
+    def result(self):
+        return dict(self.tag_count)
+
+
+# Same as users.process_map(): the set of unique user ids
+@register_visitor
+class UniqueUsersVisitor(Visitor):
+    name = "users"
+
+    def __init__(self):
+        self.users = set()
+
+    def visit(self, element):
+        if "uid" in element.attrib:
+            self.users.add(element.attrib["uid"])
+
+    def result(self):
+        return self.users
+
+
+# Same as tags.process_map(): the count of the keys of each category (lower, lower_colon, problemchars, other)
+@register_visitor
+class KeyTypeVisitor(Visitor):
+    name = "key_types"
+    element_tags = ("tag", )
+
+    def __init__(self):
+        self.keys = {"lower": 0, "lower_colon": 0, "problemchars": 0, "other": 0}
+
+    def visit(self, element):
+        tags.key_type(element, self.keys)
+
+    def result(self):
+        return self.keys
+
+
+# Same as audit.audit(): the street names whose street type is not in the expected list, by street type
+@register_visitor
+class StreetTypeVisitor(Visitor):
+    name = "street_types"
+    element_tags = ("node", "way")
+
+    def __init__(self):
+        self.street_types = defaultdict(set)
+
+    def visit(self, element):
+        for tag in element.iter("tag"):
+            if audit.is_street_name(tag):
+                street_name = tag.attrib['v']
+                m = audit.street_type_re.search(street_name)
+                if m and m.group() not in audit.expected:
+                    self.street_types[m.group()].add(street_name)
+
+    def result(self):
+        return self.street_types
+
+
+# A function that parses the file once, passes every element to all the visitors, and returns the result of every
+# visitor by name. By default all the registered visitors are used.
+def scan(filename, visitor_names = None):
+    if visitor_names is None:
+        visitor_names = sorted(VISITORS)
+    visitors = [VISITORS[name]() for name in visitor_names]
+
+    # The visit() methods to call for every tag, filled as the tags are found
+    tag_visits = {}
+
+    root = None
+    for event, element in ET.iterparse(map_source(filename), events = ("start", "end")):
+        if event == "start":
+            if root is None:
+                root = element
+            continue
+
+        visits = tag_visits.get(element.tag)
+        if visits is None:
+            visits = [visitor.visit for visitor in visitors
+                      if visitor.element_tags is None or element.tag in visitor.element_tags]
+            tag_visits[element.tag] = visits
+
+        for visit in visits:
+            visit(element)
+
+        # Free the top level elements once they were visited, so the memory stays constant (see osm_reader.py)
+        if element.tag in osm_reader.TOP_LEVEL_TAGS:
+            element.clear()
+            root.clear()
+
+    return dict((visitor.name, visitor.result()) for visitor in visitors)
+
+
+# Times the four exploration scripts against a single scan of the same file
+def compare_timings(filename):
+    start = time.time()
+    mapparser.count_tags(filename)
+    users.process_map(filename)
+    tags.process_map(filename)
+    audit.audit(filename)
+    scripts_time = time.time() - start
+
+    start = time.time()
+    scan(filename)
+    scan_time = time.time() - start
+
+    print "Four scripts: %.2f s, single scan: %.2f s (%.1fx faster)" % (scripts_time, scan_time,
+                                                                      scripts_time / scan_time)
+
+
+def test():
+    results = scan('example.osm')
+
+    assert results["tags"] == mapparser.count_tags('example.osm')
+    assert results["users"] == users.process_map('example.osm')
+    assert results["key_types"] == tags.process_map('example.osm')
+    assert len(results["street_types"]) == 3
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        pprint.pprint(scan(sys.argv[1]))
+    else:
+        test()
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+# The streaming reader shared by all the parsing code.
+# It yields the top level elements (node, way, relation) only once they are fully built, ie after their closing tag was
+# parsed, so all their <tag> and <nd> sub-elements are there. As soon as the caller is done with an element, it is
+# cleared and detached from the root, so the memory used stays the same no matter how big the file is.
+# The files compressed with bzip2 or gzip are read as they are, decompressed by other processes (see
+# compressed_input.py), and the PBF files are read by pbf_reader.py, which yields the same elements.
+
+import xml.etree.cElementTree as ET
+import os
+import random
+import struct
+import tempfile
+
+from compressed_input import map_source
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, the memory test is skipped there
+    resource = None
+
+
+TOP_LEVEL_TAGS = ("node", "way", "relation")
+
+
+# A generator that yields the fully built top level elements of an OSM file (a file name or a file object) whose tag is
+# in tags. If a tag_count dictionary is passed, the count of every tag found in the file (except the root) is added to
+# it. The yielded element must not be kept by the caller, as it is cleared right after being consumed.
+def iterate_elements(source, tags = TOP_LEVEL_TAGS, tag_count = None):
+    if isinstance(source, basestring) and is_pbf(source):
+        # Imported here, as it is the only reader needing numpy
+        import pbf_reader
+
+        for element in pbf_reader.iterate_elements(source, tags, tag_count):
+            yield element
+        return
+
+    root = None
+    depth = 0
+
+    for event, element in ET.iterparse(map_source(source), events = ("start", "end")):
+        if event == "start":
+            if root is None:
+                root = element
+            depth += 1
+
+            if tag_count is not None and depth > 1:
+                tag_count[element.tag] = tag_count.get(element.tag, 0) + 1
+            continue
+
+        depth -= 1
+        if depth == 1:
+            if element.tag in tags:
+                yield element
+
+            # Free the element and its sub-elements, then remove it from the root. Only clearing it would leave an
+            # empty element per node in the root, which still takes a lot of RAM with millions of nodes.
+            element.clear()
+            root.clear()
+
+
+# A PBF file starts with the size of the header of its first blob, then that header, whose type is OSMHeader: a string
+# field (0x0a), of 9 bytes
+def is_pbf(filename):
+    with open(filename, "rb") as map_file:
+        start = map_file.read(15)
+    return len(start) == 15 and struct.unpack(">I", start[:4])[0] < 64 * 1024 and start[4:15] == b"\x0a\x09OSMHeader"
+
+
+# The blocks of an OSM change file (.osc)
+CHANGE_ACTIONS = ("create", "modify", "delete")
+
+
+# A generator that yields the changes of an OSM change file (.osc) as (action, element) pairs: the fully built top level
+# elements of its create, modify and delete blocks whose tag is in tags, with the action of their block. The memory
+# stays constant the same way as with iterate_elements().
+def iterate_changes(source, tags = TOP_LEVEL_TAGS):
+    root = None
+    action = None
+    depth = 0
+
+    for event, element in ET.iterparse(map_source(source), events = ("start", "end")):
+        if event == "start":
+            if root is None:
+                root = element
+            depth += 1
+            if depth == 2:
+                action = element
+            continue
+
+        depth -= 1
+        if depth == 2:
+            if action.tag in CHANGE_ACTIONS and element.tag in tags:
+                yield action.tag, element
+
+            element.clear()
+            action.clear()
+        elif depth == 1:
+            root.clear()
+
+
+# A function that writes a generated OSM file with the given number of nodes (each one with a couple of tags), and a way
+# for every 10 nodes. Used to test the memory on big files.
+def write_test_file(filename, node_count):
+    generator = random.Random(0)
+
+    with open(filename, "w") as osm_file:
+        osm_file.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6">\n')
+        for node_id in xrange(1, node_count + 1):
+            osm_file.write(' <node id="%d" version="1" changeset="1" timestamp="2015-01-01T00:00:00Z" user="user%d" '
+                           'uid="%d" lat="45.%07d" lon="-73.%07d">\n'
+                           '  <tag k="amenity" v="cafe"/>\n  <tag k="addr:street" v="Rue Saint-Denis"/>\n </node>\n'
+                           % (node_id, node_id % 100, node_id % 100, generator.randint(0, 9999999),
+                              generator.randint(0, 9999999)))
+        for way_id in xrange(1, node_count / 10 + 1):
+            osm_file.write(' <way id="%d" version="1" changeset="1" timestamp="2015-01-01T00:00:00Z" user="user1" '
+                           'uid="1">\n' % way_id)
+            for _ in range(10):
+                osm_file.write('  <nd ref="%d"/>\n' % generator.randint(1, node_count))
+            osm_file.write('  <tag k="highway" v="residential"/>\n </way>\n')
+        osm_file.write('</osm>\n')
+
+
+# The peak resident memory of the process so far, in MB
+def peak_rss_mb():
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def test():
+    tag_count = {}
+    elements = [(element.tag, len(element)) for element in iterate_elements('example.osm', tag_count = tag_count)]
+    assert len(elements) == 22
+    # The sub-elements are there when the element is yielded
+    assert sum(sub_elements for tag, sub_elements in elements) == 14
+    assert tag_count == {'bounds': 1, 'member': 3, 'nd': 4, 'node': 20, 'relation': 1, 'tag': 7, 'way': 1}
+
+    if resource is None:
+        return
+
+    # Parse a generated file of about 100 MB, and check that the peak memory does not grow with it. Building the whole
+    # tree of such a file takes more than 1 GB.
+    memory_limit_mb = 20
+    handle, filename = tempfile.mkstemp(suffix = ".osm")
+    os.close(handle)
+    try:
+        write_test_file(filename, 400000)
+
+        baseline = peak_rss_mb()
+        node_refs = 0
+        for element in iterate_elements(filename):
+            node_refs += len(element.findall("nd"))
+        growth = peak_rss_mb() - baseline
+
+        print "Peak memory growth while parsing %d MB: %.1f MB" % (os.path.getsize(filename) / (1024 * 1024), growth)
+        assert node_refs == 400000
+        assert growth < memory_limit_mb
+    finally:
+        os.remove(filename)
+
+
+if __name__ == "__main__":
+    test()
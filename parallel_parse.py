@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+
+# Parallel parsing of a single .osm file.
+# The file is split into byte ranges, each one starting at a top level <node, <way or <relation tag, so every range is a
+# well formed sequence of complete elements. A process pool parses the ranges and runs the shape function on them, and
+# the results are merged back into one stream, in the same order as the serial parse (or in whatever order the chunks
+# finish, if the order is not important).
+
+import marshal
+import multiprocessing
+import os
+import re
+from collections import deque
+from io import BytesIO
+from itertools import islice
+from Queue import Queue
+
+import compressed_input
+import normalization_cache
+import osm_reader
+import quality_events
+
+
+# A top level element always starts with one of these tags. The sub-elements of the OSM format (tag, nd, member) have
+# different names, and a "<" can not appear unescaped inside an attribute value, so every match is a real element start
+top_level_start = re.compile(r"<(node|way|relation)[\s/>]")
+
+# The default size of a byte range. Small enough to keep the memory of every worker low, and big enough to make the
+# cost of sending the results back to the main process negligible compared to the parsing
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+
+# How many bytes are read at a time when looking for the start of an element
+SEARCH_BLOCK_SIZE = 64 * 1024
+
+
+# A function that returns the offset of the first top level element starting at or after the offset passed. If there
+# is no element after that offset, the end offset is returned.
+def next_element_start(osm_file, offset, end):
+    osm_file.seek(offset)
+    position = offset
+
+    while position < end:
+        # Read a bit more than a block, so that a tag split between two blocks is still found
+        block = osm_file.read(SEARCH_BLOCK_SIZE + 16)
+        if not block:
+            break
+
+        match = top_level_start.search(block)
+        if match and position + match.start() < end:
+            return position + match.start()
+
+        position += SEARCH_BLOCK_SIZE
+        osm_file.seek(position)
+
+    return end
+
+
+# A function that splits the file into byte ranges of about chunk_size bytes, each one aligned on the start of a top
+# level element. The bounds and the closing </osm> tag are left out, as they are not shaped anyway.
+def find_chunk_boundaries(filename, chunk_size = DEFAULT_CHUNK_SIZE):
+    file_size = os.path.getsize(filename)
+
+    with open(filename, "rb") as osm_file:
+        # The data ends where the root element is closed
+        tail_offset = max(0, file_size - SEARCH_BLOCK_SIZE)
+        osm_file.seek(tail_offset)
+        tail = osm_file.read()
+        closing_tag = tail.rfind(b"</osm>")
+        end = tail_offset + closing_tag if closing_tag != -1 else file_size
+
+        boundaries = [next_element_start(osm_file, 0, end)]
+        offset = boundaries[0] + chunk_size
+        while offset < end:
+            start = next_element_start(osm_file, offset, end)
+            if start > boundaries[-1]:
+                boundaries.append(start)
+            offset = max(offset, start) + chunk_size
+
+        if boundaries[-1] != end:
+            boundaries.append(end)
+
+    return [(boundaries[i], boundaries[i + 1]) for i in range(len(boundaries) - 1)]
+
+
+# The work done by every process of the pool: parse one byte range, shape its top level elements and count the tags
+# found in it. The data quality events recorded while shaping, and the counts of the normalization caches, are sent back
+# too (see quality_events.py and normalization_cache.py). The arguments are passed as a single tuple so that the
+# function can be used with Pool.imap()
+# The result is sent back serialized with marshal, which is about twice as fast as the pickle used by default by the
+# pool for this kind of data (dictionaries, lists, strings and floats only).
+def parse_chunk(arguments):
+    filename, start, end, shape_function = arguments
+
+    with open(filename, "rb") as osm_file:
+        osm_file.seek(start)
+        data = osm_file.read(end - start)
+
+    # Wrap the range inside a root element, so that it becomes a valid XML document
+    chunk = BytesIO(b"<osm>" + data + b"</osm>")
+
+    shaped_elements = []
+    tag_count = {}
+
+    for element in osm_reader.iterate_elements(chunk, tag_count = tag_count):
+        shaped_element = shape_function(element)
+        if shaped_element:
+            shaped_elements.append(shaped_element)
+
+    return marshal.dumps((shaped_elements, tag_count, quality_events.events.take(), normalization_cache.take(),
+                          end - start))
+
+
+# Calls function(argument) in a worker process of the pool, and returns (True, result), or (False, exception) if it
+# raised one, so the unordered bounded_imap() hears about the calls that failed
+def call_safely(task):
+    function, argument = task
+    try:
+        return True, function(argument)
+    except Exception, e:
+        return False, e
+
+
+# Like pool.imap() (or pool.imap_unordered() if ordered is False), but with at most in_flight calls submitted and not
+# yet read by the caller: pool.imap() submits all the calls at once and keeps every result until it is read, so when the
+# caller is slower than the workers (a slow database), the whole shaped file ends up in memory. A new call is submitted
+# every time a result is read.
+def bounded_imap(pool, function, arguments, in_flight, ordered = True):
+    arguments = iter(arguments)
+
+    if ordered:
+        pending = deque(pool.apply_async(function, (argument, )) for argument in islice(arguments, in_flight))
+        while pending:
+            result = pending.popleft().get()
+            for argument in islice(arguments, 1):
+                pending.append(pool.apply_async(function, (argument, )))
+            yield result
+        return
+
+    # The results are put in the queue by the result thread of the pool, as they finish
+    finished = Queue()
+    pending = 0
+    for argument in islice(arguments, in_flight):
+        pool.apply_async(call_safely, ((function, argument), ), callback = finished.put)
+        pending += 1
+
+    while pending:
+        succeeded, result = finished.get()
+        pending -= 1
+        if not succeeded:
+            raise result
+        for argument in islice(arguments, 1):
+            pool.apply_async(call_safely, ((function, argument), ), callback = finished.put)
+            pending += 1
+        yield result
+
+
+# A function that parses the map file using a pool of processes, and yields the shaped elements. If ordered is True,
+# the elements come out in the same order as the file (and as the serial parse). If it is False, the chunks are yielded
+# as soon as they are ready, which keeps all the processes busy when some chunks are slower than others.
+# If a tag_count dictionary is passed, the count of every tag found inside the top level elements is added to it.
+# If a progress function is passed, it is called with the byte offset reached in the file after every chunk (with an
+# unordered parse, the total size of the chunks done).
+# A compressed file can not be split into byte ranges: it is parsed by this process, while the processes decompress it
+# (see compressed_input.py). The blobs of a PBF file are decoded by the processes instead (see pbf_reader.py).
+def parallel_shape(filename, shape_function, processes = None, ordered = True, tag_count = None,
+                   chunk_size = DEFAULT_CHUNK_SIZE, progress = None):
+    if osm_reader.is_pbf(filename):
+        # Imported here, as it is the only reader needing numpy
+        import pbf_reader
+
+        for shaped_element in pbf_reader.parallel_shape(filename, shape_function, processes, ordered, tag_count,
+                                                        progress):
+            yield shaped_element
+        return
+
+    if compressed_input.compression(filename):
+        source = compressed_input.open_compressed(filename, processes)
+        for element in osm_reader.iterate_elements(source, tag_count = tag_count):
+            shaped_element = shape_function(element)
+            if shaped_element:
+                yield shaped_element
+        return
+
+    chunks = [(filename, start, end, shape_function) for start, end in find_chunk_boundaries(filename, chunk_size)]
+
+    processes = processes or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(processes, normalization_cache.start_worker)
+    try:
+        # Two chunks per process: one being parsed, one waiting to be read
+        results = bounded_imap(pool, parse_chunk, chunks, 2 * processes, ordered)
+
+        done = 0
+        for result in results:
+            shaped_elements, chunk_tag_count, chunk_events, chunk_cache_counts, chunk_bytes = marshal.loads(result)
+            quality_events.events.merge(chunk_events)
+            normalization_cache.merge(chunk_cache_counts)
+
+            done += chunk_bytes
+            if progress is not None:
+                progress(done)
+
+            if tag_count is not None:
+                for tag, count in chunk_tag_count.iteritems():
+                    tag_count[tag] = tag_count.get(tag, 0) + count
+
+            for shaped_element in shaped_elements:
+                yield shaped_element
+
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def test():
+    import bz2
+    import shutil
+    import tempfile
+
+    from Montreal_data_processing import enable_normalization_cache, iterate_shaped_elements, shape_element, \
+                                         shape_and_clean_element
+
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, "map.osm")
+        osm_reader.write_test_file(filename, 2000)
+
+        # The reference is the serial parse of the ingest
+        serial_tag_count = {}
+        serial = list(iterate_shaped_elements(filename, serial_tag_count, shape_element))
+
+        # Use a tiny chunk size so that the file is split into several chunks
+        tag_count = {}
+        parallel = list(parallel_shape(filename, shape_element, processes = 2, tag_count = tag_count,
+                                       chunk_size = 16 * 1024))
+        assert parallel == serial
+        assert tag_count == dict((tag, count) for tag, count in serial_tag_count.iteritems() if tag != "osm")
+
+        unordered = list(parallel_shape(filename, shape_element, processes = 2, ordered = False,
+                                        chunk_size = 16 * 1024))
+        element_key = lambda element: (element["type"], element["id"])
+        assert sorted(unordered, key = element_key) == sorted(serial, key = element_key)
+
+        # A compressed file is decompressed by the other processes instead
+        compressed_filename = os.path.join(directory, "map.osm.bz2")
+        with open(filename, "rb") as osm_file, open(compressed_filename, "wb") as compressed_file:
+            compressed_file.write(bz2.compress(osm_file.read()))
+        assert list(parallel_shape(compressed_filename, shape_element, processes = 2)) == serial
+
+        # The processes write the results of the normalization caches to the disk, and send their counts back
+        enable_normalization_cache(os.path.join(directory, "cache"))
+        try:
+            cleaned = list(parallel_shape(filename, shape_and_clean_element, processes = 2, chunk_size = 16 * 1024))
+            assert len(cleaned) == len(serial)
+            street_cache = normalization_cache.caches["street"]
+            assert street_cache.stats()["calls"] == 2000
+            assert street_cache.get_connection().execute("SELECT COUNT(*) FROM results").fetchone()[0] == 1
+            street_cache.close()
+        finally:
+            normalization_cache.caches.clear()
+    finally:
+        shutil.rmtree(directory)
+
+    # The calls are submitted as the results are read, and the errors of the workers reach the caller
+    pool = multiprocessing.Pool(2)
+    try:
+        submitted = []
+        def arguments():
+            for number in range(-10, 10):
+                submitted.append(number)
+                yield number
+
+        results = bounded_imap(pool, abs, arguments(), 4)
+        assert next(results) == 10 and len(submitted) == 5
+        assert list(results) == [abs(number) for number in range(-9, 10)]
+
+        del submitted[:]
+        results = bounded_imap(pool, abs, arguments(), 4, ordered = False)
+        next(results)
+        assert len(submitted) == 5
+        assert len(list(results)) == 19
+
+        for ordered in (True, False):
+            try:
+                list(bounded_imap(pool, int, ["1", "x", "3"], 2, ordered))
+                assert False, "The ValueError of the worker should be raised"
+            except ValueError:
+                pass
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+
+# A binary cache of the shaped elements of a map file, so that the runs after the first one do not parse the XML again.
+# The cache is a directory next to the map file (<map file>.parsecache, or <map file>.<name>.parsecache for the cache
+# of another shaping function, like the one of data.py) holding:
+#   - key.json: the size, modification time and SHA-1 of the map file it was built from, and the tag counts
+#   - ids.npy, types.npy, pos.npy, users.npy, offsets.npy: numeric arrays, memory-mapped when loading
+#   - strings.bin: the string table of the user names (a few thousand, repeated millions of times)
+#   - documents.bin: the rest of every shaped element, serialized with marshal, at the offsets of offsets.npy
+# If the map file changes, the key does not match anymore and the cache is rebuilt.
+
+import array
+import hashlib
+import json
+import marshal
+import mmap
+import os
+import shutil
+
+import numpy as np
+
+import osm_reader
+
+
+# Increase this when the format of the cache changes
+CACHE_VERSION = 1
+
+ELEMENT_TYPES = ["node", "way"]
+
+KEY_FILE = "key.json"
+
+
+# Grows an int64 array by blocks of Python values (array.array has no 64 bits integer type on Python 2)
+class Int64ArrayBuilder(object):
+    def __init__(self, values = (), block_size = 100000):
+        self.blocks = []
+        self.current = list(values)
+        self.block_size = block_size
+
+    def append(self, value):
+        self.current.append(value)
+        if len(self.current) >= self.block_size:
+            self.blocks.append(np.array(self.current, dtype = np.int64))
+            self.current = []
+
+    def last(self):
+        if self.current:
+            return self.current[-1]
+        return int(self.blocks[-1][-1])
+
+    def to_array(self):
+        return np.concatenate(self.blocks + [np.array(self.current, dtype = np.int64)])
+
+
+def cache_directory(filename, name = None):
+    if name is None:
+        return filename + ".parsecache"
+    return "%s.%s.parsecache" % (filename, name)
+
+
+# The SHA-1 of the content of the file, read by blocks of 4 MB
+def file_hash(filename):
+    sha1 = hashlib.sha1()
+    with open(filename, "rb") as map_file:
+        for block in iter(lambda: map_file.read(4 * 1024 * 1024), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+# The key of a map file: the cache version, the version of the shaping rules, the size, the modification time and the
+# content hash. The hash is only computed when needed, as it takes about a second per 300 MB.
+def file_key(filename, shape_version, with_hash = True):
+    stat = os.stat(filename)
+    key = {"version" : CACHE_VERSION, "shape_version" : shape_version, "size" : stat.st_size, "mtime" : stat.st_mtime}
+    if with_hash:
+        key["sha1"] = file_hash(filename)
+    return key
+
+
+# Writes key.json, through a temporary file so that a key is never half written
+def write_key(directory, content):
+    temporary_path = os.path.join(directory, KEY_FILE + ".tmp")
+    with open(temporary_path, "w") as key_file:
+        json.dump(content, key_file)
+    os.rename(temporary_path, os.path.join(directory, KEY_FILE))
+
+
+# A function that checks if there is a valid cache for the map file. If the size or the modification time changed, the
+# content hash decides (the file may only have been touched or copied). When the hash matches, the key is updated with
+# the new modification time, so the file is not hashed again on the next runs.
+def is_cache_valid(filename, shape_version, name = None):
+    directory = cache_directory(filename, name)
+    key_path = os.path.join(directory, KEY_FILE)
+    if not os.path.exists(key_path):
+        return False
+
+    with open(key_path) as key_file:
+        content = json.load(key_file)
+    cached_key = content["key"]
+
+    key = file_key(filename, shape_version, with_hash = False)
+    if all(cached_key.get(field) == value for field, value in key.iteritems()):
+        return True
+
+    key["sha1"] = file_hash(filename)
+    if not all(cached_key.get(field) == key[field] for field in ["version", "shape_version", "size", "sha1"]):
+        return False
+
+    content["key"] = key
+    write_key(directory, content)
+    return True
+
+
+# A function that parses the map file, shapes its elements with shape_function and writes the cache. It is written to
+# a temporary directory first, so that an interrupted build never leaves a half written cache behind. If parallel is
+# set to true, the file is parsed and shaped by a pool of processes (see parallel_parse.py).
+def build_cache(filename, shape_function, shape_version, name = None, parallel = False, processes = None):
+    directory = cache_directory(filename, name)
+    temporary_directory = directory + ".tmp"
+    if os.path.exists(temporary_directory):
+        shutil.rmtree(temporary_directory)
+    os.makedirs(temporary_directory)
+
+    ids = Int64ArrayBuilder()
+    types = array.array("b")
+    positions = array.array("d")
+    user_indexes = array.array("i")
+    offsets = Int64ArrayBuilder([0])
+
+    user_table = {}
+    tag_count = {}
+
+    if parallel:
+        # Imported here, as the serial build does not need the pool
+        import parallel_parse
+        shaped_elements = parallel_parse.parallel_shape(filename, shape_function, processes, tag_count = tag_count)
+    else:
+        shaped_elements = (shape_function(element) for element in osm_reader.iterate_elements(filename,
+                                                                                              tag_count = tag_count))
+
+    with open(os.path.join(temporary_directory, "documents.bin"), "wb") as documents_file:
+        for document in shaped_elements:
+            if not document:
+                continue
+
+            ids.append(int(document.pop("id")))
+            types.append(ELEMENT_TYPES.index(document.pop("type")))
+
+            position = document.pop("pos", None)
+            if position:
+                positions.extend(position)
+            else:
+                positions.extend([np.nan, np.nan])
+
+            user = document["created"].pop("user", None)
+            if user is None:
+                user_indexes.append(-1)
+            else:
+                user_indexes.append(user_table.setdefault(user, len(user_table)))
+
+            data = marshal.dumps(document)
+            documents_file.write(data)
+            offsets.append(offsets.last() + len(data))
+
+    ids = ids.to_array()
+    np.save(os.path.join(temporary_directory, "ids.npy"), ids)
+    np.save(os.path.join(temporary_directory, "types.npy"), np.frombuffer(types, dtype = np.int8))
+    np.save(os.path.join(temporary_directory, "pos.npy"), np.frombuffer(positions, dtype = np.float64).reshape(-1, 2))
+    np.save(os.path.join(temporary_directory, "users.npy"), np.frombuffer(user_indexes, dtype = np.int32))
+    np.save(os.path.join(temporary_directory, "offsets.npy"), offsets.to_array())
+
+    users = [None] * len(user_table)
+    for user, index in user_table.iteritems():
+        users[index] = user
+    with open(os.path.join(temporary_directory, "strings.bin"), "wb") as strings_file:
+        marshal.dump(users, strings_file)
+
+    # The key is written last: a cache without a key is never used
+    write_key(temporary_directory,
+              {"key" : file_key(filename, shape_version), "tag_count" : tag_count, "count" : len(ids)})
+
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.rename(temporary_directory, directory)
+
+
+# A generator that yields the shaped elements stored in the cache of the map file, rebuilt the same way as
+# shape_function returned them. If a tag_count dictionary is passed, the tag counts of the map file are added to it.
+def load_cache(filename, tag_count = None, name = None):
+    directory = cache_directory(filename, name)
+
+    with open(os.path.join(directory, KEY_FILE)) as key_file:
+        cached_tag_count = json.load(key_file)["tag_count"]
+    if tag_count is not None:
+        for tag, count in cached_tag_count.iteritems():
+            tag_count[str(tag)] = tag_count.get(str(tag), 0) + count
+
+    ids = np.load(os.path.join(directory, "ids.npy"), mmap_mode = "r")
+    types = np.load(os.path.join(directory, "types.npy"), mmap_mode = "r")
+    positions = np.load(os.path.join(directory, "pos.npy"), mmap_mode = "r")
+    user_indexes = np.load(os.path.join(directory, "users.npy"), mmap_mode = "r")
+    offsets = np.load(os.path.join(directory, "offsets.npy"), mmap_mode = "r")
+
+    with open(os.path.join(directory, "strings.bin"), "rb") as strings_file:
+        users = marshal.load(strings_file)
+
+    if len(ids) == 0:
+        return
+
+    with open(os.path.join(directory, "documents.bin"), "rb") as documents_file:
+        documents = mmap.mmap(documents_file.fileno(), 0, access = mmap.ACCESS_READ)
+        try:
+            # Convert the arrays to lists by blocks: indexing numpy arrays one value at a time is slow
+            block_size = 100000
+            for block_start in xrange(0, len(ids), block_size):
+                block_end = min(block_start + block_size, len(ids))
+                block_ids = ids[block_start:block_end].tolist()
+                block_types = types[block_start:block_end].tolist()
+                block_positions = positions[block_start:block_end].tolist()
+                block_users = user_indexes[block_start:block_end].tolist()
+                block_offsets = offsets[block_start:block_end + 1].tolist()
+
+                for i in xrange(block_end - block_start):
+                    document = marshal.loads(documents[block_offsets[i]:block_offsets[i + 1]])
+                    document["id"] = str(block_ids[i])
+                    document["type"] = ELEMENT_TYPES[block_types[i]]
+
+                    position = block_positions[i]
+                    # NaN is the only value not equal to itself
+                    if position[0] == position[0]:
+                        document["pos"] = position
+
+                    if block_users[i] != -1:
+                        document["created"]["user"] = users[block_users[i]]
+
+                    yield document
+        finally:
+            documents.close()
+
+
+# A function that yields the shaped elements of the map file from the cache, building the cache first if there is no
+# valid one. shape_version identifies the shaping rules: when they change, the cache is rebuilt. Every shaping function
+# has its own cache, named by name (see cache_directory()). parallel and processes are those of build_cache().
+def cached_shaped_elements(filename, shape_function, shape_version, tag_count = None, name = None, parallel = False,
+                           processes = None):
+    if not is_cache_valid(filename, shape_version, name):
+        print "Building the parse cache of " + filename
+        build_cache(filename, shape_function, shape_version, name, parallel, processes)
+
+    return load_cache(filename, tag_count, name)
+
+
+def test():
+    import tempfile
+
+    import data
+    from Montreal_data_processing import shape_element
+
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, "test.osm")
+        osm_reader.write_test_file(filename, 2000)
+
+        expected = [shape_element(element) for element in osm_reader.iterate_elements(filename)]
+        expected = [element for element in expected if element]
+
+        assert list(cached_shaped_elements(filename, shape_element, "test")) == expected
+        assert is_cache_valid(filename, "test")
+        assert list(cached_shaped_elements(filename, shape_element, "test")) == expected
+        assert not is_cache_valid(filename, "other rules")
+
+        # Built by the parallel parse, the cache holds the same elements
+        assert list(cached_shaped_elements(filename, shape_element, "test", name = "parallel", parallel = True,
+                                           processes = 2)) == expected
+
+        # The cache of another shaping function does not replace this one
+        data_expected = [data.shape_element(element) for element in osm_reader.iterate_elements(filename)]
+        data_expected = [element for element in data_expected if element]
+        assert list(cached_shaped_elements(filename, data.shape_element, "data", name = "data")) == data_expected
+        assert is_cache_valid(filename, "test") and is_cache_valid(filename, "data", "data")
+
+        # A touched file is hashed once, then the key holds its new modification time
+        stat = os.stat(filename)
+        os.utime(filename, (stat.st_atime, stat.st_mtime + 10))
+        assert is_cache_valid(filename, "test")
+        with open(os.path.join(cache_directory(filename), KEY_FILE)) as key_file:
+            assert json.load(key_file)["key"]["mtime"] == os.stat(filename).st_mtime
+        assert list(load_cache(filename)) == expected
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    test()
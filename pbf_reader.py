@@ -0,0 +1,798 @@
+# -*- coding: utf-8 -*-
+
+# A reader of the PBF format of OpenStreetMap (.osm.pbf), the binary format the extracts are also distributed in. It
+# yields the same elements as osm_reader.iterate_elements() does for the XML format (cElementTree elements with the same
+# attributes and <tag>, <nd> and <member> sub-elements), so shape_element() and the other shape functions give the same
+# documents for both formats.
+#
+# A PBF file is a sequence of blobs, each one preceded by its header: an OSMHeader blob, then OSMData blobs, each one a
+# zlib compressed PrimitiveBlock of about 8000 elements with its own string table. The blobs can be decoded
+# independently, so parallel_shape() reads their offsets only, and a process pool decodes and shapes them, like
+# parallel_parse.py does with the byte ranges of an XML file.
+#
+# The protocol buffers are decoded by hand (there are only a few message types, and this avoids a dependency on the
+# protobuf package). The packed arrays of the dense nodes (ids, coordinates, metadata, keys and values), which hold
+# most of the data, are decoded with NumPy in a few vectorized steps.
+#
+# The coordinates are given as the shortest text giving back the same float, so float() of the "lat" and "lon"
+# attributes gives exactly the value the XML text gives, as long as the XML has at most 7 decimals (like the OSM files).
+
+import calendar
+import marshal
+import multiprocessing
+import struct
+import time
+import xml.etree.cElementTree as ET
+import zlib
+from itertools import izip
+from operator import itemgetter
+
+import numpy as np
+
+import normalization_cache
+import osm_reader
+import parallel_parse
+import quality_events
+
+
+# The features of the format this reader supports
+SUPPORTED_FEATURES = frozenset(["OsmSchema-V0.6", "DenseNodes", "HistoricalInformation"])
+
+# The member types of the relations, by number
+MEMBER_TYPES = ["node", "way", "relation"]
+
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+# The number of elements per block written by write_pbf(), like osmium and osmosis
+BLOCK_SIZE = 8000
+
+
+# Protocol buffers decoding
+
+def read_varint(data, position):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+
+# The fields of a message (a bytearray), as (field number, value) pairs. The value is an integer for the varints, and
+# a bytearray for the length delimited fields (strings, sub-messages and packed arrays).
+def iterate_fields(data):
+    position = 0
+    end = len(data)
+    while position < end:
+        key, position = read_varint(data, position)
+        wire_type = key & 7
+        if wire_type == 0:
+            value, position = read_varint(data, position)
+        elif wire_type == 2:
+            length, position = read_varint(data, position)
+            value = data[position:position + length]
+            position += length
+        elif wire_type == 1:
+            value = data[position:position + 8]
+            position += 8
+        elif wire_type == 5:
+            value = data[position:position + 4]
+            position += 4
+        else:
+            raise ValueError("Unsupported protocol buffers wire type %d" % wire_type)
+        yield key >> 3, value
+
+
+# The int64 fields are sent as unsigned varints, in two's complement
+def signed(value):
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def unzigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+# A packed array of varints, decoded in Python (for the short arrays of the ways and relations)
+def varint_list(data):
+    values = []
+    value = 0
+    shift = 0
+    for byte in data:
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            values.append(value)
+            value = 0
+            shift = 0
+        else:
+            shift += 7
+    return values
+
+
+# A packed array of sint64 stored as deltas (the node refs and member ids), decoded in Python
+def delta_list(data):
+    values = []
+    value = 0
+    for delta in varint_list(data):
+        value += unzigzag(delta)
+        values.append(value)
+    return values
+
+
+# A packed array of varints, decoded with NumPy: the last byte of every varint is the one below 0x80, and every byte
+# holds 7 bits of its varint, shifted by 7 times its position in it
+def varint_array(data):
+    if not data:
+        return np.zeros(0, dtype = np.uint64)
+
+    data = np.frombuffer(bytes(data), dtype = np.uint8)
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+
+    positions = np.arange(len(data)) - np.repeat(starts, ends - starts + 1)
+    parts = (data & 0x7f).astype(np.uint64) << (positions * 7).astype(np.uint64)
+    return np.add.reduceat(parts, starts)
+
+
+def unzigzag_array(values):
+    return (values >> np.uint64(1)).astype(np.int64) ^ -(values & np.uint64(1)).astype(np.int64)
+
+
+# A packed array of sint32 or sint64 stored as deltas, decoded with NumPy
+def delta_array(data):
+    return np.cumsum(unzigzag_array(varint_array(data)))
+
+
+# Several packed arrays of sint64 stored as deltas (the node refs of the ways of a group), decoded together with NumPy.
+# Every array starts from 0, so the sum of the arrays before it is subtracted from its values. Returns the values of
+# every array as a list of strings.
+def delta_arrays(packed_arrays):
+    data = b"".join(bytes(packed_array) for packed_array in packed_arrays)
+    if not data:
+        return [[] for _ in packed_arrays]
+
+    # The number of values of every array: the number of bytes ending a varint in it
+    byte_bounds = np.cumsum([0] + [len(packed_array) for packed_array in packed_arrays])
+    varint_ends = np.concatenate(([0], np.cumsum(np.frombuffer(data, dtype = np.uint8) < 0x80)))
+    counts = varint_ends[byte_bounds[1:]] - varint_ends[byte_bounds[:-1]]
+
+    sums = np.cumsum(unzigzag_array(varint_array(data)))
+    value_bounds = np.concatenate(([0], np.cumsum(counts)))
+    values = map(str, (sums - np.repeat(np.concatenate(([0], sums))[value_bounds[:-1]], counts)).tolist())
+    return [values[value_bounds[index]:value_bounds[index + 1]] for index in range(len(packed_arrays))]
+
+
+# The text of every value of a column of metadata, where many nodes have the same value (the same version, user,
+# changeset...): every distinct value is formatted once
+def format_column(values, format_function):
+    distinct_values, indexes = np.unique(values, return_inverse = True)
+    texts = map(format_function, distinct_values.tolist())
+    if len(indexes) == 1:
+        return [texts[indexes[0]]]
+    return list(itemgetter(*indexes.tolist())(texts))
+
+
+# The strings of the string table are given like cElementTree gives the XML attributes: a str when they are ASCII, and
+# a unicode string otherwise
+def decode_string(data):
+    text = bytes(data)
+    try:
+        text.decode("ascii")
+        return text
+    except UnicodeDecodeError:
+        return text.decode("utf-8")
+
+
+# Reading the file
+
+# The blobs of a PBF file, as (type, offset, size) tuples
+def blob_positions(filename):
+    positions = []
+    with open(filename, "rb") as pbf_file:
+        while True:
+            length = pbf_file.read(4)
+            if not length:
+                break
+
+            blob_type = None
+            size = 0
+            for number, value in iterate_fields(bytearray(pbf_file.read(struct.unpack(">I", length)[0]))):
+                if number == 1:
+                    blob_type = bytes(value)
+                elif number == 3:
+                    size = value
+
+            positions.append((blob_type, pbf_file.tell(), size))
+            pbf_file.seek(size, 1)
+    return positions
+
+
+# The decompressed content of a blob
+def read_blob(filename, offset, size):
+    with open(filename, "rb") as pbf_file:
+        pbf_file.seek(offset)
+        blob = bytearray(pbf_file.read(size))
+
+    for number, value in iterate_fields(blob):
+        if number == 1:
+            return value
+        if number == 3:
+            return bytearray(zlib.decompress(bytes(value)))
+    raise ValueError("Unsupported blob compression (only raw and zlib blobs can be read)")
+
+
+# Checks the OSMHeader blob, and returns True if it has a bounding box (the <bounds> element of the XML files)
+def read_header(filename, offset, size):
+    has_bounds = False
+    for number, value in iterate_fields(read_blob(filename, offset, size)):
+        if number == 1:
+            has_bounds = True
+        elif number == 4 and bytes(value) not in SUPPORTED_FEATURES:
+            raise ValueError("%s needs the unsupported PBF feature %s" % (filename, bytes(value)))
+    return has_bounds
+
+
+def count_element(tag_count, element):
+    tag_count[element.tag] = tag_count.get(element.tag, 0) + 1
+    for sub_element in element:
+        tag_count[sub_element.tag] = tag_count.get(sub_element.tag, 0) + 1
+
+
+# A PrimitiveBlock: a string table, the scale of the coordinates and timestamps, and groups of elements of one type
+class PrimitiveBlock(object):
+    def __init__(self, data):
+        self.strings = []
+        self.groups = []
+        self.granularity = 100
+        self.date_granularity = 1000
+        self.lat_offset = 0
+        self.lon_offset = 0
+        # The formatted timestamps, as many elements have the same one
+        self.timestamps = {}
+
+        for number, value in iterate_fields(data):
+            if number == 1:
+                self.strings = [decode_string(string) for _, string in iterate_fields(value)]
+            elif number == 2:
+                self.groups.append(value)
+            elif number == 17:
+                self.granularity = value
+            elif number == 18:
+                self.date_granularity = value
+            elif number == 19:
+                self.lat_offset = signed(value)
+            elif number == 20:
+                self.lon_offset = signed(value)
+
+    def timestamp(self, value):
+        text = self.timestamps.get(value)
+        if text is None:
+            text = time.strftime(TIMESTAMP_FORMAT, time.gmtime(value * self.date_granularity // 1000))
+            self.timestamps[value] = text
+        return text
+
+    # The elements of the block whose tag is in tags
+    def elements(self, tags):
+        for group in self.groups:
+            # A group only has elements of one type
+            ways = []
+            for number, value in iterate_fields(group):
+                if number == 2 and "node" in tags:
+                    for element in self.dense_nodes(value):
+                        yield element
+                elif number == 1 and "node" in tags:
+                    yield self.node(value)
+                elif number == 3 and "way" in tags:
+                    ways.append(value)
+                elif number == 4 and "relation" in tags:
+                    yield self.relation(value)
+
+            for element in self.ways(ways):
+                yield element
+
+    # The Info message of a node, way or relation, added to the attributes
+    def add_info(self, attributes, data):
+        for number, value in iterate_fields(data):
+            if number == 1:
+                attributes["version"] = str(value)
+            elif number == 2:
+                attributes["timestamp"] = self.timestamp(signed(value))
+            elif number == 3:
+                attributes["changeset"] = str(signed(value))
+            elif number == 4:
+                attributes["uid"] = str(signed(value))
+            elif number == 5:
+                attributes["user"] = self.strings[value]
+            elif number == 6:
+                attributes["visible"] = "true" if value else "false"
+
+    def add_tags(self, element, keys, values):
+        strings = self.strings
+        for key, value in zip(keys, values):
+            ET.SubElement(element, "tag", {"k" : strings[key], "v" : strings[value]})
+
+    def coordinates(self, latitude, longitude):
+        return (repr((self.lat_offset + self.granularity * latitude) / 1e9),
+                repr((self.lon_offset + self.granularity * longitude) / 1e9))
+
+    def dense_nodes(self, data):
+        ids = latitudes = longitudes = keys_values = info = None
+        for number, value in iterate_fields(data):
+            if number == 1:
+                ids = delta_array(value)
+            elif number == 5:
+                info = value
+            elif number == 8:
+                latitudes = delta_array(value)
+            elif number == 9:
+                longitudes = delta_array(value)
+            elif number == 10:
+                keys_values = varint_array(value).tolist()
+        if ids is None:
+            return
+
+        # The attributes, in one column per attribute, formatted a whole column at a time
+        columns = [("id", map(str, ids.tolist())),
+                   ("lat", map(repr, ((self.lat_offset + self.granularity * latitudes) / 1e9).tolist())),
+                   ("lon", map(repr, ((self.lon_offset + self.granularity * longitudes) / 1e9).tolist()))]
+        if info is not None:
+            for number, value in iterate_fields(info):
+                if number == 1:
+                    columns.append(("version", format_column(varint_array(value), str)))
+                elif number == 2:
+                    columns.append(("timestamp", format_column(delta_array(value), self.timestamp)))
+                elif number == 3:
+                    columns.append(("changeset", format_column(delta_array(value), str)))
+                elif number == 4:
+                    columns.append(("uid", format_column(delta_array(value), str)))
+                elif number == 5:
+                    columns.append(("user", format_column(delta_array(value), self.strings.__getitem__)))
+                elif number == 6:
+                    columns.append(("visible", format_column(varint_array(value),
+                                                             lambda visible: "true" if visible else "false")))
+        names = [name for name, _ in columns]
+
+        strings = self.strings
+        # keys_values holds the keys and values of all the nodes, with a 0 after the ones of every node
+        position = 0
+        for values in izip(*[column for _, column in columns]):
+            element = ET.Element("node", dict(izip(names, values)))
+
+            if keys_values:
+                key = keys_values[position]
+                while key != 0:
+                    ET.SubElement(element, "tag", {"k" : strings[key], "v" : strings[keys_values[position + 1]]})
+                    position += 2
+                    key = keys_values[position]
+                position += 1
+
+            yield element
+
+    def node(self, data):
+        attributes = {}
+        keys = values = ()
+        latitude = longitude = 0
+        for number, value in iterate_fields(data):
+            if number == 1:
+                attributes["id"] = str(unzigzag(value))
+            elif number == 2:
+                keys = varint_list(value)
+            elif number == 3:
+                values = varint_list(value)
+            elif number == 4:
+                self.add_info(attributes, value)
+            elif number == 8:
+                latitude = unzigzag(value)
+            elif number == 9:
+                longitude = unzigzag(value)
+
+        attributes["lat"], attributes["lon"] = self.coordinates(latitude, longitude)
+        element = ET.Element("node", attributes)
+        self.add_tags(element, keys, values)
+        return element
+
+    # The ways of a group. Their node refs, which are most of their data, are decoded all at once.
+    def ways(self, messages):
+        ways = []
+        refs = []
+        for data in messages:
+            attributes = {}
+            keys = values = ()
+            way_refs = b""
+            for number, value in iterate_fields(data):
+                if number == 1:
+                    attributes["id"] = str(signed(value))
+                elif number == 2:
+                    keys = varint_list(value)
+                elif number == 3:
+                    values = varint_list(value)
+                elif number == 4:
+                    self.add_info(attributes, value)
+                elif number == 8:
+                    way_refs = value
+            ways.append((attributes, keys, values))
+            refs.append(way_refs)
+
+        for (attributes, keys, values), way_refs in izip(ways, delta_arrays(refs)):
+            element = ET.Element("way", attributes)
+            for ref in way_refs:
+                ET.SubElement(element, "nd", {"ref" : ref})
+            self.add_tags(element, keys, values)
+            yield element
+
+    def relation(self, data):
+        attributes = {}
+        keys = values = roles = member_ids = member_types = ()
+        for number, value in iterate_fields(data):
+            if number == 1:
+                attributes["id"] = str(signed(value))
+            elif number == 2:
+                keys = varint_list(value)
+            elif number == 3:
+                values = varint_list(value)
+            elif number == 4:
+                self.add_info(attributes, value)
+            elif number == 8:
+                roles = varint_list(value)
+            elif number == 9:
+                member_ids = delta_list(value)
+            elif number == 10:
+                member_types = varint_list(value)
+
+        element = ET.Element("relation", attributes)
+        for member_type, member_id, role in zip(member_types, member_ids, roles):
+            ET.SubElement(element, "member", {"type" : MEMBER_TYPES[member_type], "ref" : str(member_id),
+                                              "role" : self.strings[role]})
+        self.add_tags(element, keys, values)
+        return element
+
+
+# A generator that yields the top level elements of a PBF file whose tag is in tags, like
+# osm_reader.iterate_elements(). If a tag_count dictionary is passed, the count of every tag the XML file would have
+# (except the root) is added to it.
+def iterate_elements(filename, tags = osm_reader.TOP_LEVEL_TAGS, tag_count = None):
+    for blob_type, offset, size in blob_positions(filename):
+        if blob_type == "OSMHeader":
+            if read_header(filename, offset, size) and tag_count is not None:
+                tag_count["bounds"] = tag_count.get("bounds", 0) + 1
+        elif blob_type == "OSMData":
+            for element in PrimitiveBlock(read_blob(filename, offset, size)).elements(tags):
+                if tag_count is not None:
+                    count_element(tag_count, element)
+                yield element
+
+
+# The work done by every process of the pool: decode one blob, shape its elements and count their tags. The result, the
+# data quality events and the counts of the normalization caches are sent back serialized with marshal (see
+# parallel_parse.parse_chunk()).
+def parse_blob(arguments):
+    filename, offset, size, shape_function = arguments
+
+    shaped_elements = []
+    tag_count = {}
+    for element in PrimitiveBlock(read_blob(filename, offset, size)).elements(osm_reader.TOP_LEVEL_TAGS):
+        count_element(tag_count, element)
+        shaped_element = shape_function(element)
+        if shaped_element:
+            shaped_elements.append(shaped_element)
+
+    return marshal.dumps((shaped_elements, tag_count, quality_events.events.take(), normalization_cache.take(), size))
+
+
+# A function that decodes the blobs of a PBF file using a pool of processes, and yields the shaped elements, in the
+# order of the file unless ordered is False (see parallel_parse.parallel_shape()). progress is called with the total
+# size of the blobs done.
+def parallel_shape(filename, shape_function, processes = None, ordered = True, tag_count = None, progress = None):
+    blobs = []
+    for blob_type, offset, size in blob_positions(filename):
+        if blob_type == "OSMHeader":
+            if read_header(filename, offset, size) and tag_count is not None:
+                tag_count["bounds"] = tag_count.get("bounds", 0) + 1
+        elif blob_type == "OSMData":
+            blobs.append((filename, offset, size, shape_function))
+
+    processes = processes or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(processes, normalization_cache.start_worker)
+    try:
+        # At most two blobs per process are decoded and not yet read (see parallel_parse.bounded_imap())
+        results = parallel_parse.bounded_imap(pool, parse_blob, blobs, 2 * processes, ordered)
+
+        done = 0
+        for result in results:
+            shaped_elements, blob_tag_count, blob_events, blob_cache_counts, blob_size = marshal.loads(result)
+            quality_events.events.merge(blob_events)
+            normalization_cache.merge(blob_cache_counts)
+
+            done += blob_size
+            if progress is not None:
+                progress(done)
+
+            if tag_count is not None:
+                for tag, count in blob_tag_count.iteritems():
+                    tag_count[tag] = tag_count.get(tag, 0) + count
+
+            for shaped_element in shaped_elements:
+                yield shaped_element
+
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+# Protocol buffers encoding, for write_pbf()
+
+def encode_varint(value):
+    data = bytearray()
+    while value >= 0x80:
+        data.append((value & 0x7f) | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+
+def zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def varint_field(number, value):
+    return encode_varint(number << 3) + encode_varint(value)
+
+
+def bytes_field(number, data):
+    return encode_varint((number << 3) | 2) + encode_varint(len(data)) + data
+
+
+def packed_field(number, values):
+    return bytes_field(number, b"".join(encode_varint(value) for value in values))
+
+
+def deltas(values):
+    previous = 0
+    encoded = []
+    for value in values:
+        encoded.append(zigzag(value - previous))
+        previous = value
+    return encoded
+
+
+# The string table of a block being written
+class StringTable(object):
+    def __init__(self):
+        self.strings = [b""]
+        self.indexes = {b"": 0}
+
+    def index(self, text):
+        if isinstance(text, unicode):
+            text = text.encode("utf-8")
+        index = self.indexes.get(text)
+        if index is None:
+            index = self.indexes[text] = len(self.strings)
+            self.strings.append(text)
+        return index
+
+    def encode(self):
+        return b"".join(bytes_field(1, text) for text in self.strings)
+
+
+def timestamp_seconds(text):
+    return calendar.timegm(time.strptime(text, TIMESTAMP_FORMAT))
+
+
+def encode_info(attributes, strings):
+    info = b""
+    if "version" in attributes:
+        info += varint_field(1, int(attributes["version"]))
+    if "timestamp" in attributes:
+        info += varint_field(2, timestamp_seconds(attributes["timestamp"]))
+    if "changeset" in attributes:
+        info += varint_field(3, int(attributes["changeset"]))
+    if "uid" in attributes:
+        info += varint_field(4, int(attributes["uid"]))
+    if "user" in attributes:
+        info += varint_field(5, strings.index(attributes["user"]))
+    if "visible" in attributes:
+        info += varint_field(6, attributes["visible"] == "true")
+    return info
+
+
+def encode_tags(element, strings):
+    tags = [(strings.index(tag.attrib["k"]), strings.index(tag.attrib["v"])) for tag in element.iter("tag")]
+    return packed_field(2, [key for key, _ in tags]) + packed_field(3, [value for _, value in tags])
+
+
+# The dense nodes group of a list of nodes. Every node must have the same metadata attributes as the first one.
+def encode_dense_nodes(nodes, strings):
+    def coordinate(node, name):
+        return int(round(float(node.attrib[name]) * 1e7))
+
+    keys_values = []
+    for node in nodes:
+        for tag in node.iter("tag"):
+            keys_values.extend((strings.index(tag.attrib["k"]), strings.index(tag.attrib["v"])))
+        keys_values.append(0)
+
+    attributes = nodes[0].attrib
+    info = b""
+    if "version" in attributes:
+        info += packed_field(1, [int(node.attrib["version"]) for node in nodes])
+    if "timestamp" in attributes:
+        info += packed_field(2, deltas([timestamp_seconds(node.attrib["timestamp"]) for node in nodes]))
+    if "changeset" in attributes:
+        info += packed_field(3, deltas([int(node.attrib["changeset"]) for node in nodes]))
+    if "uid" in attributes:
+        info += packed_field(4, deltas([int(node.attrib["uid"]) for node in nodes]))
+    if "user" in attributes:
+        info += packed_field(5, deltas([strings.index(node.attrib["user"]) for node in nodes]))
+    if "visible" in attributes:
+        info += packed_field(6, [node.attrib["visible"] == "true" for node in nodes])
+
+    dense = packed_field(1, deltas([int(node.attrib["id"]) for node in nodes]))
+    if info:
+        dense += bytes_field(5, info)
+    dense += packed_field(8, deltas([coordinate(node, "lat") for node in nodes]))
+    dense += packed_field(9, deltas([coordinate(node, "lon") for node in nodes]))
+    if any(keys_values):
+        dense += packed_field(10, keys_values)
+    return bytes_field(2, dense)
+
+
+def encode_way(way, strings):
+    data = varint_field(1, int(way.attrib["id"])) + encode_tags(way, strings)
+    data += bytes_field(4, encode_info(way.attrib, strings))
+    data += packed_field(8, deltas([int(nd.attrib["ref"]) for nd in way.iter("nd")]))
+    return bytes_field(3, data)
+
+
+def encode_relation(relation, strings):
+    members = list(relation.iter("member"))
+    data = varint_field(1, int(relation.attrib["id"])) + encode_tags(relation, strings)
+    data += bytes_field(4, encode_info(relation.attrib, strings))
+    data += packed_field(8, [strings.index(member.attrib["role"]) for member in members])
+    data += packed_field(9, deltas([int(member.attrib["ref"]) for member in members]))
+    data += packed_field(10, [MEMBER_TYPES.index(member.attrib["type"]) for member in members])
+    return bytes_field(4, data)
+
+
+def write_blob(pbf_file, blob_type, data):
+    blob = varint_field(2, len(data)) + bytes_field(3, zlib.compress(data))
+    header = bytes_field(1, blob_type) + varint_field(3, len(blob))
+    pbf_file.write(struct.pack(">I", len(header)) + header + blob)
+
+
+# Converts an OSM XML file to a PBF file, with dense nodes, for the tests and the benchmarks. The elements are written
+# in blocks of at most block_size elements of the same type, with the same attributes.
+def write_pbf(xml_filename, pbf_filename, block_size = BLOCK_SIZE):
+    with open(pbf_filename, "wb") as pbf_file:
+        header = bytes_field(4, b"OsmSchema-V0.6") + bytes_field(4, b"DenseNodes")
+        elements = osm_reader.iterate_elements(xml_filename, ("bounds", ) + osm_reader.TOP_LEVEL_TAGS)
+
+        block = []
+        for element in elements:
+            if element.tag == "bounds":
+                # The bounding box comes before the elements
+                bounds = [int(round(float(element.attrib[name]) * 1e9))
+                          for name in ("minlon", "maxlon", "maxlat", "minlat")]
+                header = bytes_field(1, b"".join(varint_field(number, zigzag(value))
+                                                 for number, value in zip((1, 2, 3, 4), bounds))) + header
+                continue
+
+            if pbf_file.tell() == 0:
+                write_blob(pbf_file, b"OSMHeader", header)
+            if block and (block[-1].tag != element.tag or len(block) == block_size or
+                          sorted(block[-1].attrib) != sorted(element.attrib)):
+                write_block(pbf_file, block)
+                block = []
+            # The elements are cleared once consumed, so a copy is kept
+            copy = ET.Element(element.tag, dict(element.attrib))
+            for sub_element in element:
+                ET.SubElement(copy, sub_element.tag, dict(sub_element.attrib))
+            block.append(copy)
+
+        if pbf_file.tell() == 0:
+            write_blob(pbf_file, b"OSMHeader", header)
+        if block:
+            write_block(pbf_file, block)
+
+
+def write_block(pbf_file, elements):
+    strings = StringTable()
+    if elements[0].tag == "node":
+        group = encode_dense_nodes(elements, strings)
+    elif elements[0].tag == "way":
+        group = b"".join(encode_way(way, strings) for way in elements)
+    else:
+        group = b"".join(encode_relation(relation, strings) for relation in elements)
+
+    write_blob(pbf_file, b"OSMData", bytes_field(1, strings.encode()) + bytes_field(2, group))
+
+
+# The time taken by the XML and PBF readers to read the same file, alone and with shape_element()
+def compare_timings(xml_filename):
+    from Montreal_data_processing import shape_element
+
+    pbf_filename = xml_filename + ".pbf"
+    write_pbf(xml_filename, pbf_filename)
+    for name, read in [("XML", osm_reader.iterate_elements), ("PBF", iterate_elements)]:
+        start = time.time()
+        count = sum(1 for _ in read(xml_filename if name == "XML" else pbf_filename))
+        read_time = time.time() - start
+
+        start = time.time()
+        for element in read(xml_filename if name == "XML" else pbf_filename):
+            shape_element(element)
+        print "%s: %d elements read in %.2f s (%.0f elements/s), %.2f s with shape_element()" % \
+              (name, count, read_time, count / read_time, time.time() - start)
+
+
+def test():
+    import os
+    import shutil
+    import tempfile
+
+    from Montreal_data_processing import shape_element
+
+    directory = tempfile.mkdtemp()
+    try:
+        xml_filename = os.path.join(directory, "map.osm")
+        osm_reader.write_test_file(xml_filename, 3000)
+        # A few more elements: non-ASCII text, a relation, a node without tags among the dense nodes, visible
+        with open(xml_filename, "rb") as xml_file:
+            data = xml_file.read().replace(b"</osm>\n", b"")
+        with open(xml_filename, "wb") as xml_file:
+            xml_file.write(data + u'''
+ <node id="9000000001" version="3" changeset="7" timestamp="2016-05-01T12:30:00Z" user="Éric" uid="42" lat="45.5" lon="-73.6" visible="true">
+  <tag k="name" v="Café Olimpico"/>
+  <tag k="addr:street" v="Rue Saint-Viateur Ouest"/>
+  <tag k="contact:phone" v="+1 514 495 0746"/>
+ </node>
+ <node id="9000000002" version="1" changeset="8" timestamp="2016-05-02T12:30:00Z" user="bob" uid="12" lat="-0.0000001" lon="0.0000001" visible="true"/>
+ <relation id="5" version="1" changeset="9" timestamp="2016-05-03T12:30:00Z" user="bob" uid="12">
+  <member type="way" ref="2" role="outer"/>
+  <member type="node" ref="9000000001" role=""/>
+  <tag k="type" v="multipolygon"/>
+ </relation>
+</osm>
+'''.encode("utf-8"))
+
+        pbf_filename = os.path.join(directory, "map.osm.pbf")
+        # Small blocks, so the file has several blocks of each type
+        write_pbf(xml_filename, pbf_filename, block_size = 700)
+        assert osm_reader.is_pbf(pbf_filename) and not osm_reader.is_pbf(xml_filename)
+
+        # The coordinates are compared as numbers, as the text can differ ("45.5020" in the XML, "45.502" here)
+        def element_tuple(element):
+            attributes = dict(element.attrib)
+            for name in ("lat", "lon"):
+                if name in attributes:
+                    attributes[name] = float(attributes[name])
+            return (element.tag, attributes, [(sub_element.tag, sub_element.attrib) for sub_element in element])
+
+        xml_tag_count = {}
+        pbf_tag_count = {}
+        xml_elements = [element_tuple(element) for element in osm_reader.iterate_elements(xml_filename,
+                                                                                          tag_count = xml_tag_count)]
+        pbf_elements = [element_tuple(element) for element in iterate_elements(pbf_filename,
+                                                                               tag_count = pbf_tag_count)]
+        assert len(pbf_elements) == 3303
+        assert pbf_elements == xml_elements
+        assert pbf_tag_count == xml_tag_count
+
+        # The same documents, read serially through osm_reader or in parallel
+        expected = [shape_element(element) for element in osm_reader.iterate_elements(xml_filename)]
+        expected = [element for element in expected if element]
+        assert [shape_element(element) for element in osm_reader.iterate_elements(pbf_filename)
+                if element.tag != "relation"] == expected
+        tag_count = {}
+        assert list(parallel_shape(pbf_filename, shape_element, processes = 2, tag_count = tag_count)) == expected
+        assert tag_count == xml_tag_count
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+
+# Metrics of the stages of the pipeline (loading the map, cleaning the phone numbers and the addresses, computing the
+# statistics), so that the runs can be compared and the regressions caught. For every stage:
+#   - the time spent in each of its phases (parse, shape, clean, serialize, write...). The phases are timed exclusively:
+#     the time of a phase timed inside another one (the shaping of an element while the file is parsed) is only counted
+#     in the inner one, so the phases add up to the time of the stage.
+#   - the number of items processed (elements or documents) and their rate
+#   - the latency percentiles of the database writes
+#   - the peak resident memory of the process (and of its worker processes) at the end of the stage
+# While the map is loaded, the progress is printed after every batch, with an ETA computed from the byte offset reached
+# in the map file. The metrics of all the stages are written to a JSON summary at the end of the run.
+
+import datetime
+import json
+import math
+import os
+import time
+
+import compressed_input
+import osm_reader
+
+
+# The percentiles of the write latencies in the summary
+LATENCY_PERCENTILES = (50, 90, 99)
+
+# Used by StageMetrics.iterate() to tell the end of the items
+STOP = object()
+
+
+# The value below which the given percentage of the sorted values fall (nearest rank), or None if there are none
+def percentile(sorted_values, percentage):
+    if not sorted_values:
+        return None
+    rank = int(math.ceil(percentage / 100.0 * len(sorted_values))) - 1
+    return sorted_values[max(rank, 0)]
+
+
+def format_duration(seconds):
+    return str(datetime.timedelta(seconds = int(seconds)))
+
+
+# The peak resident memory of the finished worker processes (of a parallel parse...), in MB
+def children_peak_rss_mb():
+    if osm_reader.resource is None:
+        return None
+    resource = osm_reader.resource
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0
+
+
+def peak_rss_mb():
+    if osm_reader.resource is None:
+        return None
+    return osm_reader.peak_rss_mb()
+
+
+# The size of a map file the progress can be followed in: an uncompressed XML file (read through a ProgressFile) or a
+# PBF file (whose blobs are read by offset). None for a compressed file.
+def input_size(filename):
+    if compressed_input.compression(filename):
+        return None
+    return os.path.getsize(filename)
+
+
+# A file object that moves the position of a stage forward as the file is read, so the progress of the parser in the map
+# file is known
+class ProgressFile(object):
+    def __init__(self, filename, stage):
+        self.file = open(filename, "rb")
+        self.stage = stage
+
+    def read(self, size = -1):
+        data = self.file.read(size)
+        self.stage.position += len(data)
+        if not data:
+            self.file.close()
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+# What to parse for a map file: a ProgressFile for an uncompressed XML file, and the file name for the other ones
+def progress_source(filename, stage):
+    if compressed_input.compression(filename) or osm_reader.is_pbf(filename):
+        return filename
+    return ProgressFile(filename, stage)
+
+
+class StageMetrics(object):
+    def __init__(self, name, unit = "elements", total_bytes = None):
+        self.name = name
+        self.unit = unit
+        self.total_bytes = total_bytes
+
+        self.start = time.time()
+        self.end = None
+
+        # The exclusive time of every phase, and the time of all the phases timed so far, used to find the time of the
+        # phases timed inside another one
+        self.phases = {}
+        self.timed_seconds = 0.0
+
+        self.items = 0
+        self.latencies = []
+
+        # The byte offset reached in the input, and the one the stage started from (a resumed load starts in the middle
+        # of the file)
+        self.position = 0
+        self.start_position = 0
+
+        self.peak_rss_mb = None
+        self.children_peak_rss_mb = None
+
+    def add_time(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def start_timer(self):
+        return time.time(), self.timed_seconds
+
+    # Adds the time since start_timer() to phase, except the time of the phases timed in between
+    def stop_timer(self, phase, timer):
+        start, timed_before = timer
+        elapsed = time.time() - start
+        self.phases[phase] = self.phases.get(phase, 0.0) + elapsed - (self.timed_seconds - timed_before)
+        self.timed_seconds = timed_before + elapsed
+        return elapsed
+
+    # Calls function and adds its time to phase
+    def call(self, phase, function, *arguments, **keywords):
+        timer = self.start_timer()
+        try:
+            return function(*arguments, **keywords)
+        finally:
+            self.stop_timer(phase, timer)
+
+    # Returns a function calling the one passed, and adding its time to phase. It is called for every element, so the
+    # timer is inlined.
+    def timed(self, phase, function):
+        clock = time.time
+        phases = self.phases
+        phases.setdefault(phase, 0.0)
+
+        def timed_function(*arguments):
+            start = clock()
+            timed_before = self.timed_seconds
+            result = function(*arguments)
+            elapsed = clock() - start
+            phases[phase] += elapsed - (self.timed_seconds - timed_before)
+            self.timed_seconds = timed_before + elapsed
+            return result
+        return timed_function
+
+    # Returns a function calling a database write, adding its time to the write phase and its latency to the latencies
+    def timed_write(self, function):
+        def timed_function(*arguments, **keywords):
+            timer = self.start_timer()
+            try:
+                return function(*arguments, **keywords)
+            finally:
+                self.latencies.append(self.stop_timer("write", timer))
+        return timed_function
+
+    # Yields the items of an iterable, adding the time spent waiting for them to phase
+    def iterate(self, phase, iterable):
+        clock = time.time
+        phases = self.phases
+        phases.setdefault(phase, 0.0)
+
+        iterator = iter(iterable)
+        while True:
+            start = clock()
+            timed_before = self.timed_seconds
+            item = next(iterator, STOP)
+            elapsed = clock() - start
+            phases[phase] += elapsed - (self.timed_seconds - timed_before)
+            self.timed_seconds = timed_before + elapsed
+            if item is STOP:
+                return
+            yield item
+
+    # Used as the progress callback of the parallel parse, and of the checkpointed load
+    def set_position(self, position):
+        self.position = position
+
+    def elapsed(self):
+        return (self.end or time.time()) - self.start
+
+    # Prints the items processed so far, their rate, and the ETA if the position in the input is known
+    def report_progress(self):
+        elapsed = self.elapsed()
+        line = "%s: %d %s, %.0f %s/s" % (self.name, self.items, self.unit, self.items / max(elapsed, 1e-9), self.unit)
+
+        done = self.position - self.start_position
+        if self.total_bytes and done > 0:
+            remaining = elapsed * (self.total_bytes - self.position) / done
+            line += ", %.1f%% of the input, ETA %s" % (100.0 * self.position / self.total_bytes,
+                                                         format_duration(remaining))
+        print line
+
+    def finish(self):
+        self.end = time.time()
+        self.peak_rss_mb = peak_rss_mb()
+        self.children_peak_rss_mb = children_peak_rss_mb()
+
+    def summary(self):
+        elapsed = self.elapsed()
+        latencies = sorted(self.latencies)
+        write_latency = dict(("p%d" % percentage, percentile(latencies, percentage))
+                             for percentage in LATENCY_PERCENTILES)
+        write_latency["max"] = latencies[-1] if latencies else None
+
+        return {"stage" : self.name, "unit" : self.unit, "seconds" : elapsed, "items" : self.items,
+                "items_per_second" : self.items / max(elapsed, 1e-9), "phases" : self.phases,
+                "input_bytes" : self.position - self.start_position, "total_input_bytes" : self.total_bytes,
+                "writes" : len(latencies), "write_latency" : write_latency, "peak_rss_mb" : self.peak_rss_mb,
+                "children_peak_rss_mb" : self.children_peak_rss_mb}
+
+    # Prints the time of the stage and of its phases
+    def report(self):
+        phases = ", ".join("%s %.1f s" % (phase, seconds) for phase, seconds in
+                           sorted(self.phases.iteritems(), key = lambda item: -item[1]))
+        print "%s finished: %d %s in %.1f s (%.0f %s/s): %s" % \
+              (self.name, self.items, self.unit, self.elapsed(), self.items / max(self.elapsed(), 1e-9), self.unit,
+               phases)
+
+        latencies = sorted(self.latencies)
+        if latencies:
+            print "%s: %d writes, latency p50 %.3f s, p90 %.3f s, p99 %.3f s, max %.3f s" % \
+                  ((self.name, len(latencies)) + tuple(percentile(latencies, percentage)
+                                                       for percentage in LATENCY_PERCENTILES) + (latencies[-1], ))
+        if self.peak_rss_mb is not None:
+            print "%s: peak RSS %.0f MB" % (self.name, self.peak_rss_mb)
+
+
+# The metrics of a whole run, stage by stage
+class RunMetrics(object):
+    def __init__(self):
+        self.start = time.time()
+        self.stages = []
+
+    def stage(self, name, unit = "elements", total_bytes = None):
+        stage = StageMetrics(name, unit, total_bytes)
+        self.stages.append(stage)
+        return stage
+
+    def summary(self):
+        return {"started" : datetime.datetime.utcfromtimestamp(self.start).isoformat() + "Z",
+                "seconds" : time.time() - self.start, "peak_rss_mb" : peak_rss_mb(),
+                "children_peak_rss_mb" : children_peak_rss_mb(),
+                "stages" : [stage.summary() for stage in self.stages]}
+
+    def write_summary(self, filename):
+        with open(filename, "w") as summary_file:
+            json.dump(self.summary(), summary_file, indent = 2, sort_keys = True)
+
+
+# The metrics of the current run
+run = RunMetrics()
+
+
+# Starts the metrics of a new run
+def configure():
+    global run
+    run = RunMetrics()
+    return run
+
+
+def stage(name, unit = "elements", total_bytes = None):
+    return run.stage(name, unit, total_bytes)
+
+
+def test():
+    import shutil
+    import tempfile
+
+    metrics = RunMetrics()
+    stage = metrics.stage("Test", "elements", 1000)
+
+    # Exclusive phases: the inner sleep is only counted in shape
+    shape = stage.timed("shape", lambda item: time.sleep(0.01) or item)
+
+    def parse():
+        for number in range(5):
+            time.sleep(0.002)
+            yield shape(number)
+
+    items = list(stage.iterate("parse", parse()))
+    assert items == range(5)
+    assert 0.05 <= stage.phases["shape"] < 0.1
+    assert 0.01 <= stage.phases["parse"] < 0.04
+
+    write = stage.timed_write(lambda documents, ordered = True: len(documents))
+    assert write([1, 2, 3], ordered = False) == 3
+    assert len(stage.latencies) == 1 and "write" in stage.phases
+
+    assert percentile([1, 2, 3, 4], 50) == 2 and percentile([1, 2, 3, 4], 99) == 4 and percentile([], 50) is None
+
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, "map.osm")
+        osm_reader.write_test_file(filename, 1000)
+        stage.total_bytes = input_size(filename)
+        elements = list(osm_reader.iterate_elements(progress_source(filename, stage)))
+        assert stage.position == stage.total_bytes
+        stage.items = len(elements)
+        stage.report_progress()
+        stage.finish()
+        stage.report()
+
+        summary_filename = os.path.join(directory, "metrics.json")
+        metrics.write_summary(summary_filename)
+        with open(summary_filename) as summary_file:
+            summary = json.load(summary_file)
+        assert summary["stages"][0]["items"] == 1100
+        assert summary["stages"][0]["input_bytes"] == os.path.getsize(filename)
+        assert set(summary["stages"][0]["write_latency"]) == set(["p50", "p90", "p99", "max"])
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    test()
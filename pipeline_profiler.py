@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+# A profiling mode for the stages of the pipeline ("load", "phone_cleanup", "address_cleanup"), switched on per stage
+# with configure(), instead of wrapping cProfile around the calls at the bottom of Montreal_data_processing.py.
+# For a profiled stage:
+#   - cProfile runs during the batches of the stage, and its statistics are saved to <stage>.prof, which can be opened
+#     with snakeviz or pstats, with the top functions written to <stage>.txt
+#   - if memory is set to true, a tracemalloc snapshot is taken at the end of the profiled batches and saved to
+#     <stage>.batch<number>.snapshot (tracemalloc.Snapshot.load() reads it back), and the lines allocating the most
+#     (in shape_element(), the cleaners...), and the growth since the first batch, are written to <stage>.memory.txt
+# To keep the overhead low on a long run, only every Nth batch can be profiled (sample_every).
+# cProfile only sees the thread it runs in, so the inserts of the background writers (see pipelined_ingest.py) are not
+# in the profile. tracemalloc is part of Python 3.4 and later; with an older Python, it needs the pytracemalloc backport,
+# and without it the memory is not traced.
+
+import cProfile
+import os
+import pstats
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+PROFILE_DIRECTORY = "profiles"
+
+# The number of functions and lines in the text reports
+REPORT_LINES = 30
+
+# The number of frames kept for every allocation
+TRACEMALLOC_FRAMES = 10
+
+# The profiling settings, see configure()
+profiled_stages = set()
+profile_directory = PROFILE_DIRECTORY
+sample_every = 1
+trace_memory = False
+
+
+class StageProfiler(object):
+    def __init__(self, name, directory = PROFILE_DIRECTORY, every = 1, memory = False, enabled = True):
+        self.name = name
+        self.directory = directory
+        self.every = max(every, 1)
+        self.memory = memory
+        self.enabled = enabled
+
+        self.profile = None
+        self.batch_number = 0
+        self.started_tracing = False
+        self.first_snapshot = None
+        self.last_snapshot = None
+
+    def path(self, suffix):
+        return os.path.join(self.directory, self.name + suffix)
+
+    def sampled(self):
+        return self.batch_number % self.every == 0
+
+    def start(self):
+        if not self.enabled:
+            return
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        if self.memory and tracemalloc is None:
+            print "tracemalloc is not available, the memory of %s is not traced" % self.name
+            self.memory = False
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            self.started_tracing = True
+
+        self.profile = cProfile.Profile()
+        if self.sampled():
+            self.profile.enable()
+
+    # Called after every batch of the stage
+    def batch_done(self):
+        if not self.enabled:
+            return
+        if self.sampled():
+            self.profile.disable()
+            if self.memory:
+                self.take_snapshot()
+
+        self.batch_number += 1
+        if self.sampled():
+            self.profile.enable()
+
+    def take_snapshot(self):
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>")])
+        snapshot.dump(self.path(".batch%06d.snapshot" % self.batch_number))
+
+        if self.first_snapshot is None:
+            self.first_snapshot = snapshot
+        self.last_snapshot = snapshot
+
+    # Called at the end of the stage: saves the profile, and the memory report
+    def finish(self):
+        if not self.enabled:
+            return
+        # The last batch, not followed by batch_done()
+        if self.sampled():
+            self.profile.disable()
+            if self.memory:
+                self.take_snapshot()
+
+        self.profile.dump_stats(self.path(".prof"))
+        with open(self.path(".txt"), "w") as report:
+            stats = pstats.Stats(self.path(".prof"), stream = report)
+            stats.sort_stats("cumulative").print_stats(REPORT_LINES)
+            stats.sort_stats("tottime").print_stats(REPORT_LINES)
+
+        if self.memory:
+            self.write_memory_report()
+            if self.started_tracing:
+                tracemalloc.stop()
+
+        print "Profile of %s (every %d batches) written to %s" % (self.name, self.every, self.path(".prof"))
+
+    def write_memory_report(self):
+        with open(self.path(".memory.txt"), "w") as report:
+            report.write("Largest allocations at the end of %s, by line:\n" % self.name)
+            for statistic in self.last_snapshot.statistics("lineno")[:REPORT_LINES]:
+                report.write("%s\n" % statistic)
+
+            report.write("\nGrowth since the first profiled batch, by line:\n")
+            for statistic in self.last_snapshot.compare_to(self.first_snapshot, "lineno")[:REPORT_LINES]:
+                report.write("%s\n" % statistic)
+
+            report.write("\nLargest allocations by traceback:\n")
+            for statistic in self.last_snapshot.statistics("traceback")[:5]:
+                report.write("%s\n" % statistic)
+                for line in statistic.traceback.format():
+                    report.write("%s\n" % line)
+
+
+# Sets the stages to profile, where to save the profiles, how often to profile a batch and whether to trace the memory
+def configure(stages = (), directory = PROFILE_DIRECTORY, every = 1, memory = False):
+    global profiled_stages, profile_directory, sample_every, trace_memory
+    profiled_stages = set(stages)
+    profile_directory = directory
+    sample_every = every
+    trace_memory = memory
+
+
+# The profiler of a stage, which does nothing if the stage is not profiled
+def stage_profiler(name):
+    return StageProfiler(name, profile_directory, sample_every, trace_memory, name in profiled_stages)
+
+
+def test():
+    import shutil
+    import tempfile
+
+    def batch_work(size):
+        return sorted(str(number) for number in range(size))
+
+    directory = tempfile.mkdtemp()
+    try:
+        configure(["test"], directory, every = 3, memory = tracemalloc is not None)
+        assert not stage_profiler("other").enabled
+
+        profiler = stage_profiler("test")
+        profiler.start()
+        for _ in range(10):
+            batch_work(2000)
+            profiler.batch_done()
+        profiler.finish()
+
+        stats = pstats.Stats(os.path.join(directory, "test.prof"))
+        calls = [(function, stat[0]) for function, stat in stats.stats.iteritems() if function[2] == "batch_work"]
+        # Batches 0, 3, 6 and 9 were profiled
+        assert len(calls) == 1 and calls[0][1] == 4
+        assert os.path.exists(os.path.join(directory, "test.txt"))
+
+        if tracemalloc is not None:
+            snapshots = [name for name in os.listdir(directory) if name.endswith(".snapshot")]
+            assert len(snapshots) == 4
+            tracemalloc.Snapshot.load(os.path.join(directory, snapshots[0]))
+            assert os.path.exists(os.path.join(directory, "test.memory.txt"))
+    finally:
+        configure()
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    test()
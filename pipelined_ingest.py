@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+# A background writer, so that the parsing does not stop while a batch is inserted.
+# The parser hands the documents to the writer, which encodes them to BSON right away (so their exact size is known and
+# they are not encoded a second time by insert_many), groups them into batches, and puts the batches in a bounded queue.
+# One or more writer threads take the batches from the queue and insert them, unordered. When the queue is full, the
+# parser waits (backpressure), so the memory stays bounded when the database is slower than the parser.
+# The size of the batches, in bytes, adapts to the measured insert latency: it grows while the inserts are fast, and
+# shrinks when they get slow.
+
+import threading
+import time
+from Queue import Queue
+
+import bson
+from bson.raw_bson import RawBSONDocument
+
+
+# The batch size limits, in bytes. MongoDB accepts messages of up to 48 MB.
+MIN_BATCH_BYTES = 256 * 1024
+INITIAL_BATCH_BYTES = 4 * 1024 * 1024
+MAX_BATCH_BYTES = 32 * 1024 * 1024
+
+# The insert latency aimed at, in seconds. Long enough to amortize the round trip, short enough for the parser and the
+# writers to overlap well.
+TARGET_LATENCY = 0.5
+
+# Used to tell the writer threads to stop
+STOP = None
+
+
+class BackgroundWriter(object):
+    def __init__(self, collection, writers = 1, queue_size = 4, target_latency = TARGET_LATENCY):
+        self.collection = collection
+        self.target_latency = target_latency
+        self.batch_bytes = INITIAL_BATCH_BYTES
+
+        # The batch being filled by the parser
+        self.batch = []
+        self.current_bytes = 0
+
+        self.queue = Queue(maxsize = queue_size)
+        self.lock = threading.Lock()
+        self.errors = []
+
+        # Statistics
+        self.inserted_documents = 0
+        self.inserted_bytes = 0
+        self.latencies = []
+        self.backpressure_wait = 0.0
+
+        self.threads = [threading.Thread(target = self.run, name = "writer-%d" % number) for number in range(writers)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    # Called by the parser with a list of documents
+    def write(self, documents):
+        if self.errors:
+            raise self.errors[0]
+
+        for document in documents:
+            raw = RawBSONDocument(bson.BSON.encode(document))
+            self.batch.append(raw)
+            self.current_bytes += len(raw.raw)
+
+            if self.current_bytes >= self.batch_bytes:
+                self.flush()
+
+    def flush(self):
+        if not self.batch:
+            return
+
+        start = time.time()
+        # Blocks while the queue is full
+        self.queue.put((self.batch, self.current_bytes))
+        self.backpressure_wait += time.time() - start
+
+        self.batch = []
+        self.current_bytes = 0
+
+    # The loop of the writer threads
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is STOP:
+                    return
+
+                batch, batch_bytes = item
+                if self.errors:
+                    # Drain the queue, so the parser is never blocked after an error
+                    continue
+
+                start = time.time()
+                try:
+                    self.collection.insert_many(batch, ordered = False)
+                except Exception, e:
+                    self.errors.append(e)
+                    continue
+
+                self.adapt(batch_bytes, time.time() - start, len(batch))
+            finally:
+                self.queue.task_done()
+
+    # Adapts the batch size to the latency of the last insert
+    def adapt(self, batch_bytes, latency, document_count):
+        with self.lock:
+            self.inserted_documents += document_count
+            self.inserted_bytes += batch_bytes
+            self.latencies.append(latency)
+
+            if latency > self.target_latency:
+                self.batch_bytes = max(MIN_BATCH_BYTES, int(self.batch_bytes * 0.7))
+            elif latency < self.target_latency / 2 and batch_bytes >= self.batch_bytes:
+                self.batch_bytes = min(MAX_BATCH_BYTES, int(self.batch_bytes * 1.5))
+
+    # Sends the last batch, waits for all the inserts to finish, and stops the writer threads
+    def close(self):
+        self.flush()
+        for _ in self.threads:
+            self.queue.put(STOP)
+        for thread in self.threads:
+            thread.join()
+
+        if self.errors:
+            raise self.errors[0]
+
+    def report(self):
+        latencies = sorted(self.latencies)
+        median = latencies[len(latencies) / 2] if latencies else 0.0
+        print "Background writer: %d documents (%.1f MB) in %d batches, median insert latency %.3f s, " \
+              "final batch size %.1f MB, parser waited %.1f s for the writers" % \
+              (self.inserted_documents, self.inserted_bytes / (1024.0 * 1024.0), len(latencies), median,
+               self.batch_bytes / (1024.0 * 1024.0), self.backpressure_wait)
+
+
+def test():
+    # A fake collection, slow enough for the queue to fill up
+    class SlowCollection(object):
+        def __init__(self):
+            self.documents = []
+            self.lock = threading.Lock()
+
+        def insert_many(self, documents, ordered = True):
+            time.sleep(0.01)
+            with self.lock:
+                self.documents.extend(bson.BSON(document.raw).decode() for document in documents)
+
+    collection = SlowCollection()
+    writer = BackgroundWriter(collection, writers = 2, queue_size = 2, target_latency = 0.005)
+    # Start with tiny batches, to see them adapt
+    writer.batch_bytes = MIN_BATCH_BYTES / 64
+
+    documents = [{"id" : str(number), "type" : "node", "pos" : [45.5, -73.6]} for number in range(20000)]
+    for start in range(0, len(documents), 1000):
+        writer.write(documents[start:start + 1000])
+    writer.close()
+
+    assert sorted(int(document["id"]) for document in collection.documents) == range(20000)
+    assert writer.inserted_documents == 20000
+    # The inserts were slower than the target, so the batches shrank to the minimum
+    assert writer.batch_bytes == MIN_BATCH_BYTES
+
+    # A map loaded through the background writers gives the same documents as the serial inserts
+    import os
+    import shutil
+    import tempfile
+
+    import Montreal_data_processing as processing
+    import storage_backend
+    import synthetic_map
+
+    previous_backend = storage_backend.active_backend
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, "test.osm")
+        synthetic_map.write_synthetic_map(filename, 2000)
+        storage_backend.select_backend("sqlite", directory = os.path.join(directory, "db"))
+
+        for collection_name, pipelined in (("serial", False), ("pipelined", True)):
+            processing.insert_xml_map_to_db(filename, "test", collection_name, True, clean_on_ingest = True,
+                                            way_geometry = True, pipelined = pipelined, writers = 2, batch_size = 500)
+
+        client = storage_backend.connect()
+        loaded = {}
+        for collection_name in ("serial", "pipelined"):
+            loaded[collection_name] = sorted((dict((key, value) for key, value in document.iteritems() if key != "_id")
+                                              for document in client["test"][collection_name].find()),
+                                             key = lambda document: (document["type"], int(document["id"])))
+        client.close()
+        assert len(loaded["serial"]) == 2285
+        assert loaded["pipelined"] == loaded["serial"]
+    finally:
+        storage_backend.select_backend(previous_backend.name, **vars(previous_backend))
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+# A sink for the data quality events found while shaping and cleaning the map (a corrupt phone number, a problematic
+# attribute, an abbreviation expanded...), instead of printing a line for every record. The printing cost a significant
+# share of the time of a full run, and could not be analysed afterwards.
+# Every event has a code (the constants below). The sink counts the events by code, and keeps the details of the first
+# sample_size events of every code as examples. write_report() writes them to a JSONL file, one line per code, once the
+# run is finished. Nothing is printed while the events are recorded, unless echo is set to true.
+# The worker processes of a parallel parse have their own sink: parallel_parse.py takes their events with every chunk
+# and merges them into the sink of the main process.
+# The normalization functions only record their events when their result is not cached (see normalization_cache.py), so
+# with the normalization caches, their events are counted once per distinct value.
+
+import json
+
+
+# How many examples are kept for every event code
+DEFAULT_SAMPLE_SIZE = 5
+
+# The event codes
+PROBLEMATIC_ATTRIBUTE = "problematic_attribute"
+UNEXPECTED_DATA_TYPE = "unexpected_data_type"
+CORRUPT_PHONE = "corrupt_phone"
+PHONE_WITHOUT_AREA_CODE = "phone_without_area_code"
+NO_VALID_PHONE = "no_valid_phone"
+CORRUPT_POSTCODE = "corrupt_postcode"
+LONG_ADDRESS = "long_address"
+NO_VALID_ADDRESS = "no_valid_address"
+ABBREVIATION_EXPANDED = "abbreviation_expanded"
+
+EVENT_DESCRIPTIONS = {
+    PROBLEMATIC_ATTRIBUTE : "An attribute contains a problematic character, skipped",
+    UNEXPECTED_DATA_TYPE : "Unexpected type for a field, not cleaned",
+    CORRUPT_PHONE : "Corrupt phone number",
+    PHONE_WITHOUT_AREA_CODE : "Phone number without an area code, or with an area code not equal to 3 digits",
+    NO_VALID_PHONE : "No valid phone number found, phone field removed",
+    CORRUPT_POSTCODE : "Corrupt postal code",
+    LONG_ADDRESS : "Potentially long address in a street name",
+    NO_VALID_ADDRESS : "No valid address found, address field removed",
+    ABBREVIATION_EXPANDED : "French abbreviation expanded in a street name",
+}
+
+
+class QualityEvents(object):
+    def __init__(self, sample_size = DEFAULT_SAMPLE_SIZE, echo = False):
+        self.sample_size = sample_size
+        self.echo = echo
+
+        # The number of events of every code, and the details of the first ones
+        self.counts = {}
+        self.samples = {}
+
+    def record(self, code, **details):
+        count = self.counts.get(code, 0) + 1
+        self.counts[code] = count
+        if count <= self.sample_size:
+            self.samples.setdefault(code, []).append(details)
+
+        if self.echo:
+            print "%s: %s" % (EVENT_DESCRIPTIONS.get(code, code), details)
+
+    # Returns the events recorded since the last call, as plain dictionaries that can be sent between processes, and
+    # starts over
+    def take(self):
+        state = (self.counts, self.samples)
+        self.counts = {}
+        self.samples = {}
+        return state
+
+    # Adds the events returned by take() on another sink
+    def merge(self, state):
+        counts, samples = state
+        for code, count in counts.iteritems():
+            self.counts[code] = self.counts.get(code, 0) + count
+        for code, details in samples.iteritems():
+            code_samples = self.samples.setdefault(code, [])
+            code_samples.extend(details[:self.sample_size - len(code_samples)])
+
+    # Writes the events to a JSONL file: one line per code, with its description, its count and the examples kept. The
+    # values JSON has no type for (an ObjectId, a datetime...) are written as strings.
+    def write_report(self, filename):
+        with open(filename, "w") as report_file:
+            for code in sorted(self.counts):
+                report_file.write(json.dumps({"code" : code, "description" : EVENT_DESCRIPTIONS.get(code, code),
+                                              "count" : self.counts[code],
+                                              "samples" : self.samples.get(code, [])}, default = str) + "\n")
+
+    # Prints the count of every code
+    def report(self):
+        for code in sorted(self.counts):
+            print "%s: %d" % (EVENT_DESCRIPTIONS.get(code, code), self.counts[code])
+
+
+# The sink the events are recorded to
+events = QualityEvents()
+
+
+# Replaces the sink by a new, empty one
+def configure(sample_size = DEFAULT_SAMPLE_SIZE, echo = False):
+    global events
+    events = QualityEvents(sample_size, echo)
+    return events
+
+
+def record(code, **details):
+    events.record(code, **details)
+
+
+def test():
+    import os
+    import shutil
+    import tempfile
+
+    sink = QualityEvents(sample_size = 2)
+    for number in range(5):
+        sink.record(CORRUPT_PHONE, value = "555-%d" % number)
+    sink.record(LONG_ADDRESS, street = "Rue Sherbrooke, Montreal")
+    assert sink.counts == {CORRUPT_PHONE : 5, LONG_ADDRESS : 1}
+    assert sink.samples[CORRUPT_PHONE] == [{"value" : "555-0"}, {"value" : "555-1"}]
+
+    # The events of another process
+    worker = QualityEvents(sample_size = 2)
+    worker.record(CORRUPT_PHONE, value = "555-9")
+    worker.record(CORRUPT_POSTCODE, value = "H2X")
+    sink.merge(worker.take())
+    assert worker.counts == {}
+    assert sink.counts == {CORRUPT_PHONE : 6, LONG_ADDRESS : 1, CORRUPT_POSTCODE : 1}
+    assert len(sink.samples[CORRUPT_PHONE]) == 2
+
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, "quality_events.jsonl")
+        sink.write_report(filename)
+        with open(filename) as report_file:
+            lines = [json.loads(line) for line in report_file]
+        assert [line["code"] for line in lines] == [CORRUPT_PHONE, CORRUPT_POSTCODE, LONG_ADDRESS]
+        assert lines[0]["count"] == 6 and lines[0]["samples"] == [{"value" : "555-0"}, {"value" : "555-1"}]
+    finally:
+        shutil.rmtree(directory)
+
+    # The module level sink
+    configure(sample_size = 1)
+    record(NO_VALID_ADDRESS, address = {"street" : ""})
+    assert events.counts == {NO_VALID_ADDRESS : 1}
+    configure()
+
+    test_report_after_cleaning()
+
+
+# The report of the cleaning stages run on MongoDB, where the _id of the documents are ObjectIds. The server is replaced
+# by mongomock.
+def test_report_after_cleaning():
+    import os
+    import shutil
+    import tempfile
+
+    import mongomock
+
+    import Montreal_data_processing as processing
+    # The sink the cleaning stages record to, even when this file is run as a script
+    import quality_events
+    import storage_backend
+
+    # The requests of the cleaning stages are still converted to pymongo's ones by the MongoDB backend
+    class MockBackend(storage_backend.MongoBackend):
+        client = mongomock.MongoClient()
+
+        def new_client(self):
+            return self.client
+
+    previous_backend = storage_backend.active_backend
+    storage_backend.active_backend = MockBackend()
+    directory = tempfile.mkdtemp()
+    try:
+        MockBackend.client["test"]["elements"].insert_many([
+            {"type" : "node", "info" : {"phone" : "not a phone"}},
+            {"type" : "way", "address" : {"postcode" : "H2X 1Y4"}}
+        ])
+
+        sink = quality_events.configure()
+        processing.clean_osm_data("test", "elements")
+        assert sink.counts == {CORRUPT_PHONE : 1, NO_VALID_PHONE : 1}
+
+        filename = os.path.join(directory, "quality_events.jsonl")
+        sink.write_report(filename)
+        with open(filename) as report_file:
+            lines = [json.loads(line) for line in report_file]
+        node = MockBackend.client["test"]["elements"].find_one({"type" : "node"})
+        assert [line["samples"][0] for line in lines if line["code"] == NO_VALID_PHONE] == \
+               [{"document_id" : str(node["_id"]), "phone" : "not a phone"}]
+
+        # Any other value JSON has no type for is written as a string too
+        sink.record(CORRUPT_PHONE, document_id = node["_id"])
+        sink.write_report(filename)
+    finally:
+        storage_backend.active_backend = previous_backend
+        quality_events.configure()
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    test()
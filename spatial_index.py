@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+
+# An in-memory spatial index of the amenities, answering "the cafes within 500 m of here" or "the nearest pharmacy"
+# without a MongoDB geo index.
+# The amenities are put in a uniform grid of square cells (CELL_SIZE meters wide): the points are sorted by cell, and
+# cell_starts gives the first point of every cell, so the points of consecutive cells of a row are one slice of the
+# arrays. A query reads the slices of the cells its area touches, and computes the exact distances with NumPy. There is
+# one grid for all the amenities, and one per amenity type, so a query for a rare amenity type only reads its points.
+# The nearest queries search growing radiuses around the point until they have found enough amenities.
+#
+# The index is built from the amenity documents having a position (the nodes, and the ways once they have a geometry,
+# see node_index.py), with either schema (see typed_schema.py), and saved to one .npz file, so it is built once per
+# ingest.
+
+import json
+import math
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from node_index import haversine_meters, EARTH_RADIUS_METERS
+from typed_schema import latitude_longitude
+
+
+# Increase this when the format of the file changes
+INDEX_VERSION = 1
+
+CELL_SIZE = 250.0
+
+# The maximum number of cells of a grid. The cells are made larger for the areas that would need more.
+MAX_CELLS = 4 * 1024 * 1024
+
+METERS_PER_DEGREE = EARTH_RADIUS_METERS * math.pi / 180
+
+ELEMENT_TYPES = ["node", "way"]
+
+GRID_ARRAYS = ["latitudes", "longitudes", "points", "cell_starts", "parameters"]
+
+# A query result. distance is in meters, and None for the bounding box queries.
+Amenity = namedtuple("Amenity", ["id", "type", "amenity", "name", "lat", "lon", "distance"])
+
+
+class Grid(object):
+    # Builds the grid of the points of the index whose numbers are given
+    @classmethod
+    def build(cls, latitudes, longitudes, points, cell_size = CELL_SIZE):
+        grid = cls()
+        latitudes, longitudes = latitudes[points], longitudes[points]
+
+        if len(points):
+            min_latitude, min_longitude = latitudes.min(), longitudes.min()
+            max_latitude, max_longitude = latitudes.max(), longitudes.max()
+        else:
+            min_latitude = min_longitude = max_latitude = max_longitude = 0.0
+
+        # The longitudes are scaled at the widest latitude of the area, so a cell is never narrower than cell_size
+        meters_per_degree_longitude = METERS_PER_DEGREE * \
+                                      math.cos(math.radians(min(abs(min_latitude), abs(max_latitude))))
+        height = (max_latitude - min_latitude) * METERS_PER_DEGREE
+        width = (max_longitude - min_longitude) * meters_per_degree_longitude
+        cell_size = max(cell_size, math.sqrt(height * width / MAX_CELLS))
+
+        rows = int(height / cell_size) + 1
+        columns = int(width / cell_size) + 1
+        grid.parameters = np.array([min_latitude, min_longitude, METERS_PER_DEGREE / cell_size,
+                                    meters_per_degree_longitude / cell_size, rows, columns])
+        grid.set_parameters()
+
+        cells = grid.rows_of(latitudes) * columns + grid.columns_of(longitudes)
+        order = np.argsort(cells, kind = "mergesort")
+        grid.latitudes = latitudes[order]
+        grid.longitudes = longitudes[order]
+        grid.points = points[order]
+        grid.cell_starts = np.searchsorted(cells[order], np.arange(rows * columns + 1))
+        return grid
+
+    def set_parameters(self):
+        self.min_latitude, self.min_longitude, self.rows_per_degree, self.columns_per_degree = self.parameters[:4]
+        self.rows, self.columns = int(self.parameters[4]), int(self.parameters[5])
+
+    def rows_of(self, latitudes):
+        return np.clip(((latitudes - self.min_latitude) * self.rows_per_degree).astype(np.int64), 0, self.rows - 1)
+
+    def columns_of(self, longitudes):
+        return np.clip(((longitudes - self.min_longitude) * self.columns_per_degree).astype(np.int64),
+                       0, self.columns - 1)
+
+    # The positions in the arrays of the points in the cells touched by a bounding box
+    def candidates(self, min_latitude, min_longitude, max_latitude, max_longitude):
+        first_row, last_row = self.rows_of(np.array([min_latitude, max_latitude]))
+        first_column, last_column = self.columns_of(np.array([min_longitude, max_longitude]))
+
+        row_starts = np.arange(first_row, last_row + 1) * self.columns
+        starts = self.cell_starts[row_starts + first_column]
+        ends = self.cell_starts[row_starts + last_column + 1]
+        if len(starts) == 1:
+            return np.arange(starts[0], ends[0])
+        return np.concatenate([np.arange(start, end) for start, end in zip(starts.tolist(), ends.tolist())])
+
+    def arrays(self, prefix):
+        return dict((prefix + name, getattr(self, name)) for name in GRID_ARRAYS)
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix):
+        grid = cls()
+        for name in GRID_ARRAYS:
+            setattr(grid, name, arrays[prefix + name])
+        grid.set_parameters()
+        return grid
+
+
+class AmenitySpatialIndex(object):
+    # Builds the index from amenity documents. The ones without a position or an amenity type are skipped.
+    @classmethod
+    def build(cls, documents, cell_size = CELL_SIZE):
+        index = cls()
+        ids, types, latitudes, longitudes, amenity_codes, name_codes = [], [], [], [], [], []
+        amenity_table, name_table = {}, {}
+
+        for document in documents:
+            info = document.get("info", {})
+            if "pos" not in document or info.get("amenity") is None:
+                continue
+            latitude, longitude = latitude_longitude(document["pos"])
+            ids.append(int(document["id"]))
+            types.append(ELEMENT_TYPES.index(document["type"]))
+            latitudes.append(latitude)
+            longitudes.append(longitude)
+            amenity_codes.append(amenity_table.setdefault(info.get("amenity"), len(amenity_table)))
+            name_codes.append(name_table.setdefault(info.get("name"), len(name_table)))
+
+        index.ids = np.array(ids, dtype = np.int64)
+        index.types = np.array(types, dtype = np.int8)
+        index.latitudes = np.array(latitudes, dtype = np.float64)
+        index.longitudes = np.array(longitudes, dtype = np.float64)
+        index.amenity_codes = np.array(amenity_codes, dtype = np.int32)
+        index.name_codes = np.array(name_codes, dtype = np.int32)
+        index.amenities = sorted(amenity_table, key = amenity_table.get)
+        index.names = sorted(name_table, key = name_table.get)
+
+        all_points = np.arange(len(ids))
+        index.grids = {None : Grid.build(index.latitudes, index.longitudes, all_points, cell_size)}
+        for code, amenity in enumerate(index.amenities):
+            points = all_points[index.amenity_codes == code]
+            index.grids[amenity] = Grid.build(index.latitudes, index.longitudes, points, cell_size)
+        return index
+
+    def __len__(self):
+        return len(self.ids)
+
+    def save(self, filename):
+        arrays = {"ids" : self.ids, "types" : self.types, "latitudes" : self.latitudes, "longitudes" : self.longitudes,
+                  "amenity_codes" : self.amenity_codes, "name_codes" : self.name_codes}
+        # The grids are saved in the order of self.amenities, the grid of all the amenities first
+        for number, amenity in enumerate([None] + self.amenities):
+            arrays.update(self.grids[amenity].arrays("grid%d_" % number))
+
+        metadata = {"version" : INDEX_VERSION, "amenities" : self.amenities, "names" : self.names}
+        arrays["metadata"] = np.frombuffer(json.dumps(metadata).encode("utf-8"), dtype = np.uint8)
+
+        with open(filename, "wb") as index_file:
+            np.savez(index_file, **arrays)
+
+    # Loads a saved index, or returns None if the file was written by another version
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as arrays:
+            metadata = json.loads(arrays["metadata"].tostring().decode("utf-8"))
+            if metadata["version"] != INDEX_VERSION:
+                return None
+
+            index = cls()
+            for name in ["ids", "types", "latitudes", "longitudes", "amenity_codes", "name_codes"]:
+                setattr(index, name, arrays[name])
+            index.amenities = metadata["amenities"]
+            index.names = metadata["names"]
+            index.grids = dict((amenity, Grid.from_arrays(arrays, "grid%d_" % number))
+                               for number, amenity in enumerate([None] + index.amenities))
+        return index
+
+    def results(self, points, distances = None):
+        amenities = self.amenity_codes[points].tolist()
+        names = self.name_codes[points].tolist()
+        types = self.types[points].tolist()
+        rows = zip(self.ids[points].tolist(), types, amenities, names, self.latitudes[points].tolist(),
+                   self.longitudes[points].tolist(),
+                   distances.tolist() if distances is not None else [None] * len(points))
+        return [Amenity(str(element_id), ELEMENT_TYPES[element_type], self.amenities[amenity], self.names[name],
+                        latitude, longitude, distance)
+                for element_id, element_type, amenity, name, latitude, longitude, distance in rows]
+
+    # The points and distances of the amenities within meters of a point, by increasing distance
+    def radius_points(self, grid, latitude, longitude, meters):
+        latitude_delta = meters / METERS_PER_DEGREE
+        widest_latitude = min(abs(latitude) + latitude_delta, 89.9)
+        longitude_delta = meters / (METERS_PER_DEGREE * math.cos(math.radians(widest_latitude)))
+
+        candidates = grid.candidates(latitude - latitude_delta, longitude - longitude_delta,
+                                     latitude + latitude_delta, longitude + longitude_delta)
+        distances = haversine_meters(latitude, longitude, grid.latitudes[candidates], grid.longitudes[candidates])
+        inside = distances <= meters
+        candidates, distances = candidates[inside], distances[inside]
+
+        order = np.argsort(distances, kind = "mergesort")
+        return grid.points[candidates[order]], distances[order]
+
+    # The amenities within meters of a point, by increasing distance, optionally only of one amenity type
+    def within_radius(self, latitude, longitude, meters, amenity = None):
+        grid = self.grids.get(amenity)
+        if grid is None:
+            return []
+        return self.results(*self.radius_points(grid, latitude, longitude, meters))
+
+    # The k amenities nearest to a point, by increasing distance, optionally only of one amenity type. The radius
+    # searched is doubled until it holds k amenities (or all of them).
+    def nearest(self, latitude, longitude, k = 1, amenity = None):
+        grid = self.grids.get(amenity)
+        if grid is None or len(grid.points) == 0:
+            return []
+
+        cell_size = METERS_PER_DEGREE / grid.rows_per_degree
+        # Far enough to hold all the points of the grid from anywhere in it
+        diagonal = haversine_meters(grid.min_latitude, grid.min_longitude,
+                                    grid.min_latitude + grid.rows / grid.rows_per_degree,
+                                    grid.min_longitude + grid.columns / grid.columns_per_degree)
+        meters = cell_size
+        while True:
+            points, distances = self.radius_points(grid, latitude, longitude, meters)
+            if len(points) >= k or len(points) == len(grid.points):
+                return self.results(points[:k], distances[:k])
+            if meters > diagonal:
+                # The point is far away from the area of the grid
+                distances = haversine_meters(latitude, longitude, grid.latitudes, grid.longitudes)
+                order = np.argsort(distances, kind = "mergesort")[:k]
+                return self.results(grid.points[order], distances[order])
+            meters *= 2
+
+    # The amenities in a bounding box, optionally only of one amenity type
+    def within_bbox(self, min_latitude, min_longitude, max_latitude, max_longitude, amenity = None):
+        grid = self.grids.get(amenity)
+        if grid is None or len(grid.points) == 0:
+            return []
+
+        candidates = grid.candidates(min_latitude, min_longitude, max_latitude, max_longitude)
+        latitudes, longitudes = grid.latitudes[candidates], grid.longitudes[candidates]
+        inside = (latitudes >= min_latitude) & (latitudes <= max_latitude) & \
+                 (longitudes >= min_longitude) & (longitudes <= max_longitude)
+        return self.results(np.sort(grid.points[candidates[inside]]))
+
+
+# Random amenities around Montreal, for the tests and the benchmark
+def random_amenities(count, seed = 0):
+    generator = np.random.RandomState(seed)
+    amenity_types = ["cafe", "restaurant", "fast_food", "pharmacy", "bank", "place_of_worship"]
+    # Cafes and restaurants are common, pharmacies rare
+    weights = np.array([30, 40, 15, 2, 8, 5], dtype = np.float64)
+    types = generator.choice(len(amenity_types), count, p = weights / weights.sum())
+    latitudes = 45.40 + generator.rand(count) * 0.30
+    longitudes = -73.95 + generator.rand(count) * 0.45
+
+    return [{"id" : str(number + 1), "type" : "node", "pos" : [latitudes[number], longitudes[number]],
+             "info" : {"amenity" : amenity_types[types[number]], "name" : "Amenity %d" % (number % 50)}}
+            for number in range(count)]
+
+
+# Times the queries on an index of count random amenities
+def benchmark(count = 100000, queries = 1000):
+    index = AmenitySpatialIndex.build(random_amenities(count))
+    generator = np.random.RandomState(1)
+    points = zip((45.45 + generator.rand(queries) * 0.2).tolist(), (-73.85 + generator.rand(queries) * 0.3).tolist())
+
+    timings = {}
+    for label, query in [("radius 500 m", lambda lat, lon: index.within_radius(lat, lon, 500)),
+                         ("cafes within 500 m", lambda lat, lon: index.within_radius(lat, lon, 500, "cafe")),
+                         ("5 nearest", lambda lat, lon: index.nearest(lat, lon, 5)),
+                         ("nearest pharmacy", lambda lat, lon: index.nearest(lat, lon, 1, "pharmacy")),
+                         ("bbox 1 km", lambda lat, lon: index.within_bbox(lat, lon, lat + 0.009, lon + 0.013))]:
+        start = time.time()
+        for latitude, longitude in points:
+            query(latitude, longitude)
+        timings[label] = (time.time() - start) / queries * 1000
+        print "%s: %.3f ms per query" % (label, timings[label])
+    return timings
+
+
+def test():
+    import os
+    import tempfile
+
+    documents = random_amenities(20000)
+    index = AmenitySpatialIndex.build(documents + [{"id" : "0", "type" : "way", "info" : {"amenity" : "cafe"}}])
+    assert len(index) == 20000
+
+    latitudes = np.array([document["pos"][0] for document in documents])
+    longitudes = np.array([document["pos"][1] for document in documents])
+    amenities = np.array([document["info"]["amenity"] for document in documents])
+
+    handle, filename = tempfile.mkstemp(suffix = ".npz")
+    os.close(handle)
+    try:
+        index.save(filename)
+        loaded = AmenitySpatialIndex.load(filename)
+    finally:
+        os.remove(filename)
+
+    # Compare with a brute force search
+    for latitude, longitude in [(45.5, -73.6), (45.41, -73.94), (45.7, -73.5), (46.5, -72.0)]:
+        distances = haversine_meters(latitude, longitude, latitudes, longitudes)
+        for current in [index, loaded]:
+            expected = set(np.flatnonzero(distances <= 800) + 1)
+            assert set(int(result.id) for result in current.within_radius(latitude, longitude, 800)) == expected
+
+            cafes = np.flatnonzero(amenities == "cafe")
+            expected = cafes[np.argsort(distances[cafes])[:3]] + 1
+            results = current.nearest(latitude, longitude, 3, "cafe")
+            assert [int(result.id) for result in results] == expected.tolist()
+            assert abs(results[0].distance - distances[expected[0] - 1]) < 1e-6
+
+            inside = (latitudes >= latitude - 0.01) & (latitudes <= latitude + 0.01) & \
+                     (longitudes >= longitude - 0.02) & (longitudes <= longitude + 0.02)
+            results = current.within_bbox(latitude - 0.01, longitude - 0.02, latitude + 0.01, longitude + 0.02)
+            assert [int(result.id) for result in results] == (np.flatnonzero(inside) + 1).tolist()
+
+    assert index.within_radius(45.5, -73.6, 500, "library") == []
+    assert AmenitySpatialIndex.build([]).nearest(45.5, -73.6) == []
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,884 @@
+# -*- coding: utf-8 -*-
+
+# The storage backends the pipeline can load the map data into. connect_to_local_db() returns the client of the active
+# backend, and the rest of the pipeline (insert_xml_map_to_db(), clean_osm_data(), map_stats()) uses it through the
+# pymongo API: client[db_name][collection_name], then insert_many(), find(), bulk_write(), aggregate(), count() and
+# drop(). The write requests of bulk_write() are the UpdateOne, ReplaceOne and DeleteOne classes of this module, so
+# only the MongoDB backend needs pymongo. Two backends are available:
+#   - "mongodb": a MongoDB server on the local host (the default), through pymongo. Its collections convert the write
+#     requests to pymongo's ones
+#   - "sqlite": an embedded SQLite database file per database name, in a local directory. It needs no server, which makes
+#     the development and benchmark runs easy to set up and to reproduce.
+#
+# The SQLite backend stores every document as JSON text in a table per collection, with the integer _id as the primary
+# key. JSON has no date type, so the datetimes are written as {"$date" : <milliseconds since the epoch>}, like in
+# MongoDB's extended JSON (and with the precision of the BSON dates), and read back as datetimes.
+# It implements the subset of the pymongo API the pipeline uses:
+#   - queries: equality (matching the elements of arrays, like MongoDB), $exists, $in, $nin, $ne, $gt, $gte, $lt, $lte,
+#     $and and $or, on dotted paths
+#   - writes: the UpdateOne requests with $set and $unset on dotted paths, ReplaceOne (with upsert) and DeleteOne, and
+#     delete_many()
+#   - aggregation stages: $match, $group (with $sum), $sort, $limit, $facet
+#   - create_index(), with compound keys and partial filters, and explain_query() for the query plan of a find()
+#   - find() sorted by the increasing _id
+# The tables are in WAL mode, the batches are written with executemany() in one transaction, and the info.amenity,
+# created.user and address.postcode fields are indexed (this needs an SQLite library with the JSON1 functions, which
+# most builds have since 3.9, and all since 3.38).
+
+import array
+import datetime
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from collections import namedtuple, OrderedDict
+
+
+# The registered backends, by name
+BACKENDS = {}
+
+
+def register_backend(backend_class):
+    BACKENDS[backend_class.name] = backend_class
+    return backend_class
+
+
+# Raised by connect() when the storage can not be reached
+class ConnectionFailure(IOError):
+    pass
+
+
+# The write requests of bulk_write(), with the arguments of pymongo's ones
+class UpdateOne(object):
+    __slots__ = ("filter", "update", "upsert")
+
+    def __init__(self, filter, update, upsert = False):
+        self.filter = filter
+        self.update = update
+        self.upsert = upsert
+
+    def to_pymongo(self, pymongo):
+        return pymongo.UpdateOne(self.filter, self.update, self.upsert)
+
+
+class ReplaceOne(object):
+    __slots__ = ("filter", "replacement", "upsert")
+
+    def __init__(self, filter, replacement, upsert = False):
+        self.filter = filter
+        self.replacement = replacement
+        self.upsert = upsert
+
+    def to_pymongo(self, pymongo):
+        return pymongo.ReplaceOne(self.filter, self.replacement, self.upsert)
+
+
+class DeleteOne(object):
+    __slots__ = ("filter", )
+
+    def __init__(self, filter):
+        self.filter = filter
+
+    def to_pymongo(self, pymongo):
+        return pymongo.DeleteOne(self.filter)
+
+
+class StorageBackend(object):
+    name = None
+
+    # Returns a client, used like a pymongo MongoClient
+    def connect(self):
+        raise NotImplementedError
+
+
+@register_backend
+class MongoBackend(StorageBackend):
+    name = "mongodb"
+
+    def __init__(self, host = None, port = None):
+        self.host = host
+        self.port = port
+
+    # pymongo is only imported here, so the pipeline does not need it with the other backends
+    def connect(self):
+        import pymongo
+        try:
+            return MongoClient(self.new_client())
+        except pymongo.errors.ConnectionFailure, e:
+            raise ConnectionFailure(str(e))
+
+    def new_client(self):
+        import pymongo
+        return pymongo.MongoClient(self.host, self.port)
+
+
+# A pymongo client, database and collection, used the same way, except for bulk_write(), which takes the requests of
+# this module and sends pymongo's ones
+class MongoClient(object):
+    def __init__(self, client):
+        self.client = client
+
+    def __getitem__(self, db_name):
+        return MongoDatabase(self.client[db_name])
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+class MongoDatabase(object):
+    def __init__(self, database):
+        self.database = database
+
+    def __getitem__(self, collection_name):
+        return MongoCollection(self.database[collection_name])
+
+    def __getattr__(self, name):
+        return getattr(self.database, name)
+
+
+class MongoCollection(object):
+    def __init__(self, collection):
+        self.collection = collection
+
+    def bulk_write(self, requests, ordered = True):
+        import pymongo
+        return self.collection.bulk_write([request.to_pymongo(pymongo) for request in requests], ordered = ordered)
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+
+DEFAULT_SQLITE_DIRECTORY = ".sqlite_db"
+
+
+@register_backend
+class SQLiteBackend(StorageBackend):
+    name = "sqlite"
+
+    def __init__(self, directory = DEFAULT_SQLITE_DIRECTORY):
+        self.directory = directory
+
+    def connect(self):
+        return SQLiteClient(self.directory)
+
+
+# The backend used by connect()
+active_backend = MongoBackend()
+
+
+# Selects the backend used from now on, by name, with its options (for example directory for "sqlite")
+def select_backend(name, **options):
+    global active_backend
+    active_backend = BACKENDS[name](**options)
+    return active_backend
+
+
+def connect():
+    return active_backend.connect()
+
+
+########################################################################################################################
+#                                          The SQLite backend
+
+# The fields indexed when a collection is created, by index name. More can be added with create_index().
+INDEXED_PATHS = OrderedDict([("amenity", "info.amenity"), ("user", "created.user"), ("postcode", "address.postcode")])
+
+# The fields that can hold arrays. SQLite compares them as JSON text, so the queries on their values are only checked
+# in Python (where a value matches the elements of the array, like in MongoDB), even if they are indexed.
+ARRAY_PATHS = frozenset(["info.phone", "node_refs", "pos", "geometry.bbox", "corrupt_fields"])
+
+# The number of documents read per query by find() (SQLite builds older than 3.32 accept at most 999 parameters)
+FIND_BATCH_SIZE = 500
+
+name_regex = re.compile(r"^\w+$")
+path_regex = re.compile(r"^[\w:\-]+(\.[\w:\-]+)*$")
+indexed_path_regex = re.compile(r"json_extract\(document, '([^']+)'\)")
+
+BulkWriteResult = namedtuple("BulkWriteResult", ["matched_count", "modified_count", "upserted_count", "deleted_count"])
+InsertManyResult = namedtuple("InsertManyResult", ["inserted_ids"])
+DeleteResult = namedtuple("DeleteResult", ["deleted_count"])
+
+# The comparisons on the _id that SQLite filters on the primary key
+ID_COMPARISONS = {"$gt" : ">", "$gte" : ">=", "$lt" : "<", "$lte" : "<="}
+
+# The value of a path missing from a document
+MISSING = object()
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+class SQLiteClient(object):
+    def __init__(self, directory):
+        self.directory = directory
+        self.databases = {}
+
+    def __getitem__(self, db_name):
+        if db_name not in self.databases:
+            if not name_regex.match(db_name):
+                raise ValueError("Invalid database name: %r" % db_name)
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+            self.databases[db_name] = SQLiteDatabase(os.path.join(self.directory, db_name + ".sqlite"))
+        return self.databases[db_name]
+
+    def close(self):
+        for database in self.databases.values():
+            database.close()
+        self.databases = {}
+
+
+class SQLiteDatabase(object):
+    def __init__(self, path):
+        import sqlite3
+
+        # The connection is shared by the threads of the pipelined ingest, one at a time
+        self.connection = sqlite3.connect(path, check_same_thread = False)
+        self.lock = threading.RLock()
+
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        # In WAL mode, NORMAL only syncs at checkpoints, and the database still can not be corrupted by a crash
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+
+    def __getitem__(self, collection_name):
+        if not name_regex.match(collection_name):
+            raise ValueError("Invalid collection name: %r" % collection_name)
+        return SQLiteCollection(self, collection_name)
+
+    def close(self):
+        self.connection.close()
+
+
+def encode_value(value):
+    if isinstance(value, datetime.datetime):
+        delta = value - EPOCH
+        return {"$date" : (delta.days * 86400 + delta.seconds) * 1000 + delta.microseconds // 1000}
+    raise TypeError("%r is not JSON serializable" % value)
+
+
+def decode_dates(dictionary):
+    if "$date" in dictionary and len(dictionary) == 1:
+        return EPOCH + datetime.timedelta(milliseconds = dictionary["$date"])
+    return dictionary
+
+
+def encode_document(document):
+    return json.dumps(document, separators = (",", ":"), default = encode_value)
+
+
+# The object hook is only used for the documents holding dates, as it slows down the decoding of all the others
+def decode_document(text):
+    if '{"$date":' in text:
+        return json.loads(text, object_hook = decode_dates)
+    return json.loads(text)
+
+
+# The JSON path of a dotted path, as used by the SQLite JSON functions
+def json_path(path):
+    if not path_regex.match(path):
+        raise ValueError("Unsupported field path: %r" % path)
+    return "$." + ".".join('"%s"' % part for part in path.split("."))
+
+
+def is_scalar(value):
+    return isinstance(value, (basestring, int, long, float))
+
+
+# A value written in an SQL statement. The booleans are integers in SQLite, like json_extract() returns them.
+def sql_literal(value):
+    if isinstance(value, basestring):
+        return "'%s'" % value.replace("'", "''")
+    return repr(int(value) if isinstance(value, bool) else value)
+
+
+# The value at a dotted path of a document, or MISSING
+def get_path(document, path):
+    value = document
+    for part in path.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return MISSING
+        value = value[part]
+    return value
+
+
+def set_path(document, path, value):
+    parts = path.split(".")
+    for part in parts[:-1]:
+        document = document.setdefault(part, {})
+    document[parts[-1]] = value
+
+
+def unset_path(document, path):
+    parts = path.split(".")
+    for part in parts[:-1]:
+        document = document.get(part)
+        if not isinstance(document, dict):
+            return
+    document.pop(parts[-1], None)
+
+
+# MongoDB equality: a missing field equals None, and an array equals any of its elements
+def value_equals(value, target):
+    if value is MISSING:
+        return target is None
+    if value == target:
+        return True
+    return isinstance(value, list) and target in value
+
+
+def compare_values(value, operator, argument):
+    if value is MISSING:
+        return False
+    values = value if isinstance(value, list) else [value]
+    if operator == "$gt":
+        return any(item > argument for item in values)
+    if operator == "$gte":
+        return any(item >= argument for item in values)
+    if operator == "$lt":
+        return any(item < argument for item in values)
+    return any(item <= argument for item in values)
+
+
+# A function that checks if a document matches a MongoDB query
+def matches(document, query):
+    for key, condition in query.iteritems():
+        if key == "$and":
+            if not all(matches(document, sub_query) for sub_query in condition):
+                return False
+            continue
+        if key == "$or":
+            if not any(matches(document, sub_query) for sub_query in condition):
+                return False
+            continue
+        if key.startswith("$"):
+            raise NotImplementedError("Unsupported query operator: " + key)
+
+        value = get_path(document, key)
+        if isinstance(condition, dict) and condition and all(name.startswith("$") for name in condition):
+            for operator, argument in condition.iteritems():
+                if operator == "$exists":
+                    result = (value is not MISSING) == bool(argument)
+                elif operator == "$eq":
+                    result = value_equals(value, argument)
+                elif operator == "$ne":
+                    result = not value_equals(value, argument)
+                elif operator == "$in":
+                    result = any(value_equals(value, target) for target in argument)
+                elif operator == "$nin":
+                    result = not any(value_equals(value, target) for target in argument)
+                elif operator in ("$gt", "$gte", "$lt", "$lte"):
+                    result = compare_values(value, operator, argument)
+                else:
+                    raise NotImplementedError("Unsupported query operator: " + operator)
+                if not result:
+                    return False
+        elif not value_equals(value, condition):
+            return False
+
+    return True
+
+
+# A function that applies a MongoDB update ($set and $unset) to a document
+def apply_update(document, update):
+    for operator, fields in update.iteritems():
+        if operator == "$set":
+            for path, value in fields.iteritems():
+                set_path(document, path, value)
+        elif operator == "$unset":
+            for path in fields:
+                unset_path(document, path)
+        else:
+            raise NotImplementedError("Unsupported update operator: " + operator)
+
+
+# Lists and dictionaries can not be dictionary keys, as needed by $group: they are converted to tuples
+def hashable(value):
+    if isinstance(value, list):
+        return tuple(hashable(item) for item in value)
+    if isinstance(value, dict):
+        return tuple(sorted((key, hashable(item)) for key, item in value.iteritems()))
+    return value
+
+
+# The value of an aggregation expression: "$path" for a field of the document, a dictionary of expressions, or a constant
+def evaluate(document, expression):
+    if isinstance(expression, basestring) and expression.startswith("$"):
+        value = get_path(document, expression[1:])
+        return None if value is MISSING else value
+    if isinstance(expression, dict):
+        return dict((key, evaluate(document, value)) for key, value in expression.iteritems())
+    return expression
+
+
+def group_documents(documents, specification):
+    groups = OrderedDict()
+    for document in documents:
+        group_id = evaluate(document, specification["_id"])
+        key = hashable(group_id)
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = {"_id" : group_id}
+            for field in specification:
+                if field != "_id":
+                    group[field] = 0
+
+        for field, accumulator in specification.iteritems():
+            if field == "_id":
+                continue
+            if accumulator.keys() != ["$sum"]:
+                raise NotImplementedError("Unsupported accumulator: %r" % accumulator)
+            value = evaluate(document, accumulator["$sum"])
+            if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+                group[field] += value
+
+    return groups.values()
+
+
+def sort_documents(documents, specification):
+    documents = list(documents)
+    # Python's sort is stable, so sorting by the last key first gives the order of all the keys
+    for path, direction in reversed(specification.items()):
+        documents.sort(key = lambda document: evaluate(document, "$" + path), reverse = direction < 0)
+    return documents
+
+
+# Runs the stages of an aggregation pipeline on an iterable of documents, and returns the resulting list
+def run_pipeline(documents, pipeline):
+    for stage in pipeline:
+        (operator, argument), = stage.items()
+        if operator == "$match":
+            documents = [document for document in documents if matches(document, argument)]
+        elif operator == "$group":
+            documents = group_documents(documents, argument)
+        elif operator == "$sort":
+            documents = sort_documents(documents, argument)
+        elif operator == "$limit":
+            documents = list(documents)[:argument]
+        elif operator == "$facet":
+            # Every sub-pipeline gets the same input documents, which are read only once
+            documents = list(documents)
+            documents = [dict((name, run_pipeline(documents, sub_pipeline))
+                              for name, sub_pipeline in argument.iteritems())]
+        else:
+            raise NotImplementedError("Unsupported aggregation stage: " + operator)
+
+    return list(documents)
+
+
+class SQLiteCollection(object):
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self.table = '"%s"' % name
+
+    def execute(self, statement, parameters = ()):
+        return self.database.connection.execute(statement, parameters)
+
+    def exists(self):
+        with self.database.lock:
+            return self.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                                (self.name, )).fetchone() is not None
+
+    def create(self):
+        with self.database.lock, self.database.connection:
+            self.execute("CREATE TABLE IF NOT EXISTS %s (_id INTEGER PRIMARY KEY, document TEXT NOT NULL)" % self.table)
+            # Most documents do not have these fields, so only the ones having them are indexed. The index then stays
+            # small, and the query planner does not take the missing values into account when choosing it.
+            for index_name, path in INDEXED_PATHS.iteritems():
+                expression = "json_extract(document, '%s')" % json_path(path)
+                self.execute('CREATE INDEX IF NOT EXISTS "%s_%s" ON %s (%s) WHERE %s IS NOT NULL' %
+                             (self.name, index_name, self.table, expression, expression))
+
+    def count(self):
+        if not self.exists():
+            return 0
+        with self.database.lock:
+            return self.execute("SELECT COUNT(*) FROM %s" % self.table).fetchone()[0]
+
+    def drop(self):
+        with self.database.lock, self.database.connection:
+            self.execute("DROP TABLE IF EXISTS %s" % self.table)
+
+    # The documents get an integer _id, unless they already have one. The ordered parameter is only there for pymongo
+    # compatibility: the whole batch is written in one transaction.
+    def insert_many(self, documents, ordered = True):
+        self.create()
+        with self.database.lock, self.database.connection:
+            next_id = self.execute("SELECT COALESCE(MAX(_id), 0) + 1 FROM %s" % self.table).fetchone()[0]
+
+            rows = []
+            for document in documents:
+                if not isinstance(document, dict):
+                    # The BSON documents of the pipelined ingest (see pipelined_ingest.py)
+                    import bson
+                    document = bson.BSON(document.raw).decode()
+
+                document_id = document.get("_id")
+                if document_id is None:
+                    document_id = next_id
+                    next_id += 1
+                else:
+                    document = dict(document)
+                    del document["_id"]
+                rows.append((document_id, encode_document(document)))
+
+            self.database.connection.executemany("INSERT INTO %s (_id, document) VALUES (?, ?)" % self.table, rows)
+
+        return InsertManyResult([document_id for document_id, _ in rows])
+
+    # The JSON paths of the fields indexed on the collection (as written by json_path())
+    def indexed_paths(self):
+        with self.database.lock:
+            rows = self.execute("SELECT sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ?",
+                                (self.name, )).fetchall()
+        return set(path for sql, in rows if sql for path in indexed_path_regex.findall(sql))
+
+    # The part of a query that SQLite can filter, as a list of SQL conditions: the values and $in on the indexed fields,
+    # $exists on any field, and the integer values and ranges of the _id. The documents it returns are still checked
+    # with matches(). The values are written as literals, so the conditions are the same text as the WHERE clauses of
+    # the partial indexes, which SQLite needs to use them.
+    def sql_filter(self, query, indexed_paths = None):
+        if indexed_paths is None:
+            indexed_paths = self.indexed_paths()
+
+        conditions = []
+        for key, condition in query.iteritems():
+            if key.startswith("$"):
+                continue
+
+            if key == "_id":
+                if type(condition) in (int, long):
+                    conditions.append("_id = %d" % condition)
+                elif isinstance(condition, dict):
+                    conditions.extend("_id %s %d" % (ID_COMPARISONS[operator], value)
+                                      for operator, value in condition.iteritems()
+                                      if operator in ID_COMPARISONS and type(value) in (int, long))
+                continue
+
+            path = json_path(key)
+            if path in indexed_paths and key not in ARRAY_PATHS:
+                expression = "json_extract(document, '%s')" % path
+                if is_scalar(condition):
+                    conditions.append("%s = %s" % (expression, sql_literal(condition)))
+                elif isinstance(condition, dict) and isinstance(condition.get("$in"), list) and \
+                        all(is_scalar(value) for value in condition["$in"]):
+                    conditions.append("%s IN (%s)" % (expression,
+                                                      ", ".join(sql_literal(value) for value in condition["$in"])))
+
+            if isinstance(condition, dict) and condition.get("$exists") is True:
+                # json_type() is NULL for the missing fields only, json_extract() also for the null values
+                conditions.append("json_type(document, '%s') IS NOT NULL" % path)
+
+        return conditions
+
+    # The statement selecting the _id of the documents SQLite can filter for a query. It only reads the indexes when
+    # there are some for the query. The only sort supported is the increasing _id: [("_id", 1)].
+    def find_statement(self, query, sort = None):
+        conditions = self.sql_filter(query)
+        statement = "SELECT _id FROM %s" % self.table
+        if conditions:
+            statement += " WHERE " + " AND ".join(conditions)
+        if sort:
+            if sort != [("_id", 1)]:
+                raise NotImplementedError("Only the sort on the increasing _id is supported: %r" % (sort, ))
+            statement += " ORDER BY _id"
+        return statement
+
+    # Creates an index like pymongo's create_index(): keys is a list of (path, direction) pairs. partialFilterExpression
+    # can hold values and $exists: True. SQLite has no spatial index, so the 2dsphere indexes are not created.
+    def create_index(self, keys, name = None, partialFilterExpression = None, unique = False, **options):
+        if any(direction == "2dsphere" for _, direction in keys):
+            return None
+
+        if name is None:
+            name = "_".join("%s_%s" % (path, direction) for path, direction in keys).replace(".", "_")
+        columns = ", ".join("_id" if path == "_id" else "json_extract(document, '%s')" % json_path(path)
+                            for path, _ in keys)
+        where = ""
+        if partialFilterExpression:
+            indexed_paths = set(json_path(path) for path in partialFilterExpression)
+            where = " WHERE " + " AND ".join(self.sql_filter(partialFilterExpression, indexed_paths))
+
+        self.create()
+        with self.database.lock, self.database.connection:
+            self.execute('CREATE %sINDEX IF NOT EXISTS "%s_%s" ON %s (%s)%s' %
+                         ("UNIQUE " if unique else "", self.name, name, self.table, columns, where))
+        return name
+
+    # The query plan of find(query, sort), as the details of SQLite's EXPLAIN QUERY PLAN
+    def explain_query(self, query, sort = None):
+        # Without any condition SQLite can filter, every document is read and checked by matches(), even if SQLite
+        # reads the _id from an index
+        if not self.sql_filter(query):
+            return ["SCAN " + self.name]
+
+        with self.database.lock:
+            rows = self.execute("EXPLAIN QUERY PLAN " + self.find_statement(query, sort)).fetchall()
+        return [row[-1] for row in rows]
+
+    # The sizes of the collection in bytes, like the size, storageSize and totalIndexSize of MongoDB's collStats: the
+    # JSON text of the documents, the pages of the table, and the pages of its indexes. The pages are counted with the
+    # dbstat table, which needs an SQLite library built with it.
+    def collection_stats(self):
+        self.create()
+        with self.database.lock:
+            size, = self.execute("SELECT COALESCE(SUM(LENGTH(document)), 0) FROM %s" % self.table).fetchone()
+            storage_size, = self.execute("SELECT COALESCE(SUM(pgsize), 0) FROM dbstat WHERE name = ?",
+                                         (self.name, )).fetchone()
+            index_size, = self.execute("SELECT COALESCE(SUM(pgsize), 0) FROM dbstat WHERE name IN "
+                                       "(SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ?)",
+                                       (self.name, )).fetchone()
+        return {"size" : size, "storageSize" : storage_size, "totalIndexSize" : index_size}
+
+    # Selects the _id of the matching documents first (8 bytes each), then reads the documents by batches of _id, so
+    # the collection can be updated while it is iterated. sort is the one of find_statement().
+    def find(self, query = None, sort = None):
+        query = query or {}
+        if not self.exists():
+            return
+
+        with self.database.lock:
+            ids = array.array("l", (document_id for document_id, in self.execute(self.find_statement(query, sort))))
+
+        for start in xrange(0, len(ids), FIND_BATCH_SIZE):
+            block = ids[start:start + FIND_BATCH_SIZE].tolist()
+            with self.database.lock:
+                rows = self.execute("SELECT _id, document FROM %s WHERE _id IN (%s) ORDER BY _id" %
+                                    (self.table, ", ".join("?" * len(block))), block).fetchall()
+
+            for document_id, text in rows:
+                document = decode_document(text)
+                document["_id"] = document_id
+                if matches(document, query):
+                    yield document
+
+    def find_one(self, query = None):
+        for document in self.find(query):
+            return document
+        return None
+
+    # Deletes the documents matching a query, in one transaction
+    def delete_many(self, query):
+        if not self.exists():
+            return DeleteResult(0)
+
+        with self.database.lock, self.database.connection:
+            ids = [document["_id"] for document in self.find(query)]
+            for start in xrange(0, len(ids), FIND_BATCH_SIZE):
+                block = ids[start:start + FIND_BATCH_SIZE]
+                self.execute("DELETE FROM %s WHERE _id IN (%s)" % (self.table, ", ".join("?" * len(block))), block)
+
+        return DeleteResult(len(ids))
+
+    # Applies a list of UpdateOne, ReplaceOne and DeleteOne requests, in one transaction. The updates by _id (as sent
+    # by the cleaning stages) are read and written by blocks, the other requests one at a time, in order. Only
+    # ReplaceOne can upsert.
+    def bulk_write(self, requests, ordered = True):
+        if all(type(request) is UpdateOne and request.filter.keys() == ["_id"] for request in requests):
+            return self.update_by_ids(requests)
+
+        matched = modified = upserted = deleted = 0
+        self.create()
+        with self.database.lock, self.database.connection:
+            for request in requests:
+                existing = self.find_one(request.filter)
+
+                if isinstance(request, DeleteOne):
+                    if existing is not None:
+                        self.execute("DELETE FROM %s WHERE _id = ?" % self.table, (existing["_id"], ))
+                        deleted += 1
+                    continue
+
+                if isinstance(request, ReplaceOne):
+                    document = dict(request.replacement)
+                    document.pop("_id", None)
+                elif isinstance(request, UpdateOne):
+                    if existing is None:
+                        if request.upsert:
+                            raise NotImplementedError("Only ReplaceOne can upsert")
+                        continue
+                    document = decode_document(encode_document(existing))
+                    apply_update(document, request.update)
+                    document.pop("_id")
+                else:
+                    raise NotImplementedError("Unsupported request: %r" % request)
+
+                if existing is None:
+                    if request.upsert:
+                        # A NULL _id is given the next free one by SQLite
+                        self.execute("INSERT INTO %s (_id, document) VALUES (NULL, ?)" % self.table,
+                                     (encode_document(document), ))
+                        upserted += 1
+                    continue
+
+                matched += 1
+                document_id = existing.pop("_id")
+                if document != existing:
+                    modified += 1
+                    self.execute("UPDATE %s SET document = ? WHERE _id = ?" % self.table,
+                                 (encode_document(document), document_id))
+
+        return BulkWriteResult(matched, modified, upserted, deleted)
+
+    def update_by_ids(self, requests):
+        updates = OrderedDict()
+        for request in requests:
+            updates.setdefault(request.filter["_id"], []).append(request.update)
+
+        matched = modified = 0
+        with self.database.lock, self.database.connection:
+            ids = updates.keys()
+            rows = []
+            for start in xrange(0, len(ids), 500):
+                block = ids[start:start + 500]
+                rows.extend(self.execute("SELECT _id, document FROM %s WHERE _id IN (%s)" %
+                                         (self.table, ", ".join("?" * len(block))), block).fetchall())
+
+            changed = []
+            for document_id, text in rows:
+                matched += 1
+                document = decode_document(text)
+                original = decode_document(text)
+                for update in updates[document_id]:
+                    apply_update(document, update)
+                if document != original:
+                    modified += 1
+                    changed.append((encode_document(document), document_id))
+
+            self.database.connection.executemany("UPDATE %s SET document = ? WHERE _id = ?" % self.table, changed)
+
+        return BulkWriteResult(matched, modified, 0, 0)
+
+    # Runs an aggregation pipeline. Like pymongo, it returns an iterator that can only be consumed once.
+    def aggregate(self, pipeline):
+        if pipeline and pipeline[0].keys() == ["$match"]:
+            documents = self.find(pipeline[0]["$match"])
+            pipeline = pipeline[1:]
+        else:
+            documents = self.find()
+
+        return iter(run_pipeline(documents, pipeline))
+
+
+########################################################################################################################
+
+# Runs the ingest, the cleaning stages and the statistics on the map file with every backend, and prints the
+# throughput of each stage
+def compare_backends(filename, backend_names = ("sqlite", "mongodb")):
+    import Montreal_data_processing as processing
+
+    previous_backend = active_backend
+    try:
+        for name in backend_names:
+            select_backend(name)
+            timings = []
+
+            start = time.time()
+            processing.insert_xml_map_to_db(filename, "benchmark", "elements", True)
+            timings.append(("ingest", time.time() - start))
+
+            client = connect()
+            count = client["benchmark"]["elements"].count()
+            client.close()
+
+            start = time.time()
+            processing.clean_osm_data("benchmark", "elements")
+            timings.append(("cleaning", time.time() - start))
+
+            start = time.time()
+            processing.map_stats("benchmark", "elements")
+            timings.append(("statistics", time.time() - start))
+
+            for stage, elapsed in timings:
+                print "%s %s: %.2f s, %.0f documents per second" % (name, stage, elapsed, count / elapsed)
+    finally:
+        select_backend(previous_backend.name, **vars(previous_backend))
+
+
+def test():
+    directory = tempfile.mkdtemp()
+    try:
+        client = SQLiteBackend(directory).connect()
+        collection = client["test"]["elements"]
+        assert collection.count() == 0
+
+        collection.insert_many([
+            {"type" : "node", "created" : {"user" : "a"}, "info" : {"amenity" : "cafe", "name" : "Tim Hortons"}},
+            {"type" : "node", "created" : {"user" : "a"}, "info" : {"amenity" : "cafe", "name" : "Starbucks"}},
+            {"type" : "node", "created" : {"user" : "b"}, "info" : {"amenity" : "cafe", "name" : "Tim Hortons",
+                                                                    "phone" : ["514 555 1234"]}},
+            {"type" : "way", "created" : {"user" : "c"}, "address" : {"postcode" : "H2X 1Y4"}}
+        ])
+        assert collection.count() == 4
+
+        assert len(list(collection.find({"info.amenity" : "cafe"}))) == 3
+        assert len(list(collection.find({"info.phone" : {"$exists" : True}}))) == 1
+        assert len(list(collection.find({"info.phone" : "514 555 1234"}))) == 1
+        assert len(list(collection.find({"created.user" : {"$in" : ["a", "c"]}}))) == 3
+        assert len(list(collection.find({"info" : {"$exists" : False}}))) == 1
+
+        result = collection.bulk_write([
+            UpdateOne({"_id" : 4}, {"$set" : {"address" : {"postcode" : "H2X-1Y4"}}}),
+            UpdateOne({"_id" : 3}, {"$set" : {"has_corrupt_data" : True}, "$unset" : {"info.phone" : ""}}),
+            UpdateOne({"_id" : 2}, {"$set" : {"info.name" : "Starbucks"}}),
+            UpdateOne({"_id" : 10}, {"$set" : {"info.name" : "Nothing"}})
+        ])
+        assert result == BulkWriteResult(3, 2, 0, 0)
+        assert collection.find_one({"address.postcode" : "H2X-1Y4"})["_id"] == 4
+        assert "phone" not in collection.find_one({"has_corrupt_data" : True})["info"]
+
+        result = list(collection.aggregate([{"$match" : {"info.amenity" : "cafe"}},
+                                            {"$group" : {"_id" : "$info.name", "count" : {"$sum" : 1}}},
+                                            {"$sort" : {"count" : -1}},
+                                            {"$limit" : 1}]))
+        assert result == [{"_id" : "Tim Hortons", "count" : 2}]
+
+        result = list(collection.aggregate([{"$group" : {"_id" : "$created.user", "count" : {"$sum" : 1}}},
+                                            {"$match" : {"count" : 1}}]))
+        assert sorted(group["_id"] for group in result) == ["b", "c"]
+
+        result = list(collection.aggregate([{"$facet" : {
+            "types" : [{"$group" : {"_id" : "$type", "count" : {"$sum" : 1}}}, {"$sort" : {"_id" : 1}}],
+            "cafes" : [{"$match" : {"info.amenity" : "cafe"}}, {"$group" : {"_id" : None, "count" : {"$sum" : 1}}}]
+        }}]))
+        assert result == [{"types" : [{"_id" : "node", "count" : 3}, {"_id" : "way", "count" : 1}],
+                           "cafes" : [{"_id" : None, "count" : 3}]}]
+
+        collection.drop()
+        assert collection.count() == 0
+
+        collection.insert_many([{"type" : "node", "id" : "1"}, {"type" : "way", "id" : "1"}, {"type" : "node", "id" : "2"}])
+        collection.create_index([("type", 1), ("id", 1)], unique = True)
+        result = collection.bulk_write([
+            ReplaceOne({"type" : "node", "id" : "3"}, {"type" : "node", "id" : "3"}, upsert = True),
+            ReplaceOne({"type" : "way", "id" : "1"}, {"type" : "way", "id" : "1", "info" : {"name" : "A"}}),
+            ReplaceOne({"type" : "node", "id" : "2"}, {"type" : "node", "id" : "2"}),
+            DeleteOne({"type" : "node", "id" : "1"})
+        ], ordered = False)
+        assert result == BulkWriteResult(2, 1, 1, 1)
+        assert sorted((document["type"], document["id"]) for document in collection.find()) == \
+               [("node", "2"), ("node", "3"), ("way", "1")]
+        assert collection.explain_query({"type" : "node", "id" : "3"})[0].startswith("SEARCH")
+
+        # The _id ranges are filtered on the primary key
+        assert "PRIMARY KEY" in collection.explain_query({"_id" : {"$gte" : 4}})[0]
+        assert collection.delete_many({"_id" : {"$gte" : 4}, "type" : "node"}).deleted_count == 1
+        assert sorted(document["id"] for document in collection.find()) == ["1", "2"]
+
+        # The datetimes are read back as datetimes
+        timestamp = datetime.datetime(2015, 1, 2, 3, 4, 5)
+        collection.insert_many([{"type" : "node", "id" : 4, "created" : {"timestamp" : timestamp}}])
+        assert collection.find_one({"id" : 4})["created"]["timestamp"] == timestamp
+        assert collection.find_one({"created.timestamp" : {"$gte" : datetime.datetime(2015, 1, 1)}})["id"] == 4
+
+        stats = collection.collection_stats()
+        assert stats["size"] > 0 and stats["storageSize"] > 0 and stats["totalIndexSize"] > 0
+        client.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+
+# A generator of synthetic OSM files that look like the Montreal extract, of any size, for the benchmarks (see
+# benchmarks.py). The same seed always gives the same file.
+# Like the real map, most of the nodes have no tags at all (they are the points of the ways), a few are amenities with a
+# name, an address and a phone number, the ways reference runs of nodes and carry street names, and there are some
+# relations. The values have the same mess as the real ones: French and English street names, abbreviated or not,
+# phone numbers and postal codes in all sorts of formats (some of them corrupt), phones under contact:phone, addresses
+# with the city in the street name... The contributors follow a long tailed distribution: a few of them made most of
+# the elements.
+
+import random
+from xml.sax.saxutils import quoteattr
+
+
+# The bounding box of the greater Montreal
+MIN_LATITUDE, MAX_LATITUDE = 45.40, 45.70
+MIN_LONGITUDE, MAX_LONGITUDE = -73.98, -73.47
+
+# The share of the nodes having tags, and the number of nodes per way and per relation
+TAGGED_NODE_FRACTION = 0.08
+NODES_PER_WAY = 7
+NODES_PER_RELATION = 500
+
+USER_COUNT = 800
+
+AMENITIES = [("restaurant", 30), ("cafe", 12), ("fast_food", 12), ("bank", 6), ("pharmacy", 5), ("bar", 6),
+             ("place_of_worship", 8), ("school", 5), ("parking", 10), ("bench", 6)]
+CUISINES = ["italian", "french", "chinese", "vietnamese", "pizza", "burger", "sandwich", "indian", "japanese",
+            "lebanese", "portuguese", "coffee_shop", "regional"]
+NAMES = {"restaurant" : ["Chez Lévesque", "L'Express", "Schwartz's", "Au Pied de Cochon", "Le Petit Alep"],
+         "cafe" : ["Tim Hortons", "Starbucks", "Second Cup", "Café Olimpico", "Café Myriade"],
+         "fast_food" : ["McDonald's", "Subway", "A&W", "Tim Hortons", "La Belle Province"],
+         "bank" : ["Desjardins", "Banque Nationale", "RBC", "TD Canada Trust", "BMO"],
+         "pharmacy" : ["Jean Coutu", "Pharmaprix", "Uniprix", "Familiprix"],
+         "bar" : ["Bily Kun", "Le Saint-Sulpice", "Brutopia", "Dieu du Ciel!"],
+         "place_of_worship" : ["Église Saint-Jean-Baptiste", "St. Patrick's Basilica", "Oratoire Saint-Joseph"],
+         "school" : ["École Saint-Louis", "Collège de Montréal", "FACE School"]}
+DENOMINATIONS = ["catholic", "roman_catholic", "anglican", "orthodox", "jewish", "baptist"]
+
+STREET_NAMES = ["Saint-Denis", "Saint-Laurent", "Sherbrooke", "Sainte-Catherine", "de la Montagne", "Notre-Dame",
+                "Saint-Hubert", "Papineau", "Côte-des-Neiges", "Mont-Royal", "René-Lévesque", "Saint-Urbain",
+                "Jean-Talon", "Beaubien", "Rachel", "Masson", "Wellington", "Peel", "Crescent", "Atwater",
+                "Sainte-Anne", "du Parc", "de Maisonneuve", "Saint-Joseph", "Henri-Bourassa"]
+ENGLISH_STREET_NAMES = ["Sherbrooke", "Victoria", "Queen Mary", "Decarie", "Monkland", "Greene", "Somerville",
+                        "Lakeshore", "Westminster", "Cote Saint-Luc", "Peel", "Elm", "Maple"]
+FRENCH_QUALIFIERS = ["Rue", "Rue", "Rue", "rue", "Boulevard", "Boul.", "boul", "Avenue", "Av.", "Chemin", "ch.",
+                     "Place", "Montée", "Ruelle"]
+ENGLISH_QUALIFIERS = ["Street", "Street", "St.", "St", "Avenue", "Ave", "Road", "Boulevard", "Crescent"]
+FRENCH_DIRECTIONS = ["", "", "", "Est", "Ouest", "E.", "O."]
+ENGLISH_DIRECTIONS = ["", "", "", "West", "East", "W.", "E."]
+LONG_ADDRESS_SUFFIXES = [", Montréal", ", Montreal, QC", " Montreal", ", Québec, Canada"]
+
+AREA_CODES = ["514", "514", "514", "438", "450"]
+POSTCODE_LETTERS = "ABCEGHJKLMNPRSTVXY"
+
+HIGHWAYS = [("residential", 50), ("service", 20), ("footway", 10), ("secondary", 8), ("primary", 5),
+            ("tertiary", 7)]
+
+
+def weighted_choice(generator, choices):
+    total = sum(weight for value, weight in choices)
+    point = generator.uniform(0, total)
+    for value, weight in choices:
+        point -= weight
+        if point <= 0:
+            return value
+    return choices[-1][0]
+
+
+def street_name(generator):
+    kind = generator.random()
+    if kind < 0.6:
+        name = "%s %s %s" % (generator.choice(FRENCH_QUALIFIERS), generator.choice(STREET_NAMES),
+                             generator.choice(FRENCH_DIRECTIONS))
+        # Saint is often abbreviated in the French names
+        if generator.random() < 0.3:
+            name = name.replace("Sainte-", "Ste-").replace("Saint-", generator.choice(["St-", "St "]))
+    elif kind < 0.9:
+        name = "%s %s %s" % (generator.choice(ENGLISH_STREET_NAMES), generator.choice(ENGLISH_QUALIFIERS),
+                             generator.choice(ENGLISH_DIRECTIONS))
+    elif kind < 0.95:
+        number = generator.randint(1, 40)
+        name = generator.choice(["%de Avenue" % number, "%de Rue" % number,
+                                 "%d%s Avenue" % (number, {1 : "st", 2 : "nd", 3 : "rd"}.get(number % 10, "th"))])
+    else:
+        name = "%s %s%s" % (generator.choice(FRENCH_QUALIFIERS), generator.choice(STREET_NAMES),
+                            generator.choice(LONG_ADDRESS_SUFFIXES))
+    return name.strip()
+
+
+def phone_number(generator):
+    area_code = generator.choice(AREA_CODES)
+    exchange = generator.randint(200, 999)
+    line = generator.randint(0, 9999)
+    formats = ["%s-%03d-%04d", "(%s) %03d-%04d", "+1 %s %03d %04d", "%s.%03d.%04d", "%s%03d%04d", "+1-%s-%03d-%04d",
+               "1 %s %03d-%04d"]
+    kind = generator.random()
+    if kind < 0.85:
+        return generator.choice(formats) % (area_code, exchange, line)
+    if kind < 0.92:
+        # Two numbers in the same tag
+        return "%s-%03d-%04d;%s" % (area_code, exchange, line, generator.choice(formats) % (
+            generator.choice(AREA_CODES), generator.randint(200, 999), generator.randint(0, 9999)))
+    if kind < 0.97:
+        # No area code
+        return "%03d-%04d" % (exchange, line)
+    return generator.choice(["n/a", "514", "voir site web", "+1 514"])
+
+
+def postal_code(generator):
+    code = "%s%d%s %d%s%d" % (generator.choice("HJ"), generator.randint(1, 9), generator.choice(POSTCODE_LETTERS),
+                              generator.randint(0, 9), generator.choice(POSTCODE_LETTERS), generator.randint(0, 9))
+    kind = generator.random()
+    if kind < 0.7:
+        return code
+    if kind < 0.8:
+        return code.lower()
+    if kind < 0.88:
+        return code.replace(" ", "")
+    if kind < 0.95:
+        return code.replace(" ", "-")
+    return generator.choice([code[:3], "Québec", "QC " + code, "H2X 1Y"])
+
+
+# The user and uid of an element, from a long tailed distribution
+def contributor(generator):
+    index = min(int(generator.paretovariate(1.1)) - 1, USER_COUNT - 1)
+    return "mtl_mapper_%d" % index, 1000 + index
+
+
+def write_tag(osm_file, key, value):
+    osm_file.write('  <tag k=%s v=%s/>\n' % (quoteattr(key), quoteattr(value)))
+
+
+def start_element(osm_file, generator, tag, element_id, extra = ""):
+    user, uid = contributor(generator)
+    osm_file.write(' <%s id="%d" version="%d" changeset="%d" timestamp="20%02d-%02d-%02dT%02d:%02d:%02dZ" user=%s '
+                   'uid="%d"%s' % (tag, element_id, generator.randint(1, 12), generator.randint(1000000, 40000000),
+                                   generator.randint(8, 16), generator.randint(1, 12), generator.randint(1, 28),
+                                   generator.randint(0, 23), generator.randint(0, 59), generator.randint(0, 59),
+                                   quoteattr(user), uid, extra))
+
+
+def write_address(osm_file, generator):
+    write_tag(osm_file, "addr:housenumber", str(generator.randint(1, 9999)))
+    write_tag(osm_file, "addr:street", street_name(generator))
+    if generator.random() < 0.6:
+        write_tag(osm_file, "addr:postcode", postal_code(generator))
+    if generator.random() < 0.3:
+        write_tag(osm_file, "addr:city", generator.choice(["Montréal", "Montreal", "Laval", "Longueuil"]))
+    if generator.random() < 0.05:
+        write_tag(osm_file, "addr:state", "QC")
+
+
+def write_amenity_tags(osm_file, generator):
+    amenity = weighted_choice(generator, AMENITIES)
+    write_tag(osm_file, "amenity", amenity)
+    if amenity in NAMES:
+        write_tag(osm_file, "name", generator.choice(NAMES[amenity]))
+    if amenity in ("restaurant", "fast_food", "cafe") and generator.random() < 0.6:
+        write_tag(osm_file, "cuisine", generator.choice(CUISINES))
+    if amenity == "place_of_worship":
+        write_tag(osm_file, "religion", "christian" if generator.random() < 0.85 else "jewish")
+        write_tag(osm_file, "denomination", generator.choice(DENOMINATIONS))
+    if generator.random() < 0.3:
+        write_tag(osm_file, "wheelchair", generator.choice(["yes", "no", "limited"]))
+
+    kind = generator.random()
+    if kind < 0.45:
+        write_tag(osm_file, "phone", phone_number(generator))
+    elif kind < 0.6:
+        write_tag(osm_file, "contact:phone", phone_number(generator))
+    if generator.random() < 0.15:
+        write_tag(osm_file, "contact:website", "http://www.example.com/%d" % generator.randint(1, 100000))
+    if generator.random() < 0.55:
+        write_address(osm_file, generator)
+    if generator.random() < 0.2:
+        write_tag(osm_file, "opening_hours", "Mo-Fr 08:00-18:00")
+
+
+# Writes a synthetic map with node_count nodes, a way for every NODES_PER_WAY nodes and a relation for every
+# NODES_PER_RELATION nodes. The nodes come first, then the ways and the relations, like in the OSM files.
+def write_synthetic_map(filename, node_count, seed = 0):
+    generator = random.Random(seed)
+
+    with open(filename, "w") as osm_file:
+        osm_file.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6" generator="synthetic_map.py">\n')
+        osm_file.write(' <bounds minlat="%.7f" minlon="%.7f" maxlat="%.7f" maxlon="%.7f"/>\n' %
+                       (MIN_LATITUDE, MIN_LONGITUDE, MAX_LATITUDE, MAX_LONGITUDE))
+
+        for node_id in xrange(1, node_count + 1):
+            start_element(osm_file, generator, "node", node_id, ' lat="%.7f" lon="%.7f"' %
+                          (generator.uniform(MIN_LATITUDE, MAX_LATITUDE),
+                           generator.uniform(MIN_LONGITUDE, MAX_LONGITUDE)))
+            if generator.random() >= TAGGED_NODE_FRACTION:
+                osm_file.write('/>\n')
+                continue
+
+            osm_file.write('>\n')
+            kind = generator.random()
+            if kind < 0.75:
+                write_amenity_tags(osm_file, generator)
+            elif kind < 0.9:
+                write_address(osm_file, generator)
+            else:
+                write_tag(osm_file, generator.choice(["highway", "railway", "natural"]),
+                          generator.choice(["crossing", "traffic_signals", "stop", "tree", "level_crossing"]))
+            osm_file.write(' </node>\n')
+
+        way_count = max(node_count / NODES_PER_WAY, 1)
+        for way_id in xrange(1, way_count + 1):
+            start_element(osm_file, generator, "way", way_id)
+            osm_file.write('>\n')
+
+            # The ways go through runs of neighbouring nodes, the buildings are closed
+            ref_count = generator.randint(2, 16)
+            first_ref = generator.randint(1, max(node_count - ref_count, 1))
+            refs = range(first_ref, min(first_ref + ref_count, node_count + 1))
+            is_building = generator.random() < 0.4
+            if is_building:
+                refs.append(refs[0])
+            for ref in refs:
+                osm_file.write('  <nd ref="%d"/>\n' % ref)
+
+            if is_building:
+                write_tag(osm_file, "building", generator.choice(["yes", "yes", "house", "apartments", "commercial"]))
+                if generator.random() < 0.3:
+                    write_address(osm_file, generator)
+                elif generator.random() < 0.05:
+                    write_amenity_tags(osm_file, generator)
+            else:
+                write_tag(osm_file, "highway", weighted_choice(generator, HIGHWAYS))
+                if generator.random() < 0.7:
+                    write_tag(osm_file, "name", street_name(generator))
+            osm_file.write(' </way>\n')
+
+        for relation_id in xrange(1, node_count / NODES_PER_RELATION + 1):
+            start_element(osm_file, generator, "relation", relation_id)
+            osm_file.write('>\n')
+            for _ in range(generator.randint(2, 10)):
+                osm_file.write('  <member type="way" ref="%d" role="%s"/>\n' %
+                               (generator.randint(1, way_count), generator.choice(["outer", "inner", ""])))
+            write_tag(osm_file, "type", generator.choice(["multipolygon", "route", "boundary"]))
+            osm_file.write(' </relation>\n')
+
+        osm_file.write('</osm>\n')
+
+
+def test():
+    import os
+    import shutil
+    import tempfile
+
+    import osm_reader
+    from Montreal_data_processing import shape_element
+
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, "map.osm")
+        write_synthetic_map(filename, 5000)
+        with open(filename, "rb") as map_file:
+            data = map_file.read()
+        write_synthetic_map(filename, 5000)
+        with open(filename, "rb") as map_file:
+            assert map_file.read() == data
+
+        tag_count = {}
+        documents = [shape_element(element) for element in osm_reader.iterate_elements(filename, tag_count = tag_count)]
+        documents = [document for document in documents if document]
+        assert tag_count["node"] == 5000 and tag_count["way"] == 5000 / NODES_PER_WAY
+        assert tag_count["relation"] == 5000 / NODES_PER_RELATION and tag_count["bounds"] == 1
+
+        nodes = [document for document in documents if document["type"] == "node"]
+        untagged = [node for node in nodes if "info" not in node and "address" not in node]
+        assert len(untagged) > 0.85 * len(nodes)
+        assert any(document.get("is_amenity") for document in documents)
+        assert any("phone" in document.get("info", {}) for document in documents)
+        assert any("website" in document.get("info", {}) for document in documents)
+        streets = [document["address"]["street"] for document in documents if "street" in document.get("address", {})]
+        assert any(street.startswith("Rue") for street in streets) and any("St." in street for street in streets)
+        assert all(len(document["node_refs"]) >= 2 for document in documents if document["type"] == "way")
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    test()
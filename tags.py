@@ -3,6 +3,7 @@
 import xml.etree.cElementTree as ET
 import pprint
 import re
+from compressed_input import map_source
 """
 Your task is to explore the data a bit more.
 Before you process the data and add it into MongoDB, you should check the "k"
@@ -57,7 +58,7 @@ def key_type(element, keys):
 
 def process_map(filename):
     keys = {"lower": 0, "lower_colon": 0, "problemchars": 0, "other": 0}
-    for _, element in ET.iterparse(filename):
+    for _, element in ET.iterparse(map_source(filename)):
         keys = key_type(element, keys)
 
     return keys
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+# An opt-in typed schema for the documents. shape_element() keeps every value as the string found in the map file, so a
+# way with hundreds of nodes carries hundreds of decimal strings in node_refs. With the typed schema:
+#   - "id" and the entries of "node_refs" are 64 bits integers
+#   - "created.uid", "created.version" and "created.changeset" are integers
+#   - "created.timestamp" is a datetime (UTC)
+#   - "pos" is a GeoJSON point ({"type" : "Point", "coordinates" : [lon, lat]}) instead of [lat, lon], so the 2dsphere
+#     index is built on it directly, without the "location" copy (see index_builder.py)
+# The elements are shaped and cleaned as before, and converted by batch just before they are inserted (see
+# prepare_batch()): the values of a field are gathered for the whole batch and converted by one NumPy call.
+# Integers and datetimes are smaller than their decimal strings in BSON, and so are the indexes on them, and they are
+# compared as numbers and dates by the range queries. pymongo writes the integers fitting on 32 bits as BSON int32, and
+# the others as int64: MongoDB compares them as the same numbers, so the ids are found whatever their size.
+# compare_schemas() (python osm_cli.py compare-schemas MAP) loads a map with both schemas, and prints the size of the
+# collection and of its indexes, and the time of map_stats().
+
+import sys
+import time
+
+import numpy as np
+
+
+INTEGER_CREATED_FIELDS = ("uid", "version", "changeset")
+
+
+def to_integers(values):
+    return np.array(values).astype(np.int64).tolist()
+
+
+# The OSM timestamps are in UTC, like "2015-01-02T03:04:05Z"
+def to_datetimes(values):
+    return np.array([value.rstrip("Z") for value in values], dtype = "datetime64[s]").astype(object).tolist()
+
+
+def geojson_point(latitude, longitude):
+    return {"type" : "Point", "coordinates" : [longitude, latitude]}
+
+
+# The latitude and longitude of a "pos" field, with either schema
+def latitude_longitude(position):
+    if isinstance(position, dict):
+        longitude, latitude = position["coordinates"]
+        return latitude, longitude
+    return position[0], position[1]
+
+
+# Converts a batch of shaped documents to the typed schema, in place, and returns it
+def convert_batch(documents):
+    with_id = [document for document in documents if "id" in document]
+    for document, value in zip(with_id, to_integers([document["id"] for document in with_id])):
+        document["id"] = value
+
+    for field in INTEGER_CREATED_FIELDS:
+        created = [document["created"] for document in documents if field in document.get("created", ())]
+        for fields, value in zip(created, to_integers([fields[field] for fields in created])):
+            fields[field] = value
+
+    created = [document["created"] for document in documents if "timestamp" in document.get("created", ())]
+    for fields, value in zip(created, to_datetimes([fields["timestamp"] for fields in created])):
+        fields["timestamp"] = value
+
+    # All the refs of the batch are converted at once, then split back by way
+    ways = [document for document in documents if "node_refs" in document]
+    refs = to_integers([ref for way in ways for ref in way["node_refs"]])
+    start = 0
+    for way in ways:
+        end = start + len(way["node_refs"])
+        way["node_refs"] = refs[start:end]
+        start = end
+
+    for document in documents:
+        if "pos" in document:
+            document["pos"] = geojson_point(*document["pos"])
+
+    return documents
+
+
+# The size of a collection and of its indexes, in bytes, from MongoDB's collStats or the SQLite backend
+def collection_stats(db, collection):
+    import storage_backend
+
+    if isinstance(collection, storage_backend.SQLiteCollection):
+        stats = collection.collection_stats()
+    else:
+        stats = db.command("collstats", collection.name)
+    return {"size" : stats["size"], "storage_size" : stats["storageSize"], "index_size" : stats["totalIndexSize"]}
+
+
+# Loads the map file with the string schema, then with the typed one, into the active storage backend (see
+# storage_backend.py), with the way geometries, the query indexes and the index of the element ids (see osm_changes.py).
+# Prints and returns, for each schema, the size of the documents in BSON (as stored by MongoDB), the size of the
+# collection and of its indexes as reported by the backend, and the best time of repeat calls of map_stats().
+def compare_schemas(filename, db_name = "schema_comparison", repeat = 3):
+    import bson
+
+    import Montreal_data_processing as processing
+    import osm_changes
+    import storage_backend
+
+    results = {}
+    for schema, typed in (("strings", False), ("typed", True)):
+        processing.insert_xml_map_to_db(filename, db_name, schema, True, clean_on_ingest = True, way_geometry = True,
+                                        typed = typed)
+        processing.build_query_indexes(db_name, schema, typed)
+
+        client = storage_backend.connect()
+        collection = client[db_name][schema]
+        collection.create_index(osm_changes.ELEMENT_KEY, unique = True, name = "element_key")
+        result = collection_stats(client[db_name], collection)
+        result["bson_size"] = 0
+        for document in collection.find():
+            # On MongoDB, build_query_indexes() adds a GeoJSON copy of "pos" to the string schema, for the spatial index
+            if not typed and "pos" in document and "location" not in document:
+                document["location"] = geojson_point(*document["pos"])
+            result["bson_size"] += len(bson.BSON.encode(document))
+        client.close()
+
+        best = None
+        for _ in range(repeat):
+            start = time.time()
+            processing.map_stats(db_name, schema)
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        result["map_stats_seconds"] = best
+        results[schema] = result
+
+    print "Schema comparison on %s (%s backend):" % (filename, storage_backend.active_backend.name)
+    for name in ("bson_size", "size", "storage_size", "index_size", "map_stats_seconds"):
+        strings, typed = results["strings"][name], results["typed"][name]
+        print "  %-18s strings %14.3f   typed %14.3f   %+6.1f%%" % (name, strings, typed,
+                                                                     100.0 * (typed - strings) / max(strings, 1e-9))
+    return results
+
+
+def test():
+    import datetime
+
+    documents = [{"type" : "node", "id" : "4294967296", "pos" : [45.5, -73.6],
+                  "created" : {"uid" : "7", "version" : "2", "changeset" : "30", "timestamp" : "2015-01-02T03:04:05Z",
+                               "user" : "someone"}},
+                 {"type" : "way", "id" : "12", "node_refs" : ["4294967296", "3"], "created" : {"version" : "1"}},
+                 {"type" : "way", "id" : "13", "node_refs" : ["5"]}]
+    node, way, other_way = convert_batch(documents)
+
+    assert node["id"] == 4294967296 and way["id"] == 12
+    assert node["created"] == {"uid" : 7, "version" : 2, "changeset" : 30, "user" : "someone",
+                               "timestamp" : datetime.datetime(2015, 1, 2, 3, 4, 5)}
+    assert way["created"] == {"version" : 1}
+    assert way["node_refs"] == [4294967296, 3] and other_way["node_refs"] == [5]
+    assert node["pos"] == {"type" : "Point", "coordinates" : [-73.6, 45.5]}
+    assert latitude_longitude(node["pos"]) == latitude_longitude([45.5, -73.6]) == (45.5, -73.6)
+    assert convert_batch([]) == []
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        compare_schemas(sys.argv[1])
+    else:
+        test()
@@ -3,6 +3,7 @@
 import xml.etree.cElementTree as ET
 import pprint
 import re
+from compressed_input import map_source
 """
 Your task is to explore the data a bit more.
 The first task is a fun one - find out how many unique users
@@ -18,7 +19,7 @@ def get_user(element):
 
 def process_map(filename):
     users = set()
-    for _, element in ET.iterparse(filename):
+    for _, element in ET.iterparse(map_source(filename)):
         if "uid" in element.attrib:
             users.add(element.attrib["uid"])
 